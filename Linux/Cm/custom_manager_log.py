@@ -0,0 +1,80 @@
+# Handlers of the CustomManager event log pipeline (custom_manager.EventLogPipeline).
+# They live apart from custom_manager so that logging.handlers, which pulls in
+# socket and pickle, is only imported once the first event is logged.
+import logging.handlers
+import queue
+
+# QueueHandler that drops and counts records when the queue is full, so a
+# burst of events never makes the caller wait on log I/O
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, event_queue):
+        super().__init__(event_queue)
+        self.queued = 0
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.queued += 1
+        except queue.Full:
+            self.dropped += 1
+
+# RotatingFileHandler that can write a whole batch with one flush
+class BatchRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    def emit_batch(self, records):
+        lines = []
+        for record in records:
+            if self.filter(record):
+                try:
+                    lines.append(self.format(record) + self.terminator)
+                except Exception:
+                    self.handleError(record)
+        if not lines:
+            return
+        self.acquire()
+        try:
+            for line in lines:
+                if self.stream is None:
+                    self.stream = self._open()
+                if self.maxBytes and self.stream.tell() + len(line) >= self.maxBytes:
+                    self.doRollover()
+                    if self.stream is None:
+                        self.stream = self._open()
+                self.stream.write(line)
+            self.stream.flush()
+        except OSError:
+            self.handleError(records[-1])
+        finally:
+            self.release()
+
+# QueueListener that drains up to batch_size records at a time and hands them
+# to each handler as one batch
+class BatchQueueListener(logging.handlers.QueueListener):
+    def __init__(self, event_queue, *handlers, batch_size):
+        super().__init__(event_queue, *handlers)
+        self.batch_size = batch_size
+        self.written = 0
+
+    def enqueue_sentinel(self):
+        # Blocks while the queue is full; the writer thread is still draining it
+        self.queue.put(self._sentinel)
+
+    def _monitor(self):
+        q = self.queue
+        while True:
+            batch = [q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = any(record is self._sentinel for record in batch)
+            records = [record for record in batch if record is not self._sentinel]
+            if records:
+                for handler in self.handlers:
+                    handler.emit_batch(records)
+                self.written += len(records)
+            for _ in batch:
+                q.task_done()
+            if stop:
+                break